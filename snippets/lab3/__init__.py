@@ -1,4 +1,6 @@
 from snippets.lab2 import *
+from contextlib import contextmanager
+import select
 import threading
 
 
@@ -7,12 +9,61 @@ import threading
 # socket.setdefaulttimeout(5) # set default timeout for blocking operations to 5 seconds
 
 
+# Messages are sent as frames: a header carrying the length of the payload, followed by the payload itself.
+# The header is a varint (7 bits per byte, least significant bits first, where the most significant bit
+# of each byte tells whether more bytes follow) encoding the length shifted left by one bit:
+# the lowest bit tells whether more frames follow, i.e. whether the message is streamed across many frames.
+# So, short messages pay 1 or 2 bytes of header, while long ones are not limited in size by the header.
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024 # default upper bound to the size of messages, to protect receivers against huge frames
+MAX_HEADER_SIZE = 10 # enough for 64-bit lengths
+RECEIVE_BUFFER_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024 # streamed messages are sent in frames of (at least) this size
+
+
+def encode_header(length: int, more: bool = False) -> bytes:
+    value = (length << 1) | more
+    header = bytearray()
+    while value >= 0x80:
+        header.append((value & 0x7F) | 0x80)
+        value >>= 7
+    header.append(value)
+    return bytes(header)
+
+
+def decode_header(buffer, start: int = 0, end: int = None) -> tuple[int, bool, int] | None:
+    """
+    Decodes the frame header at the beginning of `buffer[start:end]`.
+    Returns a triple (length, whether more frames follow, header size),
+    or None if the buffer does not contain the whole header yet.
+    """
+    if end is None:
+        end = len(buffer)
+    value = 0
+    for i in range(min(end - start, MAX_HEADER_SIZE)):
+        byte = buffer[start + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if byte < 0x80:
+            return value >> 1, bool(value & 1), i + 1
+    if end - start >= MAX_HEADER_SIZE:
+        raise ValueError("Malformed frame header")
+    return None
+
+
 class Connection:
-    def __init__(self, socket: socket.socket, callback=None):
+    def __init__(self, socket: socket.socket, callback=None, max_frame_size: int = MAX_FRAME_SIZE):
         self.__socket = socket
         self.local_address = self.__socket.getsockname()
         self.remote_address = self.__socket.getpeername()
+        self.max_frame_size = max_frame_size
+        self.binary = False # whether 'message' events carry raw bytes, rather than decoded strings
+        # received data is accumulated in a reusable buffer: self.__view[self.__start:self.__end] is yet to be consumed
+        self.__buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0
+        self.__end = 0
         self.__notify_closed = False
+        self.__send_lock = threading.Lock() # many threads may send on the same connection
         self.__callback = callback
         self.__receiver_thread = threading.Thread(target=self.__handle_incoming_messages, daemon=True)
         if self.__callback:
@@ -33,20 +84,135 @@ class Connection:
     @property
     def closed(self):
         return self.__socket._closed
-    
+
+    @property
+    def alive(self):
+        """
+        Cheap health check for idle connections: the socket must be open, and there must be nothing to read.
+        A readable (or non-empty buffer) idle socket means either the remote peer has closed the connection, or unexpected data arrived.
+        """
+        if self.closed or self.__end > self.__start:
+            return False
+        try:
+            readable, _, _ = select.select([self.__socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
     def send(self, message):
-        if not isinstance(message, bytes):
+        if isinstance(message, str):
             message = message.encode()
-            message = int.to_bytes(len(message), 2, 'big') + message
-        self.__socket.sendall(message)
+        if len(message) > self.max_frame_size:
+            raise ValueError(f"Message of {len(message)} bytes exceeds the maximum frame size of {self.max_frame_size} bytes")
+        with self.__send_lock:
+            self.__send_frame(message)
+
+    def __send_frame(self, payload, more: bool = False):
+        header = encode_header(len(payload), more)
+        if len(payload) < RECEIVE_BUFFER_SIZE:
+            self.__socket.sendall(header + payload) # a single write avoids delays due to Nagle's algorithm
+        else:
+            self.__socket.sendall(header) # large payloads are not copied just to prepend the header
+            self.__socket.sendall(payload)
+
+    @contextmanager
+    def stream(self):
+        """
+        Sends a single message as a sequence of frames, via the `write` function provided by this context manager,
+        which accepts either strings or bytes: data is sent as soon as at least `STREAM_CHUNK_SIZE` bytes are written.
+        So, the whole message is never in memory at once on the sending side.
+        Receivers join the frames back into a single message, which is still bounded by their `max_frame_size`.
+        The message ends when the context is exited. If that happens because of an exception, the connection is closed,
+        as the message cannot be completed.
+        """
+        chunk = bytearray()
+
+        def write(data):
+            if isinstance(data, str):
+                data = data.encode()
+            if not chunk and len(data) >= STREAM_CHUNK_SIZE:
+                self.__send_frame(data, more=True) # no need to copy large data into the chunk
+                return
+            chunk.extend(data)
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                self.__send_frame(chunk, more=True)
+                chunk.clear()
+
+        with self.__send_lock:
+            try:
+                yield write
+            except:
+                self.close()
+                raise
+            self.__send_frame(chunk)
 
     def receive(self):
-        length = int.from_bytes(self.__socket.recv(2), 'big')
-        if length == 0:
+        message = self.receive_bytes()
+        if message is None:
             return None
-        return self.__socket.recv(length).decode()
+        return message.decode()
+
+    def receive_bytes(self) -> bytes | bytearray | None:
+        """
+        Receives the next whole message, looping over the socket as many times as needed,
+        and joining its frames, in case it was streamed.
+        Returns None if the connection is closed by the remote peer in between messages.
+        """
+        frame, more = self.__receive_frame()
+        if frame is None or not more:
+            return frame
+        message = bytearray(frame)
+        while more:
+            frame, more = self.__receive_frame(len(message))
+            if frame is None:
+                raise ConnectionError("Connection closed by %s:%d in the middle of a message" % self.remote_address)
+            message += frame
+        return message
+
+    def __receive_frame(self, received_so_far: int = 0) -> tuple[bytes | bytearray | None, bool]:
+        while (header := decode_header(self.__view, self.__start, self.__end)) is None:
+            if not self.__fill_buffer():
+                return None, False
+        length, more, header_size = header
+        if received_so_far + length > self.max_frame_size:
+            raise ValueError(f"Message of {received_so_far + length}+ bytes exceeds the maximum frame size of {self.max_frame_size} bytes")
+        self.__start += header_size
+        available = self.__end - self.__start
+        if length <= available:
+            frame = bytes(self.__view[self.__start:self.__start + length])
+            self.__start += length
+            return frame, more
+        # the frame is larger than the buffered data: the payload is received directly into its own buffer
+        payload = bytearray(length)
+        payload[:available] = self.__view[self.__start:self.__end]
+        self.__start = self.__end = 0
+        missing = memoryview(payload)[available:]
+        while missing:
+            received = self.__socket.recv_into(missing)
+            if received == 0:
+                raise ConnectionError("Connection closed by %s:%d in the middle of a frame" % self.remote_address)
+            missing = missing[received:]
+        return payload, more
+
+    def __fill_buffer(self) -> bool:
+        if self.__start > 0: # move the unconsumed data to the beginning of the buffer
+            pending = self.__end - self.__start
+            self.__view[:pending] = self.__view[self.__start:self.__end]
+            self.__start, self.__end = 0, pending
+        received = self.__socket.recv_into(self.__view[self.__end:])
+        if received == 0:
+            if self.__end > 0:
+                raise ConnectionError("Connection closed by %s:%d in the middle of a frame" % self.remote_address)
+            return False
+        self.__end += received
+        return True
     
     def close(self):
+        try:
+            # unlike close alone, shutdown wakes up a thread blocked receiving (and notifies the peer) when closing from another thread
+            self.__socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # already closed, either locally or by the peer
         self.__socket.close()
         if not self.__notify_closed:
             self.on_event('close')
@@ -55,7 +221,7 @@ class Connection:
     def __handle_incoming_messages(self):
         try:
             while not self.closed:
-                message = self.receive()
+                message = self.receive_bytes() if self.binary else self.receive()
                 if message is None:
                     break
                 self.on_event('message', message)
@@ -73,17 +239,26 @@ class Connection:
 
 
 class Client(Connection):
-    def __init__(self, server_address, callback=None):
+    def __init__(self, server_address, callback=None, max_frame_size: int = MAX_FRAME_SIZE):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.bind(address(port=0))
         sock.connect(address(*server_address))
-        super().__init__(sock, callback)
+        super().__init__(sock, callback, max_frame_size)
 
 
 class Server:
-    def __init__(self, port, callback=None):
+    def __init__(self, port, callback=None, max_connections: int = None, max_frame_size: int = MAX_FRAME_SIZE, reuse_port: bool = False):
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port: # many processes may listen on the same port, the kernel spreading incoming connections among them
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise ValueError("Sharing ports among processes (SO_REUSEPORT) is not supported on this platform")
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.__socket.bind(address(port=port))
+        self.__socket.listen() # listening right away, so that clients can connect as soon as the server is created
+        self.local_address = self.__socket.getsockname()
+        self.max_connections = max_connections
+        self.max_frame_size = max_frame_size
+        self.__connections: set[Connection] = set()
         self.__listener_thread = threading.Thread(target=self.__handle_incoming_connections, daemon=True)
         self.__callback = callback
         if self.__callback:
@@ -102,12 +277,19 @@ class Server:
             self.__listener_thread.start()
     
     def __handle_incoming_connections(self):
-        self.__socket.listen()
         self.on_event('listen', address=self.__socket.getsockname())
         try:
             while not self.__socket._closed:
                 socket, address = self.__socket.accept()
-                connection = Connection(socket)
+                if self.max_connections is not None:
+                    self.__connections = {c for c in self.__connections if not c.closed}
+                    if len(self.__connections) >= self.max_connections:
+                        socket.close() # refuse connections beyond the limit, rather than spawning more threads
+                        self.on_event('reject', address=address)
+                        continue
+                connection = Connection(socket, max_frame_size=self.max_frame_size)
+                if self.max_connections is not None:
+                    self.__connections.add(connection)
                 self.on_event('connect', connection, address)
         except ConnectionAbortedError as e:
             pass # silently ignore error, because this is simply the socket being closed locally
@@ -121,3 +303,13 @@ class Server:
 
     def close(self):
         self.__socket.close()
+
+
+if __name__ == '__main__':
+    for length in (0, 1, 63, 64, 300, 2**16, 2**32 + 5):
+        for more in (False, True):
+            header = encode_header(length, more)
+            assert decode_header(header) == (length, more, len(header))
+            assert decode_header(header[:-1]) is None
+    assert encode_header(300) == b'\xd8\x04'
+    assert encode_header(300, more=True) == b'\xd9\x04'
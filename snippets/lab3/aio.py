@@ -0,0 +1,208 @@
+from snippets.lab3 import address, encode_header, MAX_FRAME_SIZE, MAX_HEADER_SIZE
+import asyncio
+import inspect
+
+
+class AsyncConnection:
+    """
+    The asyncio counterpart of `Connection`: same wire format, same events ('message', 'close', 'error'),
+    but no threads, as incoming messages are handled by a task on the event loop.
+    Callbacks may either be plain functions or coroutine functions.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, callback=None, max_frame_size: int = MAX_FRAME_SIZE):
+        self.__reader = reader
+        self.__writer = writer
+        self.max_frame_size = max_frame_size
+        self.binary = False # whether 'message' events carry raw bytes, rather than decoded strings
+        self.local_address = writer.get_extra_info('sockname')[:2]
+        self.remote_address = writer.get_extra_info('peername')[:2]
+        self.__notify_closed = False
+        self.__callback = callback
+        self.__receiver_task: asyncio.Task | None = None
+        if self.__callback:
+            self.__start_receiving()
+
+    def __start_receiving(self):
+        self.__receiver_task = asyncio.get_running_loop().create_task(self.__handle_incoming_messages())
+
+    @property
+    def callback(self):
+        return self.__callback or (lambda *_: None)
+
+    @callback.setter
+    def callback(self, value):
+        if self.__callback:
+            raise ValueError("Callback can only be set once")
+        self.__callback = value
+        if value:
+            self.__start_receiving()
+
+    @property
+    def closed(self):
+        return self.__writer.is_closing()
+
+    async def send(self, message):
+        if isinstance(message, str):
+            message = message.encode()
+        if len(message) > self.max_frame_size:
+            raise ValueError(f"Message of {len(message)} bytes exceeds the maximum frame size of {self.max_frame_size} bytes")
+        self.__writer.write(encode_header(len(message)))
+        self.__writer.write(message) # the transport buffers both writes, so no copy is needed to prepend the header
+        await self.__writer.drain()
+
+    async def receive(self):
+        message = await self.receive_bytes()
+        if message is None:
+            return None
+        return message.decode()
+
+    async def receive_bytes(self) -> bytes | bytearray | None:
+        """
+        Receives the next whole message, joining its frames, in case it was streamed by a `Connection`.
+        """
+        header = await self.__receive_header()
+        if header is None:
+            return None
+        message = None
+        while True:
+            length, more = header
+            received_so_far = len(message) if message is not None else 0
+            if received_so_far + length > self.max_frame_size:
+                raise ValueError(f"Message of {received_so_far + length}+ bytes exceeds the maximum frame size of {self.max_frame_size} bytes")
+            try:
+                frame = await self.__reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                raise ConnectionError("Connection closed by %s:%d in the middle of a frame" % self.remote_address)
+            if message is None and not more:
+                return frame
+            if message is None:
+                message = bytearray(frame)
+            else:
+                message += frame
+            if not more:
+                return message
+            header = await self.__receive_header()
+            if header is None:
+                raise ConnectionError("Connection closed by %s:%d in the middle of a message" % self.remote_address)
+
+    async def __receive_header(self) -> tuple[int, bool] | None:
+        # same format of encode_header/decode_header, read byte by byte from the (buffered) stream reader
+        value = 0
+        for i in range(MAX_HEADER_SIZE):
+            chunk = await self.__reader.read(1)
+            if not chunk:
+                if i == 0:
+                    return None
+                raise ConnectionError("Connection closed by %s:%d in the middle of a frame" % self.remote_address)
+            value |= (chunk[0] & 0x7F) << (7 * i)
+            if chunk[0] < 0x80:
+                return value >> 1, bool(value & 1)
+        raise ValueError("Malformed frame header")
+
+    async def close(self):
+        self.__writer.close()
+        try:
+            await self.__writer.wait_closed()
+        except OSError:
+            pass # the remote peer may have already reset the connection
+        if not self.__notify_closed:
+            self.__notify_closed = True
+            await self.on_event('close')
+
+    async def __handle_incoming_messages(self):
+        try:
+            while not self.closed:
+                message = await (self.receive_bytes() if self.binary else self.receive())
+                if message is None:
+                    break
+                await self.on_event('message', message)
+        except Exception as e:
+            if self.closed and isinstance(e, OSError):
+                return # silently ignore error, because this is simply the socket being closed locally
+            await self.on_event('error', error=e)
+        finally:
+            await self.close()
+
+    async def on_event(self, event: str, payload: str=None, connection: 'AsyncConnection'=None, error: Exception=None):
+        if connection is None:
+            connection = self
+        result = self.callback(event, payload, connection, error)
+        if inspect.isawaitable(result):
+            await result
+
+
+class AsyncClient(AsyncConnection):
+    """
+    Use `await AsyncClient.connect(server_address, callback)` to create instances, as connecting requires awaiting.
+    """
+
+    @classmethod
+    async def connect(cls, server_address, callback=None, max_frame_size: int = MAX_FRAME_SIZE) -> 'AsyncClient':
+        reader, writer = await asyncio.open_connection(*address(*server_address))
+        return cls(reader, writer, callback, max_frame_size)
+
+
+class AsyncServer:
+    """
+    The asyncio counterpart of `Server`: same events ('listen', 'connect', 'stop', 'error'),
+    but all connections are served by a single event loop, rather than one thread each.
+    Listening starts upon `await server.start()`.
+    """
+
+    def __init__(self, port: int, callback=None, max_frame_size: int = MAX_FRAME_SIZE):
+        self.__port = port
+        self.max_frame_size = max_frame_size
+        self.__callback = callback
+        self.__server: asyncio.Server | None = None
+
+    @property
+    def callback(self):
+        return self.__callback or (lambda *_: None)
+
+    @callback.setter
+    def callback(self, value):
+        if self.__callback:
+            raise ValueError("Callback can only be set once")
+        self.__callback = value
+
+    @property
+    def local_address(self):
+        if self.__server is None:
+            return None
+        return self.__server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        try:
+            host, port = address(port=self.__port)
+            self.__server = await asyncio.start_server(self.__handle_incoming_connection, host, port)
+        except Exception as e:
+            await self.on_event('error', error=e)
+            raise
+        await self.on_event('listen', address=self.local_address)
+
+    async def serve_forever(self):
+        if self.__server is None:
+            await self.start()
+        try:
+            await self.__server.serve_forever() # type: ignore
+        except asyncio.CancelledError:
+            pass # the server has been closed
+
+    async def __handle_incoming_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = AsyncConnection(reader, writer, max_frame_size=self.max_frame_size)
+        try:
+            await self.on_event('connect', connection, connection.remote_address)
+        except Exception as e:
+            await self.on_event('error', error=e)
+
+    async def on_event(self, event: str, connection: AsyncConnection=None, address: tuple=None, error: Exception=None):
+        result = self.callback(event, connection, address, error)
+        if inspect.isawaitable(result):
+            await result
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close() # just like Server.close, open connections are left untouched
+            self.__server = None
+            await self.on_event('stop')
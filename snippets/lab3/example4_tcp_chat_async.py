@@ -0,0 +1,70 @@
+from snippets.lab3 import message, local_ips, address
+from snippets.lab3.aio import AsyncClient, AsyncServer
+import asyncio
+import sys
+
+
+mode = sys.argv[1].lower().strip()
+remote_peer: AsyncClient | None = None
+
+
+async def send_message(msg, sender):
+    if remote_peer is None:
+        print("No peer connected, message is lost")
+    elif msg:
+        await remote_peer.send(message(msg.strip(), sender))
+    else:
+        print("Empty message, not sent")
+
+
+def on_message_received(event, payload, connection, error):
+    match event:
+        case 'message':
+            print(payload)
+        case 'close':
+            print(f"Connection with peer {connection.remote_address} closed")
+            global remote_peer; remote_peer = None
+        case 'error':
+            print(error)
+
+
+def on_new_connection(event, connection, address, error):
+    match event:
+        case 'listen':
+            print(f"Server listening on port {address[1]} at {', '.join(local_ips())}")
+        case 'connect':
+            print(f"Open ingoing connection from: {address}")
+            connection.callback = on_message_received
+            global remote_peer; remote_peer = connection
+        case 'stop':
+            print(f"Stop listening for new connections")
+        case 'error':
+            print(error)
+
+
+async def main():
+    global remote_peer
+    server = None
+    if mode == 'server':
+        server = AsyncServer(int(sys.argv[2]), on_new_connection)
+        await server.start()
+    elif mode == 'client':
+        remote_peer = await AsyncClient.connect(address(sys.argv[2]), on_message_received)
+        print(f"Connected to {remote_peer.remote_address}")
+
+    # input() is blocking, so it is run in a separate thread, in order not to block the event loop
+    username = await asyncio.to_thread(input, 'Enter your username to start the chat:\n')
+    print('Type your message and press Enter to send it. Messages from other peers will be displayed below.')
+    while True:
+        try:
+            content = await asyncio.to_thread(input)
+            await send_message(content, username)
+        except (EOFError, KeyboardInterrupt):
+            if remote_peer:
+                await remote_peer.close()
+            break
+    if server:
+        await server.close()
+
+
+asyncio.run(main())
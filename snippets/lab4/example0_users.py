@@ -8,7 +8,7 @@ user_db = InMemoryUserDatabase(debug=_PRINT_LOGS)
 auth_service = InMemoryAuthenticationService(user_db, debug=_PRINT_LOGS)
 
 
-gc_user = User(
+gc_user: User = User(
     username='gciatto',
     emails={'giovanni.ciatto@unibo.it', 'giovanni.ciatto@gmail.com'},
     full_name='Giovanni Ciatto',
@@ -18,9 +18,9 @@ gc_user = User(
 
 gc_user_hidden_password = gc_user.copy(password=None)
 
-gc_credentials_ok = [Credentials(id, gc_user.password) for id in gc_user.ids] # type: ignore
+gc_credentials_ok: list[Credentials] = [Credentials(id, gc_user.password) for id in gc_user.ids] # type: ignore
 
-gc_credentials_wrong = Credentials(
+gc_credentials_wrong: Credentials = Credentials(
     id='giovanni.ciatto@unibo.it',
     password='wrong password',
 )
@@ -71,7 +71,143 @@ assert auth_service.validate_token(gc_token) == True
 gc_token_wrong_signature = gc_token.copy(signature='wrong signature')
 assert auth_service.validate_token(gc_token_wrong_signature) == False
 
+# A token whose user was tampered with should be invalid, even if its signature was found valid before
+assert auth_service.validate_token(gc_token) == True
+gc_token_tampered = gc_token.copy(user=gc_user_hidden_password.copy(role=Role.USER))
+assert auth_service.validate_token(gc_token_tampered) == False
+assert auth_service.validate_token(gc_token.copy(signature='sìgnature')) == False
+
 # A token with expiration in the past should be invalid
 gc_token_expired = auth_service.authenticate(gc_credentials_ok[0], timedelta(milliseconds=10))
 time.sleep(0.1)
 assert auth_service.validate_token(gc_token_expired) == False
+
+if __name__ == '__main__':
+    # A revoked token should be invalid, even if genuine and unexpired
+    assert auth_service.revoke_token(gc_token) == True
+    assert auth_service.validate_token(gc_token) == False
+    assert auth_service.revoke_token(gc_token) == False # already invalid
+
+    # All the tokens of a user can be revoked at once
+    gc_tokens = [auth_service.authenticate(gc_credentials_ok[0]) for _ in range(3)]
+    assert auth_service.revoke_user_tokens('gciatto') == 3
+    assert not any(auth_service.validate_token(token) for token in gc_tokens)
+
+    # Expired tokens are forgotten, revoked or not
+    tracked = auth_service.stats['tracked']
+    auth_service.revoke_token(auth_service.authenticate(gc_credentials_ok[0], timedelta(milliseconds=200)))
+    auth_service.authenticate(gc_credentials_ok[0], timedelta(milliseconds=200))
+    assert auth_service.stats['tracked'] == tracked + 2
+    deadline = time.monotonic() + 5 # the sweeper runs upon expiration, but it may be late on a busy machine
+    while auth_service.stats['tracked'] != tracked and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert auth_service.stats['tracked'] == tracked and auth_service.stats['tracked_revoked'] == 4
+
+    # Users can be added by many threads at once: when many of them compete for the same ID, exactly one wins
+    from concurrent.futures import ThreadPoolExecutor
+    import sys
+    import threading
+
+    from .users.compact import CompactUserDatabase
+
+    def add_contenders(stress_db: UserDatabase, thread: int) -> list[bool]:
+        # each thread tries to add a user per contended email, with a username of its own
+        added = []
+        for i in range(contended_ids):
+            start_line.wait() # all threads add their users for the same email at the same time
+            try:
+                stress_db.add_user(User(f'user{i}-{thread}', {f'user{i}@example.com'}, password='password'))
+                added.append(True)
+            except ValueError:
+                added.append(False)
+        return added
+
+    contenders, contended_ids = 8, 500
+    start_line = threading.Barrier(contenders)
+    for stress_db in (InMemoryUserDatabase(debug=False, hasher=PasswordHasher(iterations=1)),
+                      CompactUserDatabase(debug=False, hasher=PasswordHasher(iterations=1))):
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6) # switching threads as often as possible, to make races likely
+        try:
+            with ThreadPoolExecutor(contenders) as executor:
+                outcomes = list(executor.map(lambda thread: add_contenders(stress_db, thread), range(contenders)))
+        finally:
+            sys.setswitchinterval(switch_interval)
+        for i in range(contended_ids):
+            winners = [thread for thread in range(contenders) if outcomes[thread][i]]
+            assert len(winners) == 1
+            assert stress_db.get_user(f'user{i}@example.com').username == f'user{i}-{winners[0]}'
+            for thread in range(contenders):
+                if thread != winners[0]:
+                    try:
+                        stress_db.get_user(f'user{i}-{thread}')
+                        assert False, "Losers must not be added under any of their IDs"
+                    except KeyError:
+                        pass
+        if isinstance(stress_db, CompactUserDatabase):
+            assert len(stress_db) == contended_ids
+
+    # Users can be spread among many databases (shards) by username, via consistent hashing
+    from .users.sharding import HashRing, ShardedUserDatabase
+    ring, bigger_ring = HashRing(4), HashRing(5)
+    owners = [ring.node_of(f'user{i}') for i in range(10_000)]
+    assert all(2_000 <= owners.count(node) <= 3_000 for node in range(4)) # keys are evenly spread among nodes
+    moved = sum(owner != bigger_ring.node_of(f'user{i}') for i, owner in enumerate(owners))
+    assert moved < 3_000 # adding a node moves about 1/5 of the keys, rather than all of them
+
+    shards: list[UserDatabase] = [InMemoryUserDatabase(debug=False, hasher=PasswordHasher(iterations=1)) for _ in range(4)]
+    sharded_db = ShardedUserDatabase(shards, debug=False)
+    sharded_users = [User(f'user{i}', {f'user{i}@example.com'}, password=f'password{i}') for i in range(20)]
+    assert sharded_db.add_users(sharded_users) == [None] * len(sharded_users)
+    for user in sharded_users:
+        assert shards[sharded_db.shard_of(user)].get_user(user.username) == user.copy(password=None) # each user is in one shard
+    fresh_db = ShardedUserDatabase(shards, debug=False) # knowing nothing about where emails are
+    assert fresh_db.get_users(['user3@example.com', 'user7', 'nobody']) == [sharded_users[3].copy(password=None), sharded_users[7].copy(password=None), None]
+    assert fresh_db.check_passwords([Credentials('user5@example.com', 'password5'), Credentials('user5', 'wrong'), Credentials('nobody', 'x')]) == [True, False, False]
+
+    # IDs are unique across shards, also among the users of the same batch
+    twins = [User('twin1', {'twin@example.com'}, password='x'), User('twin5', {'twin@example.com'}, password='x')]
+    assert sharded_db.shard_of(twins[0]) != sharded_db.shard_of(twins[1]) # so no shard would notice they share an email
+    errors = sharded_db.add_users([User('someone', {'user4@example.com'}, password='x'), *twins])
+    assert errors == ['User with ID user4@example.com already exists', None, 'User with ID twin@example.com already exists']
+    assert sharded_db.get_user('twin@example.com').username == 'twin1'
+    try:
+        sharded_db.get_user('twin5')
+        assert False, "Rejected users must not be added to any shard"
+    except KeyError:
+        pass
+    impostor = User('user6@example.com', {'impostor@example.com'}, password='x') # a username which is an email of another user
+    assert sharded_db.shard_of(impostor) != sharded_db.shard_of(sharded_users[6]) # so the shard owning that username does not know it
+    assert sharded_db.add_users([impostor]) == ['User with ID user6@example.com already exists']
+    assert sharded_db.get_user('user6@example.com').username == 'user6'
+    sharded_db.close()
+
+    # Users added via a primary server are replicated to replica servers, along with their password hashes
+    from .users.replication import PrimaryUserDatabase, ReplicaUserDatabase, ReplicatedUserDatabase
+    from .example2_rpc_server import ServerStub
+    primary_store, replica_store = (InMemoryUserDatabase(debug=False, hasher=PasswordHasher(iterations=1)) for _ in range(2))
+    primary_db = PrimaryUserDatabase(primary_store, PasswordHasher(iterations=1), max_log_size=4, debug=False)
+    primary_db.add_users([User(f'early{i}', {f'early{i}@example.com'}, password=f'password{i}') for i in range(6)])
+    assert primary_db.log_position() == 6
+    primary_server = ServerStub(0, keep_alive=True, debug=False, user_db=primary_db)
+    primary_address = ('localhost', primary_server.local_address[1])
+    replica_db = ReplicaUserDatabase(replica_store, debug=False)
+    replica_server = ServerStub(0, keep_alive=True, debug=False, user_db=replica_db)
+    replica_db.follow(primary_address) # the log keeps the latest 2 to 4 entries only, so the replica gets a snapshot first
+    replicated_db = ReplicatedUserDatabase.connect(primary_address, [('localhost', replica_server.local_address[1])], debug=False)
+    replicated_db.add_user(User('late', {'late@example.com'}, password='late password'))
+    assert replicated_db.get_user('late@example.com').username == 'late' # read from the replica, once it has caught up
+    assert replica_db.log_position() == primary_db.log_position() == 7
+    assert replicated_db.check_passwords([Credentials('early0', 'password0'), Credentials('late', 'late password')]) == [True, True]
+    primary_hashes = {user.username: user.password for user in primary_store.hashed_users()}
+    assert {user.username: user.password for user in replica_store.hashed_users()} == primary_hashes # hashes are not recomputed
+    assert all(password_hash.startswith('pbkdf2_sha256$') for password_hash in primary_hashes.values()) # type: ignore
+    try:
+        replica_db.add_user(User('rogue', {'rogue@example.com'}, password='x'))
+        assert False, "Replicas must be read-only"
+    except ValueError:
+        pass
+    replicated_db.close()
+    replica_db.close()
+    replica_server.close()
+    primary_server.close()
@@ -1,17 +1,24 @@
 from .users import User, Credentials, Token, Role
-from datetime import datetime
+from snippets.lab3 import STREAM_CHUNK_SIZE
+from datetime import datetime, timedelta
+from enum import Enum, IntEnum
+from typing import Callable
 import json
-from dataclasses import dataclass
+import re
+import struct
+from dataclasses import dataclass, fields, is_dataclass
 
 
 @dataclass
 class Request:
     """
     A container for RPC requests: a name of the function to call and its arguments.
+    The optional ID is chosen by the client to match responses with requests, when many calls share the same connection.
     """
 
     name: str
     args: tuple
+    id: int | None = None
 
     def __post_init__(self):
         self.args = tuple(self.args)
@@ -23,79 +30,149 @@ class Response:
     A container for RPC responses: a result of the function call or an error message.
     When error is None, it means there was no error.
     Result may be None, if the function returns None.
+    The ID is the one of the request this response corresponds to.
+    The optional code tells errors which clients can react to (e.g. by backing off), among `ERROR_CODES`, from the others.
     """
 
     result: object | None
     error: str | None
+    id: int | None = None
+    code: str | None = None
+
+
+def _identity(obj):
+    return obj
+
+
+# Requests start with their name and ID, so that servers can read them without deserializing arguments (see `peek_request`)
+_FIELD_ORDERS: dict[type, tuple[str, ...]] = {Request: ('name', 'id', 'args')}
+
+
+def _fields_of(cls: type) -> tuple[str, ...]:
+    if cls in _FIELD_ORDERS:
+        return _FIELD_ORDERS[cls]
+    if not is_dataclass(cls):
+        raise ValueError(f"Cannot derive a conversion for {cls}, which is neither an enum nor a dataclass")
+    return tuple(field.name for field in fields(cls))
 
 
 class Serializer:
-    primitive_types = (int, float, str, bool, type(None))
-    container_types = (list, set)
+    """
+    Converts objects to ASTs (i.e. dicts, lists, and primitive values), and then to JSON.
+    Conversions are looked up in a table indexed by type, which is filled once (see `register_type`),
+    so converting each node of an object graph costs a single dict lookup.
+    """
+
+    def __init__(self):
+        self.__encoders: dict[type, Callable] = {}
+        for primitive_type in (int, float, str, bool, type(None)):
+            self.__encoders[primitive_type] = _identity
+        for container_type in (list, tuple, set):
+            self.__encoders[container_type] = self._container_to_ast
+        self.__encoders[dict] = self._dict_to_ast
+        self.__encoder = json.JSONEncoder(indent=2)
+        self.register_type(datetime, self._datetime_to_ast)
+        self.register_type(timedelta, self._timedelta_to_ast)
+        for cls in (User, Credentials, Token, Role, Request, Response):
+            self.register_type(cls)
+
+    def register_type(self, cls: type, to_ast: Callable = None, name: str = None):
+        """
+        Makes instances of `cls` serializable, as dicts tagged with `name` (defaults to the name of the class).
+        Unless a custom `to_ast` function is provided, returning a dict,
+        enums are converted by name, and dataclasses field by field.
+        """
+        name = name or cls.__name__
+        if to_ast is None:
+            to_ast = self._enum_to_ast if issubclass(cls, Enum) else self._fields_to_ast(_fields_of(cls))
+        convert = to_ast # bound to a local name, to be captured by the closure below
+
+        def tagged_to_ast(obj):
+            data = convert(obj)
+            data['$type'] = name
+            return data
+
+        self.__encoders[cls] = tagged_to_ast
 
     def serialize(self, obj):
         return self._ast_to_string(self._to_ast(obj))
 
+    def serialize_to(self, obj, write: Callable):
+        """
+        Serializes `obj` by passing its text to `write` in chunks of about `STREAM_CHUNK_SIZE` characters,
+        e.g. the `write` function of `Connection.stream()`, so that the whole JSON string is never materialized.
+        The AST is still built in full, as the standard JSON encoder is fed with it.
+        """
+        pieces: list[str] = []
+        size = 0
+        for piece in self.__encoder.iterencode(self._to_ast(obj)):
+            pieces.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                write(''.join(pieces))
+                pieces.clear()
+                size = 0
+        write(''.join(pieces))
+
     def _ast_to_string(self, data):
-        return json.dumps(data, indent=2)
+        return self.__encoder.encode(data)
 
     def _to_ast(self, obj):
-        if isinstance(obj, self.primitive_types):
-            return obj
-        if isinstance(obj, self.container_types):
-            return [self._to_ast(item) for item in obj]
-        if isinstance(obj, dict):
-            return {key: self._to_ast(value) for key, value in obj.items()}
-        # selects the appropriate method to convert the object to AST via reflection
-        method_name = f'_{type(obj).__name__.lower()}_to_ast'
-        if hasattr(self, method_name):
-            data = getattr(self, method_name)(obj)
-            data['$type'] = type(obj).__name__
-            return data
-        raise ValueError(f"Unsupported type {type(obj)}")
-
-    def _user_to_ast(self, user: User):
-        return {
-            'username': self._to_ast(user.username),
-            'emails': [self._to_ast(email) for email in user.emails],
-            'full_name': self._to_ast(user.full_name),
-            'role': self._to_ast(user.role),
-            'password': self._to_ast(user.password),
-        }
+        encoder = self.__encoders.get(type(obj)) or self.__resolve_encoder(type(obj))
+        return encoder(obj)
 
-    def _credentials_to_ast(self, credentials: Credentials):
-        return {
-            'id': self._to_ast(credentials.id),
-            'password': self._to_ast(credentials.password),
-        }
+    def __resolve_encoder(self, cls: type) -> Callable:
+        # subclasses of registered types are converted as their closest registered ancestor, which is remembered
+        for ancestor in cls.__mro__[1:]:
+            if ancestor in self.__encoders:
+                self.__encoders[cls] = self.__encoders[ancestor]
+                return self.__encoders[cls]
+        raise ValueError(f"Unsupported type {cls}")
 
-    def _token_to_ast(self, token: Token):
-        return {
-            'signature': self._to_ast(token.signature),
-            'user': self._to_ast(token.user),
-            'expiration': self._to_ast(token.expiration),
-        }
+    def _container_to_ast(self, items):
+        return [self._to_ast(item) for item in items]
 
-    def _datetime_to_ast(self, dt: datetime):
-        raise NotImplementedError("Missing implementation for datetime serialization")
+    def _dict_to_ast(self, data: dict):
+        return {key: self._to_ast(value) for key, value in data.items()}
 
-    def _role_to_ast(self, role: Role):
-        return {'name': role.name}
+    def _fields_to_ast(self, names: tuple[str, ...]) -> Callable:
+        def to_ast(obj):
+            return {name: self._to_ast(getattr(obj, name)) for name in names}
+        return to_ast
 
-    def _request_to_ast(self, request: Request):
-        return {
-            'name': self._to_ast(request.name),
-            'args': [self._to_ast(arg) for arg in request.args],
-        }
+    def _enum_to_ast(self, value: Enum):
+        return {'name': value.name}
 
-    def _response_to_ast(self, response: Response):
-        return {
-            'result': self._to_ast(response.result) if response.result is not None else None,
-            'error': self._to_ast(response.error),
-        }
+    def _datetime_to_ast(self, dt: datetime):
+        return {'iso': dt.isoformat()} # time zone included, if any
+
+    def _timedelta_to_ast(self, delta: timedelta):
+        return {'seconds': delta.total_seconds()}
 
 
 class Deserializer:
+    """
+    Parses JSON into ASTs, and then converts ASTs to objects.
+    Dicts tagged with a '$type' are converted by the function registered for that type name (see `register_type`).
+    """
+
+    def __init__(self):
+        self.__decoders: dict[str, Callable] = {}
+        self.register_type(datetime, self._ast_to_datetime)
+        self.register_type(timedelta, self._ast_to_timedelta)
+        for cls in (User, Credentials, Token, Role, Request, Response):
+            self.register_type(cls)
+
+    def register_type(self, cls: type, from_ast: Callable = None, name: str = None):
+        """
+        Makes dicts tagged with `name` (defaults to the name of `cls`) deserializable as instances of `cls`.
+        Unless a custom `from_ast` function is provided, accepting a dict,
+        enums are converted by name, and dataclasses field by field (missing fields get their default values).
+        """
+        if from_ast is None:
+            from_ast = self._ast_to_enum(cls) if issubclass(cls, Enum) else self._ast_to_fields(cls, _fields_of(cls))
+        self.__decoders[name or cls.__name__] = from_ast
+
     def deserialize(self, string):
         return self._ast_to_obj(self._string_to_ast(string))
 
@@ -106,66 +183,469 @@ class Deserializer:
         if isinstance(data, dict):
             if '$type' not in data:
                 return {key: self._ast_to_obj(value) for key, value in data.items()}
-            # selects the appropriate method to convert the AST to object via reflection
-            method_name = f'_ast_to_{data["$type"].lower()}'
-            if hasattr(self, method_name):
-                return getattr(self, method_name)(data)
-            raise ValueError(f"Unsupported type {data['type']}")
+            decoder = self.__decoders.get(data['$type'])
+            if decoder is None:
+                raise ValueError(f"Unsupported type {data['$type']}")
+            return decoder(data)
         if isinstance(data, list):
             return [self._ast_to_obj(item) for item in data]
         return data
 
-    def _ast_to_user(self, data):
-        return User(
-            username=self._ast_to_obj(data['username']),
-            emails=set(self._ast_to_obj(data['emails'])),
-            full_name=self._ast_to_obj(data['full_name']),
-            role=self._ast_to_obj(data['role']),
-            password=self._ast_to_obj(data['password']),
-        )
-
-    def _ast_to_credentials(self, data):
-        return Credentials(
-            id=self._ast_to_obj(data['id']),
-            password=self._ast_to_obj(data['password']),
-        )
-
-    def _ast_to_token(self, data):
-        return Token(
-            signature=self._ast_to_obj(data['signature']),
-            user=self._ast_to_obj(data['user']),
-            expiration=self._ast_to_obj(data['expiration']),
-        )
+    def _ast_to_fields(self, cls: type, names: tuple[str, ...]) -> Callable:
+        def from_ast(data):
+            return cls(**{name: self._ast_to_obj(data[name]) for name in names if name in data})
+        return from_ast
+
+    def _ast_to_enum(self, cls: type) -> Callable:
+        def from_ast(data):
+            return cls[data['name']] # type: ignore
+        return from_ast
 
     def _ast_to_datetime(self, data):
-        raise NotImplementedError("Missing implementation for datetime deserialization")
+        return datetime.fromisoformat(data['iso'])
+
+    def _ast_to_timedelta(self, data):
+        return timedelta(seconds=data['seconds'])
+
+
+# Binary format: a magic byte, followed by one encoded value.
+# Each value is a 1-byte type code, possibly followed by a payload:
+# - ints are zigzag varints, floats are 8-byte IEEE 754 doubles
+# - strings are a varint length followed by UTF-8 bytes; datetimes are strings in ISO format
+# - lists, sets, and dicts are a varint count of items (or key-value pairs) followed by the items
+# - objects of known classes are their fields, in a fixed order, with no field names
+# - objects of other registered classes are tagged with their type name, followed by their fields
+# - objects with custom conversions (e.g. timedeltas) are the dicts produced by their conversion, tagged with a '$type' key
+BINARY_MAGIC = b'\xb1' # never the first byte of a UTF-8 text, hence of a JSON document
+
+
+class TypeCode(IntEnum):
+    NONE = 0
+    FALSE = 1
+    TRUE = 2
+    INT = 3
+    FLOAT = 4
+    STR = 5
+    LIST = 6
+    SET = 7
+    DICT = 8
+    OBJECT = 15
+    USER = 16
+    CREDENTIALS = 17
+    TOKEN = 18
+    ROLE = 19
+    REQUEST = 20
+    RESPONSE = 21
+    DATETIME = 22
+
+
+_BUILTIN_CODES = {
+    User: TypeCode.USER,
+    Credentials: TypeCode.CREDENTIALS,
+    Token: TypeCode.TOKEN,
+    Role: TypeCode.ROLE,
+    Request: TypeCode.REQUEST,
+    Response: TypeCode.RESPONSE,
+}
+
+_DOUBLE = struct.Struct('>d')
+
+
+def _write_varint(value: int, buffer: bytearray):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _write_str(value: str, buffer: bytearray):
+    data = value.encode()
+    _write_varint(len(data), buffer)
+    buffer += data
+
+
+class _StreamBuffer(bytearray):
+    """
+    A buffer which is periodically flushed to a `write` function, while an object is being written into it.
+    """
+
+    def __init__(self, write: Callable):
+        super().__init__()
+        self.write = write
+
+    def flush(self):
+        if self:
+            self.write(bytes(self))
+            self.clear()
 
-    def _ast_to_role(self, data):
-        return Role[self._ast_to_obj(data['name'])]
 
-    def _ast_to_request(self, data):
-        return Request(
-            name=self._ast_to_obj(data['name']),
-            args=tuple(self._ast_to_obj(arg) for arg in data['args']),
-        )
+def _read_varint(data: memoryview, position: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
 
-    def _ast_to_response(self, data):
-        return Response(
-            result=self._ast_to_obj(data['result']) if data['result'] is not None else None,
-            error=self._ast_to_obj(data['error']),
-        )
+
+def _zigzag_decode(value: int) -> int:
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def _read_str(data: memoryview, position: int) -> tuple[str, int]:
+    length, position = _read_varint(data, position)
+    return str(data[position:position + length], 'utf-8'), position + length
+
+
+class BinarySerializer(Serializer):
+    """
+    Writes objects straight into a byte buffer, without any intermediate AST.
+    Writers are looked up in a table indexed by type, just like AST conversions in `Serializer`.
+    """
+
+    def __init__(self):
+        self.__writers: dict[type, Callable[[object, bytearray], None]] = {
+            type(None): self._write_none,
+            bool: self._write_bool,
+            int: self._write_int,
+            float: self._write_float,
+            str: self._write_str,
+            list: self._write_list,
+            tuple: self._write_list,
+            set: self._write_set,
+            dict: self._write_dict,
+            datetime: self._write_datetime,
+        }
+        super().__init__()
+
+    def register_type(self, cls: type, to_ast: Callable = None, name: str = None):
+        super().register_type(cls, to_ast, name)
+        if cls is datetime:
+            return # datetimes have their own type code, regardless of how they are converted to ASTs
+        if issubclass(cls, Enum):
+            self.__writers[cls] = self._enum_writer(cls)
+        elif to_ast is not None: # custom conversions are written as the tagged AST they produce
+            self.__writers[cls] = self._ast_writer(to_ast, name or cls.__name__)
+        else:
+            self.__writers[cls] = self._fields_writer(cls, _fields_of(cls), name or cls.__name__)
+
+    def serialize(self, obj) -> bytes:
+        buffer = bytearray(BINARY_MAGIC)
+        self._write(obj, buffer)
+        return bytes(buffer)
+
+    def serialize_to(self, obj, write: Callable):
+        """
+        Serializes `obj` by passing its bytes to `write` in chunks of about `STREAM_CHUNK_SIZE` bytes:
+        the buffer is flushed in between the items of containers, so that neither an AST nor the whole message is materialized.
+        """
+        buffer = _StreamBuffer(write)
+        buffer += BINARY_MAGIC
+        self._write(obj, buffer)
+        buffer.flush()
+
+    def _write(self, obj, buffer: bytearray):
+        writer = self.__writers.get(type(obj)) or self.__resolve_writer(type(obj))
+        writer(obj, buffer)
+
+    def __resolve_writer(self, cls: type) -> Callable:
+        for ancestor in cls.__mro__[1:]:
+            if ancestor in self.__writers:
+                self.__writers[cls] = self.__writers[ancestor]
+                return self.__writers[cls]
+        raise ValueError(f"Unsupported type {cls}")
+
+    def _write_none(self, obj: None, buffer: bytearray):
+        buffer.append(TypeCode.NONE)
+
+    def _write_bool(self, obj: bool, buffer: bytearray):
+        buffer.append(TypeCode.TRUE if obj else TypeCode.FALSE)
+
+    def _write_int(self, obj: int, buffer: bytearray):
+        buffer.append(TypeCode.INT)
+        _write_varint(obj << 1 if obj >= 0 else (-obj << 1) - 1, buffer) # zigzag: small negatives stay small
+
+    def _write_float(self, obj: float, buffer: bytearray):
+        buffer.append(TypeCode.FLOAT)
+        buffer += _DOUBLE.pack(obj)
+
+    def _write_str(self, obj: str, buffer: bytearray):
+        buffer.append(TypeCode.STR)
+        _write_str(obj, buffer)
+
+    def _write_items(self, code: TypeCode, items, buffer: bytearray):
+        buffer.append(code)
+        _write_varint(len(items), buffer)
+        for item in items:
+            self._write(item, buffer)
+            if len(buffer) >= STREAM_CHUNK_SIZE and isinstance(buffer, _StreamBuffer):
+                buffer.flush()
+
+    def _write_list(self, obj, buffer: bytearray):
+        self._write_items(TypeCode.LIST, obj, buffer)
+
+    def _write_set(self, obj: set, buffer: bytearray):
+        self._write_items(TypeCode.SET, obj, buffer)
+
+    def _write_dict(self, obj: dict, buffer: bytearray):
+        buffer.append(TypeCode.DICT)
+        _write_varint(len(obj), buffer)
+        for key, value in obj.items():
+            self._write(key, buffer)
+            self._write(value, buffer)
+            if len(buffer) >= STREAM_CHUNK_SIZE and isinstance(buffer, _StreamBuffer):
+                buffer.flush()
+
+    def _write_datetime(self, obj: datetime, buffer: bytearray):
+        buffer.append(TypeCode.DATETIME)
+        _write_str(obj.isoformat(), buffer)
+
+    def _write_header(self, cls: type, name: str, buffer: bytearray):
+        if cls in _BUILTIN_CODES:
+            buffer.append(_BUILTIN_CODES[cls])
+        else:
+            buffer.append(TypeCode.OBJECT)
+            _write_str(name, buffer)
+
+    def _enum_writer(self, cls: type) -> Callable:
+        def write(obj, buffer: bytearray):
+            self._write_header(cls, cls.__name__, buffer)
+            _write_str(obj.name, buffer)
+        return write
+
+    def _fields_writer(self, cls: type, names: tuple[str, ...], name: str) -> Callable:
+        def write(obj, buffer: bytearray):
+            self._write_header(cls, name, buffer)
+            for field_name in names:
+                self._write(getattr(obj, field_name), buffer)
+        return write
+
+    def _ast_writer(self, to_ast: Callable, name: str) -> Callable:
+        def write(obj, buffer: bytearray):
+            data = to_ast(obj)
+            data['$type'] = name
+            self._write_dict(data, buffer)
+        return write
+
+
+class BinaryDeserializer(Deserializer):
+    """
+    Reads values from a memoryview, without any intermediate AST.
+    Each reader returns the value read, and the position right after it.
+    Readers are looked up in a table indexed by type code (or by type name, for objects of other registered classes).
+    """
+
+    def __init__(self):
+        self.__readers: list[Callable | None] = [None] * 256
+        self.__object_readers: dict[str, Callable] = {}
+        for code, reader in {
+            TypeCode.NONE: self._read_none,
+            TypeCode.FALSE: self._read_false,
+            TypeCode.TRUE: self._read_true,
+            TypeCode.INT: self._read_int,
+            TypeCode.FLOAT: self._read_float,
+            TypeCode.STR: _read_str,
+            TypeCode.LIST: self._read_list,
+            TypeCode.SET: self._read_set,
+            TypeCode.DICT: self._read_dict,
+            TypeCode.OBJECT: self._read_object,
+            TypeCode.DATETIME: self._read_datetime,
+        }.items():
+            self.__readers[code] = reader
+        super().__init__()
+
+    def register_type(self, cls: type, from_ast: Callable = None, name: str = None):
+        super().register_type(cls, from_ast, name)
+        if issubclass(cls, Enum):
+            reader = self._enum_reader(cls)
+        elif from_ast is not None: # custom conversions are written as tagged ASTs, which are read as dicts
+            return
+        else:
+            reader = self._fields_reader(cls, _fields_of(cls))
+        if cls in _BUILTIN_CODES:
+            self.__readers[_BUILTIN_CODES[cls]] = reader
+        else:
+            self.__object_readers[name or cls.__name__] = reader
+
+    def deserialize(self, data: bytes):
+        if data[:1] != BINARY_MAGIC:
+            raise ValueError("Not a binary message")
+        obj, position = self._read(memoryview(data), 1)
+        if position != len(data):
+            raise ValueError(f"Unexpected {len(data) - position} trailing bytes")
+        return obj
+
+    def _read(self, data: memoryview, position: int) -> tuple[object, int]:
+        reader = self.__readers[data[position]]
+        if reader is None:
+            raise ValueError(f"Unsupported type code {data[position]}")
+        return reader(data, position + 1)
+
+    def _read_none(self, data: memoryview, position: int):
+        return None, position
+
+    def _read_false(self, data: memoryview, position: int):
+        return False, position
+
+    def _read_true(self, data: memoryview, position: int):
+        return True, position
+
+    def _read_int(self, data: memoryview, position: int):
+        value, position = _read_varint(data, position)
+        return _zigzag_decode(value), position
+
+    def _read_float(self, data: memoryview, position: int):
+        return _DOUBLE.unpack_from(data, position)[0], position + _DOUBLE.size
+
+    def _read_many(self, data: memoryview, position: int, count: int) -> tuple[list, int]:
+        items = []
+        for _ in range(count):
+            item, position = self._read(data, position)
+            items.append(item)
+        return items, position
+
+    def _read_list(self, data: memoryview, position: int):
+        count, position = _read_varint(data, position)
+        return self._read_many(data, position, count)
+
+    def _read_set(self, data: memoryview, position: int):
+        items, position = self._read_list(data, position)
+        return set(items), position
+
+    def _read_dict(self, data: memoryview, position: int):
+        count, position = _read_varint(data, position)
+        items, position = self._read_many(data, position, 2 * count)
+        result = dict(zip(items[::2], items[1::2]))
+        if '$type' in result: # an object converted by a custom function, which expects an AST
+            return self._ast_to_obj(result), position
+        return result, position
+
+    def _read_object(self, data: memoryview, position: int):
+        name, position = _read_str(data, position)
+        if name not in self.__object_readers:
+            raise ValueError(f"Unsupported type {name}")
+        return self.__object_readers[name](data, position)
+
+    def _read_datetime(self, data: memoryview, position: int):
+        text, position = _read_str(data, position)
+        return datetime.fromisoformat(text), position
+
+    def _enum_reader(self, cls: type) -> Callable:
+        def read(data: memoryview, position: int):
+            name, position = _read_str(data, position)
+            return cls[name], position # type: ignore
+        return read
+
+    def _fields_reader(self, cls: type, names: tuple[str, ...]) -> Callable:
+        positional = names == tuple(field.name for field in fields(cls)) # i.e. fields are written in declaration order
+
+        def read(data: memoryview, position: int):
+            values, position = self._read_many(data, position, len(names))
+            return (cls(*values) if positional else cls(**dict(zip(names, values)))), position
+        return read
+
+
+@dataclass(frozen=True)
+class Codec:
+    """
+    A named pair of serializer and deserializer, to be agreed upon by clients and servers.
+    """
+
+    name: str
+    serializer: Serializer
+    deserializer: Deserializer
 
 
 DEFAULT_SERIALIZER = Serializer()
 DEFAULT_DESERIALIZER = Deserializer()
 
+CODECS: dict[str, Codec] = {
+    'json': Codec('json', DEFAULT_SERIALIZER, DEFAULT_DESERIALIZER),
+    'binary': Codec('binary', BinarySerializer(), BinaryDeserializer()),
+}
+
 
-def serialize(obj):
-    return DEFAULT_SERIALIZER.serialize(obj)
+# Name of the request by which clients ask servers for the codecs they support (sent in JSON, which all servers support)
+NEGOTIATE_CODECS = '$codecs'
 
+# Name of the request by which clients subscribe to invalidation notices, and of the notices themselves:
+# these are requests pushed by servers to subscribed connections, carrying the IDs of the users which changed
+SUBSCRIBE_INVALIDATIONS = '$subscribe'
+INVALIDATE = '$invalidate'
 
-def deserialize(string):
-    return DEFAULT_DESERIALIZER.deserialize(string)
+# Name of the request by which replicas ask a primary for its change log from some position on, and of the entries themselves:
+# these are requests pushed by the primary to the replica connection, carrying a position and the users added from there on
+# (with their password hashes), or else users of a snapshot of the primary as of that position (see `PrimaryUserDatabase.stream`)
+REPLICATE = '$replicate'
+APPLY = '$apply'
+
+
+# Codes of errors which are due to the load of the server, rather than to the request: clients may retry such requests later
+OVERLOADED = 'overloaded'
+RATE_LIMITED = 'rate_limited'
+ERROR_CODES = (OVERLOADED, RATE_LIMITED)
+
+_JSON_REQUEST_HEADER = re.compile(rb'\s*\{\s*"name":\s*("(?:[^"\\]|\\.)*"),\s*"id":\s*(null|-?\d+)')
+_PEEK_SIZE = 1024
+
+
+def peek_request(message) -> tuple[str, int | None] | None:
+    """
+    Reads the name and the ID of a serialized request, without deserializing its arguments (which come after them),
+    e.g. to reject a request as cheaply as possible. Returns None if `message` does not start like a request.
+    """
+    if isinstance(message, str):
+        message = message[:_PEEK_SIZE].encode()
+    if message[:1] == BINARY_MAGIC:
+        data = memoryview(message)
+        try:
+            if data[1] != TypeCode.REQUEST or data[2] != TypeCode.STR:
+                return None
+            name, position = _read_str(data, 3)
+            if data[position] == TypeCode.NONE:
+                return name, None
+            if data[position] == TypeCode.INT:
+                return name, _zigzag_decode(_read_varint(data, position + 1)[0])
+        except (IndexError, UnicodeDecodeError):
+            pass # truncated or corrupted
+        return None
+    match = _JSON_REQUEST_HEADER.match(message[:_PEEK_SIZE])
+    if match is None:
+        return None
+    name_literal, id_literal = match.groups()
+    return json.loads(name_literal), None if id_literal == b'null' else int(id_literal)
+
+
+def codec_of(message) -> Codec:
+    """
+    Tells which codec was used to produce a serialized message, by looking at its first byte.
+    """
+    if isinstance(message, (bytes, bytearray)) and message[:1] == BINARY_MAGIC:
+        return CODECS['binary']
+    return CODECS['json']
+
+
+def register_type(cls: type, to_ast: Callable = None, from_ast: Callable = None, name: str = None):
+    """
+    Makes instances of `cls` serializable and deserializable with every codec (see `Serializer.register_type`).
+    """
+    for codec in CODECS.values():
+        codec.serializer.register_type(cls, to_ast, name)
+        codec.deserializer.register_type(cls, from_ast, name)
+
+
+def serialize(obj, codec: str = 'json'):
+    return CODECS[codec].serializer.serialize(obj)
+
+
+def serialize_to(obj, write: Callable, codec: str = 'json'):
+    CODECS[codec].serializer.serialize_to(obj, write)
+
+
+def deserialize(message):
+    return codec_of(message).deserializer.deserialize(message)
 
 
 if __name__ == '__main__':
@@ -179,10 +659,50 @@ if __name__ == '__main__':
             ["a string", 42, 3.14, True, False], # a list, containing various primitive types
             {'key': 'value'}, # a dictionary
             Response(None, 'an error'), # a Response, which contains a None field
-        )
+        ),
+        id=1,
     )
     serialized = serialize(request)
     print("Serialized", "=", serialized)
     deserialized = deserialize(serialized)
     print("Deserialized", "=", deserialized)
     assert request == deserialized
+
+    serialized_binary = serialize(request, 'binary')
+    print("Serialized (binary)", "=", serialized_binary)
+    print("Size (binary vs JSON)", "=", len(serialized_binary), "vs", len(serialized.encode()), "bytes")
+    assert request == deserialize(serialized_binary)
+
+    # Tokens (hence, datetimes) and timedeltas can be serialized with every codec
+    from datetime import timezone
+    token = Token(gc_user.copy(password=None), datetime(2024, 1, 1, 12, 30, tzinfo=timezone.utc), 'signature')
+    for codec in CODECS:
+        assert deserialize(serialize(Request('validate_token', (token,)), codec)) == Request('validate_token', (token,))
+        assert deserialize(serialize(timedelta(hours=1, milliseconds=5), codec)) == timedelta(hours=1, milliseconds=5)
+
+    # The name and the ID of requests can be read without deserializing them
+    for codec in CODECS:
+        assert peek_request(serialize(request, codec)) == ('my_function', 1)
+        assert peek_request(serialize(Request('check_password', (gc_credentials_wrong,), -300), codec)) == ('check_password', -300)
+        assert peek_request(serialize(Request('"quoted\\ñame"', ()), codec)) == ('"quoted\\ñame"', None)
+        assert peek_request(serialize(Response(None, 'not a request'), codec)) is None
+    assert peek_request(b'{"id": 1, "name": "foreign client"}') is None
+
+    # Further dataclasses can be made serializable by registering them
+    @dataclass
+    class Point:
+        x: float
+        y: float
+
+    register_type(Point)
+    for codec in CODECS:
+        assert deserialize(serialize(Request('move', (Point(1.0, -2.5),)), codec)) == Request('move', (Point(1.0, -2.5),))
+
+    # Large objects can be streamed in chunks, with the same outcome of serializing them at once
+    users = [gc_user.copy(username=f'user{i}', emails={f'user{i}@example.com'}) for i in range(10_000)]
+    for codec in CODECS:
+        chunks: list = []
+        serialize_to(users, chunks.append, codec)
+        assert len(chunks) > 1
+        streamed = ''.join(chunks) if codec == 'json' else b''.join(chunks)
+        assert streamed == serialize(users, codec)
@@ -1,58 +1,499 @@
-from snippets.lab3 import Server
-from snippets.lab4.users.impl import InMemoryUserDatabase
-from snippets.lab4.example1_presentation import serialize, deserialize, Request, Response
+from snippets.lab3 import Connection, Server, address
+from snippets.lab4.users import UserDatabase, AuthenticationService
+from snippets.lab4.users.impl import InMemoryUserDatabase, InMemoryAuthenticationService, _Debuggable
+from snippets.lab4.users.hashing import PasswordHasher
+from snippets.lab4.users.compact import CompactUserDatabase
+from snippets.lab4.users.persistent import PersistentUserDatabase
+from snippets.lab4.users.sqlite import SqliteUserDatabase
+from snippets.lab4.users.replication import PrimaryUserDatabase, ReplicaUserDatabase
+from snippets.lab4.users.sharding import ShardedUserDatabase
+from snippets.lab4.example1_presentation import Codec, Request, Response, CODECS, NEGOTIATE_CODECS, SUBSCRIBE_INVALIDATIONS, INVALIDATE, REPLICATE, APPLY, OVERLOADED, RATE_LIMITED, codec_of, peek_request
+import os
+import queue
+import threading
+import time
 import traceback
 
 
-class ServerStub(Server):
-    def __init__(self, port):
-        super().__init__(port, self.__on_connection_event)
-        self.__user_db = InMemoryUserDatabase()
+def _send_response(response: Response, connection: Connection, codec: Codec):
+    # the response is streamed straight into the socket, so that large results are never materialized as a whole message
+    with connection.stream() as write:
+        codec.serializer.serialize_to(response, write)
+
+
+class _ResponseWriter:
+    """
+    Sends responses over a connection from a dedicated thread, so that whoever produces them does not wait for them to be flushed.
+    """
+
+    __STOP = object()
+
+    def __init__(self, connection: Connection):
+        self.__connection = connection
+        self.__outbox: queue.Queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__send_outgoing_messages, daemon=True)
+        self.__thread.start()
+
+    def send(self, response: Response, codec: Codec):
+        self.__outbox.put((response, codec))
+
+    def close(self):
+        self.__outbox.put(self.__STOP)
+
+    def __send_outgoing_messages(self):
+        while (message := self.__outbox.get()) is not self.__STOP:
+            response, codec = message
+            try:
+                _send_response(response, self.__connection, codec)
+            except OSError as e:
+                if not self.__connection.closed:
+                    traceback.print_exception(e)
+                return
+
+
+class WorkerPool:
+    """
+    A fixed number of worker threads, consuming tasks from a bounded queue.
+    When the queue is full, `submit` either blocks until there is room (`block=True`) or raises `queue.Full`.
+    """
+
+    __STOP = object()
+
+    def __init__(self, workers: int, queue_size: int = 0):
+        if workers < 1:
+            raise ValueError("The number of workers must be positive")
+        self.__tasks: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.__threads = [threading.Thread(target=self.__run_tasks, daemon=True) for _ in range(workers)]
+        for thread in self.__threads:
+            thread.start()
+
+    @property
+    def queued(self) -> int:
+        return self.__tasks.qsize()
+
+    def submit(self, task, block: bool = True):
+        self.__tasks.put(task, block)
+
+    def __run_tasks(self):
+        while (task := self.__tasks.get()) is not self.__STOP:
+            try:
+                task()
+            except Exception as e:
+                traceback.print_exception(e)
+
+    def shutdown(self):
+        for _ in self.__threads:
+            self.__tasks.put(self.__STOP)
+
+
+class TokenBucket:
+    """
+    Admits `rate` events per second on average, and bursts of at most `burst` events:
+    each event takes a token from the bucket, which holds at most `burst` tokens, and is refilled at `rate` tokens per second.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0 or burst < 1:
+            raise ValueError("Rate must be positive, and burst must be at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = burst
+        self.__last = time.monotonic()
+
+    def __refill(self, now: float):
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    @property
+    def full(self) -> bool:
+        self.__refill(time.monotonic())
+        return self.__tokens >= self.burst
+
+    def delay(self) -> float:
+        """
+        Returns 0 if there is a token, or else how many seconds to wait for the next one (taking nothing either way).
+        """
+        self.__refill(time.monotonic())
+        return max(0.0, (1 - self.__tokens) / self.rate)
+
+    def take(self) -> float:
+        """
+        Takes a token, returning 0 if there was one, or else how many seconds to wait for the next one (and takes nothing).
+        """
+        if (delay := self.delay()) == 0:
+            self.__tokens -= 1
+        return delay
+
+
+class RateLimiter:
+    """
+    Rate limits requests by remote address and method: the `limits` dict maps method names to pairs (rate, burst)
+    (see `TokenBucket`), where the '*' key stands for all methods together.
+    Each address gets its own bucket for '*', and one per limited method, so that a request takes a token from both:
+    tokens are only taken if both buckets have one, so that a request rejected by one limit does not consume the other.
+    Protocol requests (whose names start with '$', e.g. '$codecs') are never limited, as they are not calls of the API.
+    Buckets of idle addresses are discarded from time to time, as they are full anyway.
+    """
+
+    __PRUNE_EVERY = 1024 # new buckets
+
+    def __init__(self, limits: dict[str, tuple[float, float]]):
+        self.limits = dict(limits)
+        self.__buckets: dict[tuple[str, str], TokenBucket] = {}
+        self.__created = 0
+        self.__lock = threading.Lock()
+
+    def __bucket(self, host: str, method: str) -> TokenBucket:
+        # the caller is expected to hold the lock
+        bucket = self.__buckets.get((host, method))
+        if bucket is None:
+            self.__created += 1
+            if self.__created % self.__PRUNE_EVERY == 0:
+                self.__buckets = {key: bucket for key, bucket in self.__buckets.items() if not bucket.full}
+            bucket = self.__buckets[host, method] = TokenBucket(*self.limits[method])
+        return bucket
+
+    def admit(self, host: str, method: str | None) -> float:
+        """
+        Returns 0 if a request for `method` (None if unknown) from `host` is admitted,
+        or else how many seconds the client should wait before retrying.
+        """
+        if method is not None and method.startswith('$'):
+            return 0.0
+        keys = [key for key in ('*', method) if key in self.limits]
+        with self.__lock:
+            buckets = [self.__bucket(host, key) for key in keys]
+            if (delay := max((bucket.delay() for bucket in buckets), default=0.0)) > 0:
+                return delay
+            for bucket in buckets:
+                bucket.take()
+        return 0.0
+
+
+def parse_rate_limit(text: str) -> tuple[str, tuple[float, float]]:
+    """
+    Parses a rate limit of the form '[METHOD=]RATE[:BURST]', where the method defaults to '*', and the burst to the rate.
+    """
+    method, _, limit = text.rpartition('=')
+    rate, _, burst = limit.partition(':')
+    return method or '*', (float(rate), float(burst or max(1.0, float(rate))))
+
+
+USER_DB_STORES = ('memory', 'compact', 'persistent', 'sqlite', 'sharded')
+LOCAL_USER_DB_STORES = USER_DB_STORES[:-1] # the ones which need no other servers
+
+
+def make_user_db(store: str = 'memory', debug: bool = True, path: str = 'users-data', hasher: PasswordHasher = None,
+                 shards: list[tuple[str, int]] = None) -> UserDatabase:
+    """
+    Creates a user database of the given kind of `store`, among `USER_DB_STORES`.
+    Stores which are persistent keep their data in `path`.
+    Local stores hash passwords via the given `hasher` (by default, a `PasswordHasher` without workers).
+    The sharded store spreads users among the servers at the `shards` addresses (see `ShardedUserDatabase`).
+    """
+    match store:
+        case 'memory':
+            return InMemoryUserDatabase(debug, hasher)
+        case 'compact':
+            return CompactUserDatabase(debug, hasher)
+        case 'persistent':
+            return PersistentUserDatabase(path, debug=debug, hasher=hasher)
+        case 'sqlite':
+            os.makedirs(path, exist_ok=True)
+            return SqliteUserDatabase(os.path.join(path, 'users.sqlite3'), debug, hasher)
+        case 'sharded':
+            if not shards:
+                raise ValueError("The sharded store requires the addresses of its shards")
+            return ShardedUserDatabase.connect(shards, debug=debug)
+    raise ValueError(f"Unknown store {store!r}, expected one of {USER_DB_STORES}")
+
+
+class ServerStub(Server, _Debuggable):
+    """
+    Server-side stub for RPC. By default, each connection serves exactly one request, and it is closed right after the response.
+    When `keep_alive` is True, connections are kept open to serve many requests, until clients close them.
+    When `pipelined` is True (which implies `keep_alive`), responses are flushed by a per-connection writer thread,
+    so that the next request on the same connection is read and processed while the previous response is being sent.
+
+    When `workers` is positive, requests are not served by the receiver thread of their connection,
+    but by a `WorkerPool` of that many threads, fed by a queue of at most `queue_size` requests (0 means unbounded).
+    When the queue is full, the `overload_policy` decides what to do with further requests:
+    - 'block' stops reading from the connection until there is room, so that TCP flow control slows the client down
+    - 'reject' immediately responds with an error, so that the client can back off and retry later
+    The amount of connections served at once (hence, of receiver threads) can be bounded via `max_connections`.
+    Requests can also be rate limited, by remote address and method, via the `rate_limits` of a `RateLimiter`:
+    requests beyond the limits are rejected as soon as they are received, only reading their name and ID.
+    Rejections carry an error code ('overloaded' or 'rate_limited'), so that clients can tell they may retry later.
+
+    Requests may be encoded with any of the supported `codecs`, which clients can discover via a '$codecs' request:
+    the codec of each request is recognised from its first byte, and the response is encoded with the same codec.
+
+    Clients may subscribe a connection to invalidation notices via a '$subscribe' request: that connection is then kept open,
+    and whenever a request changes some users, an '$invalidate' request carrying their IDs is pushed over it,
+    so that clients can keep caches of users consistent (see `ClientStub.subscribe`).
+
+    When the `user_db` is a `PrimaryUserDatabase`, replicas may follow its change log via a '$replicate' request:
+    that connection is then kept open, and a dedicated thread pushes '$apply' requests carrying the log entries over it
+    (see `ReplicaUserDatabase.follow`).
+
+    Requests for `USER_DB_METHODS` are served by the given `user_db` (an `InMemoryUserDatabase`, by default),
+    while the ones for `AUTHENTICATION_METHODS` are served by the given `auth_service`
+    (by default, an `InMemoryAuthenticationService` of the `user_db`, with a random secret).
+    Requests for any other method are answered with an error, so that no other attribute of those objects
+    (e.g. `ReplicaUserDatabase.apply`, or `close`) can be reached remotely.
+    Logs are printed unless `debug` is False, while counters about served and rejected requests are available via `stats`.
+    When `reuse_port` is True, many servers (e.g. in distinct processes) may listen on the same port (see `PreforkServer`).
+    """
+
+    OVERLOAD_POLICIES = ('block', 'reject')
+    USER_DB_METHODS = ('add_user', 'get_user', 'check_password', 'add_users', 'get_users', 'check_passwords', 'log_position')
+    AUTHENTICATION_METHODS = ('authenticate', 'validate_token', 'revoke_token')
+
+    def __init__(self, port, keep_alive: bool = False, pipelined: bool = False,
+                 workers: int = 0, queue_size: int = 0, overload_policy: str = 'block', max_connections: int = None,
+                 codecs: tuple[str, ...] = tuple(CODECS), debug: bool = True, user_db: UserDatabase = None,
+                 reuse_port: bool = False, auth_service: AuthenticationService = None, rate_limits: dict[str, tuple[float, float]] = None):
+        if overload_policy not in self.OVERLOAD_POLICIES:
+            raise ValueError(f"Invalid overload policy {overload_policy!r}, expected one of {self.OVERLOAD_POLICIES}")
+        if 'json' not in codecs:
+            raise ValueError("JSON must be among the supported codecs, as codec negotiation relies on it")
+        self.__codecs = tuple(codec for codec in CODECS if codec in codecs)
+        self.__keep_alive = keep_alive or pipelined
+        self.__pipelined = pipelined
+        self.__writers: dict[Connection, _ResponseWriter] = {}
+        self.__workers = WorkerPool(workers, queue_size) if workers > 0 else None
+        self.__overload_policy = overload_policy
+        self.__user_db = user_db if user_db is not None else InMemoryUserDatabase(debug)
+        self.__auth_service = auth_service if auth_service is not None else InMemoryAuthenticationService(self.__user_db, debug=debug)
+        self.__subscribers: dict[Connection, Codec] = {}
+        self.__subscribers_lock = threading.Lock()
+        self.__followers: set[Connection] = set()
+        self.__rate_limiter = RateLimiter(rate_limits) if rate_limits else None
+        self.__stats = dict(served=0, rejected_requests=0, rate_limited_requests=0, rejected_connections=0)
+        self.__stats_lock = threading.Lock()
+        _Debuggable.__init__(self, debug)
+        Server.__init__(self, port, self.__on_connection_event, max_connections, reuse_port=reuse_port)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Amounts of requests served, rejected (because of overload or rate limiting), of connections rejected,
+        and of requests waiting in the queue of the worker pool.
+        """
+        with self.__stats_lock:
+            stats = dict(self.__stats)
+        stats['queued'] = self.__workers.queued if self.__workers is not None else 0
+        return stats
+
+    def __count(self, stat: str):
+        with self.__stats_lock:
+            self.__stats[stat] += 1
     
     def __on_connection_event(self, event, connection, address, error):
         match event:
             case 'listen':
-                print('Server listening on %s:%d' % address)
+                self._log('Server listening on %s:%d' % address)
             case 'connect':
+                self._log('[%s:%d] Open connection' % connection.remote_address)
+                if self.__pipelined:
+                    self.__writers[connection] = _ResponseWriter(connection)
+                connection.binary = True # payloads are decoded according to their codec
                 connection.callback = self.__on_message_event
+            case 'reject':
+                self.__count('rejected_connections')
+                self._log('[%s:%d] Reject connection: too many connections' % address)
             case 'error':
                 traceback.print_exception(error)
             case 'stop':
-                print('Server stopped')
+                if self.__workers is not None:
+                    self.__workers.shutdown()
+                self._log('Server stopped')
     
     def __on_message_event(self, event, payload, connection, error):
         match event:
             case 'message':
-                print('[%s:%d] Open connection' % connection.remote_address)
-                request = deserialize(payload)
-                assert isinstance(request, Request)
-                print('[%s:%d] Unmarshall request:' % connection.remote_address, request)
-                response = self.__handle_request(request)
-                connection.send(serialize(response))
-                print('[%s:%d] Marshall response:' % connection.remote_address, response)
-                connection.close()
+                if self.__rate_limiter is not None:
+                    peeked = peek_request(payload)
+                    delay = self.__rate_limiter.admit(connection.remote_address[0], peeked[0] if peeked else None)
+                    if delay > 0:
+                        self.__reject(payload, connection, RATE_LIMITED, f"Too many requests, retry in {delay:.3f} seconds", peeked)
+                        return
+                if self.__workers is None:
+                    self.__serve(payload, connection)
+                    return
+                try:
+                    self.__workers.submit(lambda: self.__serve(payload, connection), block=self.__overload_policy == 'block')
+                except queue.Full:
+                    self.__reject(payload, connection, OVERLOADED, "Server overloaded, retry later")
             case 'error':
                 traceback.print_exception(error)
             case 'close':
-                print('[%s:%d] Close connection' % connection.remote_address)
+                if connection in self.__writers:
+                    self.__writers.pop(connection).close()
+                with self.__subscribers_lock:
+                    self.__subscribers.pop(connection, None)
+                    self.__followers.discard(connection)
+                self._log('[%s:%d] Close connection' % connection.remote_address)
     
+    def __serve(self, payload, connection: Connection):
+        codec = codec_of(payload)
+        respond = self.__respond
+        if codec.name not in self.__codecs:
+            response = Response(None, f"Unsupported codec {codec.name}")
+            codec = CODECS['json']
+        else:
+            try:
+                request = codec.deserializer.deserialize(payload)
+                if not isinstance(request, Request):
+                    raise TypeError(f"Expected a request, got: {type(request).__name__}")
+            except Exception as e:
+                # there is no request ID to answer to, so the connection is closed, as the client would wait forever otherwise
+                # (this happens on worker threads too, where the connection would not notice the error)
+                traceback.print_exception(e)
+                connection.close()
+                return
+            self._log('[%s:%d] Unmarshall request:' % connection.remote_address, request)
+            if request.name == SUBSCRIBE_INVALIDATIONS:
+                response = self.__subscribe(request, connection, codec)
+            elif request.name == REPLICATE:
+                response = self.__replicate(request, connection)
+                # sent right away, even when pipelined, so that it precedes the '$apply' requests pushed by the streaming thread
+                respond = _send_response
+            else:
+                response = self.__handle_request(request)
+        respond(response, connection, codec)
+        self.__count('served')
+        self._log('[%s:%d] Marshall response:' % connection.remote_address, response)
+        if response.error is None and (ids := self.__invalidated_ids(request)):
+            self.__publish(ids)
+        if response.error is None and request.name == REPLICATE:
+            self.__start_streaming(request.args[0], connection, codec)
+        if not self.__keep_alive and connection not in self.__subscribers and connection not in self.__followers:
+            connection.close()
+
+    def __subscribe(self, request: Request, connection: Connection, codec: Codec) -> Response:
+        with self.__subscribers_lock:
+            self.__subscribers[connection] = codec
+        self._log('[%s:%d] Subscribe to invalidations' % connection.remote_address)
+        return Response(True, None, request.id)
+
+    def __replicate(self, request: Request, connection: Connection) -> Response:
+        if not isinstance(self.__user_db, PrimaryUserDatabase):
+            return Response(None, "Not a primary: no change log to replicate", request.id)
+        with self.__subscribers_lock:
+            self.__followers.add(connection)
+        self._log('[%s:%d] Follow change log from position %d' % (*connection.remote_address, request.args[0]))
+        return Response(True, None, request.id)
+
+    def __start_streaming(self, position: int, connection: Connection, codec: Codec):
+        # log entries are pushed by a dedicated thread, which waits for further entries once the follower has caught up
+        def send(position, users, snapshot):
+            with connection.stream() as write:
+                codec.serializer.serialize_to(Request(APPLY, (position, users, snapshot)), write)
+            self._log('[%s:%d] Push %d %s from position %d' % (*connection.remote_address, len(users),
+                                                                 'snapshot users' if snapshot else 'log entries', position))
+
+        assert isinstance(self.__user_db, PrimaryUserDatabase)
+        threading.Thread(target=self.__user_db.stream, args=(position, send), daemon=True).start()
+
+    def __invalidated_ids(self, request: Request) -> set[str]:
+        match request.name:
+            case 'add_user':
+                return request.args[0].ids
+            case 'add_users':
+                return {id for user in request.args[0] for id in user.ids}
+        return set()
+
+    def __publish(self, ids: set[str]):
+        notice = Request(INVALIDATE, (sorted(ids),))
+        with self.__subscribers_lock:
+            subscribers = list(self.__subscribers.items())
+        for connection, codec in subscribers:
+            try:
+                connection.send(codec.serializer.serialize(notice))
+                self._log('[%s:%d] Push notice:' % connection.remote_address, notice)
+            except OSError:
+                pass # the subscriber has gone, and it will be forgotten upon the 'close' event
+
+    def __reject(self, payload, connection: Connection, code: str, message: str, peeked: tuple[str, int | None] | None = None):
+        # only the name and the ID of the request are read, to let the client match the response with its request
+        codec = codec_of(payload)
+        peeked = peeked or peek_request(payload)
+        if peeked is None: # not produced by our serializers, so it must be deserialized in full
+            request = codec.deserializer.deserialize(payload)
+            peeked = request.name, request.id
+        name, id = peeked
+        response = Response(None, message, id, code)
+        self.__respond(response, connection, codec)
+        self.__count('rate_limited_requests' if code == RATE_LIMITED else 'rejected_requests')
+        self._log('[%s:%d] Reject request %s (%s)' % (*connection.remote_address, name, code))
+        if not self.__keep_alive:
+            connection.close()
+
+    def __respond(self, response: Response, connection: Connection, codec: Codec):
+        if self.__pipelined:
+            self.__writers[connection].send(response, codec)
+        else:
+            _send_response(response, connection, codec)
+
     def __handle_request(self, request):
+        if request.name == NEGOTIATE_CODECS:
+            return Response(list(self.__codecs), None, request.id)
+        if request.name in self.AUTHENTICATION_METHODS:
+            service = self.__auth_service
+        elif request.name in self.USER_DB_METHODS:
+            service = self.__user_db
+        else:
+            return Response(None, f"Unknown method {request.name!r}", request.id)
         try:
-            method = getattr(self.__user_db, request.name)
+            method = getattr(service, request.name)
             result = method(*request.args)
             error = None
         except Exception as e:
             result = None
             error = " ".join(e.args)
-        return Response(result, error)
+        return Response(result, error, request.id)
 
 
 if __name__ == '__main__':
-    import sys
-    server = ServerStub(int(sys.argv[1]))
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m snippets -l 4 -e 2', description='RPC server for user database')
+    parser.add_argument('port', type=int, help='Port to listen on')
+    parser.add_argument('--keep-alive', action='store_true', help='Serve many requests per connection')
+    parser.add_argument('--pipelined', action='store_true', help='Flush responses in background (implies --keep-alive)')
+    parser.add_argument('--workers', '-w', type=int, default=0, help='Size of the worker pool (0 means no pool)')
+    parser.add_argument('--queue-size', '-q', type=int, default=0, help='Maximum amount of queued requests (0 means unbounded)')
+    parser.add_argument('--overload-policy', choices=ServerStub.OVERLOAD_POLICIES, default='block', help='What to do when the queue is full')
+    parser.add_argument('--max-connections', '-c', type=int, default=None, help='Maximum amount of open connections')
+    parser.add_argument('--store', choices=USER_DB_STORES, default='memory', help='How users are stored')
+    parser.add_argument('--data', default='users-data', help='Where users are stored, for persistent stores')
+    parser.add_argument('--shards', nargs='+', type=address, default=[], metavar='ADDRESS', help='Servers storing users, for the sharded store')
+    parser.add_argument('--hashing-workers', type=int, default=0, help='Processes hashing passwords, for local stores (0 means none)')
+    parser.add_argument('--primary', action='store_true', help='Keep a change log, for replicas to follow')
+    parser.add_argument('--replica-of', metavar='ADDRESS', help='Follow the change log of the primary at this address (read-only)')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='[METHOD=]RATE[:BURST]',
+                        help='Requests per second per client address, for all methods or for the given one (repeatable)')
+    parser.add_argument('--secret', help='Secret signing tokens (by default, a random one)')
+    parser.add_argument('--codecs', nargs='+', choices=list(CODECS), default=list(CODECS), help='Supported codecs')
+    args = parser.parse_args()
+
+    hasher = PasswordHasher(workers=args.hashing_workers)
+    user_db = make_user_db(args.store, path=args.data, hasher=hasher, shards=args.shards)
+    if args.primary:
+        user_db = PrimaryUserDatabase(user_db, hasher)
+    elif args.replica_of:
+        user_db = ReplicaUserDatabase(user_db)
+        user_db.follow(address(args.replica_of))
+    server = ServerStub(args.port, args.keep_alive, args.pipelined, args.workers, args.queue_size, args.overload_policy,
+                        args.max_connections, tuple(args.codecs), user_db=user_db,
+                        auth_service=InMemoryAuthenticationService(user_db, args.secret), rate_limits=dict(args.rate_limit))
     while True:
         try:
             input('Close server with Ctrl+D (Unix) or Ctrl+Z (Win)\n')
         except (EOFError, KeyboardInterrupt):
             break
     server.close()
+    if hasattr(user_db, 'close'):
+        user_db.close()
+    hasher.close()
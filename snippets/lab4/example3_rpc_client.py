@@ -1,37 +1,413 @@
 from snippets.lab3 import Client, address
 from snippets.lab4.users import *
-from snippets.lab4.example1_presentation import serialize, deserialize, Request, Response
+from snippets.lab4.users.impl import _Debuggable
+from snippets.lab4.example1_presentation import serialize, deserialize, codec_of, Request, Response, CODECS, NEGOTIATE_CODECS, SUBSCRIBE_INVALIDATIONS, INVALIDATE, ERROR_CODES
+from concurrent.futures import Future
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+import itertools
+import random
+import threading
+import time
+import traceback
 
 
-class ClientStub:
+class ServerBusyError(RuntimeError):
+    """
+    Raised when the server rejects a call because of its load (i.e. overload, or rate limiting), rather than of the call itself,
+    so that the same call may succeed if retried later. The `code` is among `ERROR_CODES`.
+    """
+
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.code = code
+
+
+def _error_of(response: Response) -> RuntimeError:
+    if response.code in ERROR_CODES:
+        return ServerBusyError(response.error, response.code) # type: ignore
+    return RuntimeError(response.error)
+
+
+class _RequestNotSent(ConnectionError):
+    """
+    Raised when a connection fails before a request is fully sent, so that the server cannot have served it.
+    """
+
+
+def _printable(message) -> str:
+    if codec_of(message).name != 'json':
+        return repr(bytes(message))
+    if not isinstance(message, str):
+        message = message.decode()
+    return message.replace('\n', '\n# ')
+
+
+class ConnectionPool:
+    """
+    A pool of persistent connections towards the same server, to be reused across many RPC calls.
+    It requires the server to keep connections alive after each response (see `ServerStub(keep_alive=True)`).
+
+    - at least `min_size` connections are kept open, even when idle
+    - at most `max_size` connections are open at the same time: further requests wait for a connection to be released
+    - connections which have been idle for more than `max_idle_time` seconds are closed (unless needed to honour `min_size`)
+    - idle connections are health-checked before being reused: dead ones are discarded and replaced
+    """
+
+    def __init__(self, server_address: tuple[str, int], min_size: int = 0, max_size: int = 8, max_idle_time: float = 30.0):
+        if max_size < 1:
+            raise ValueError("Pool size must be positive")
+        if not 0 <= min_size <= max_size:
+            raise ValueError("Minimum pool size must be in the range 0..max_size")
+        self.__server_address = address(*server_address)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.__idle: deque[tuple[Client, float]] = deque()
+        self.__size = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+        for _ in range(min_size):
+            self.__size += 1
+            self.release(self.__open())
+
+    @property
+    def size(self):
+        return self.__size
+
+    def __open(self) -> Client:
+        # the caller is expected to have already reserved a slot for the new connection, by incrementing self.__size
+        try:
+            return Client(self.__server_address)
+        except:
+            with self.__condition:
+                self.__size -= 1
+                self.__condition.notify()
+            raise
+
+    def __discard(self, client: Client):
+        client.close()
+        self.__size -= 1
+        self.__condition.notify()
+
+    def __evict_idle_connections(self):
+        # the least recently used connections are on the left side of the deque
+        deadline = time.monotonic() - self.max_idle_time
+        while self.__idle and self.__size > self.min_size and self.__idle[0][1] < deadline:
+            client, _ = self.__idle.popleft()
+            self.__discard(client)
+
+    def acquire(self, timeout: float = None, fresh: bool = False) -> Client:
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    raise ConnectionError("Connection pool is closed")
+                self.__evict_idle_connections()
+                while self.__idle and not fresh:
+                    client, _ = self.__idle.pop() # the most recently used connection is the most likely to be healthy
+                    if client.alive:
+                        return client
+                    self.__discard(client)
+                if self.__size >= self.max_size and fresh and self.__idle:
+                    client, _ = self.__idle.popleft() # make room for the new connection
+                    self.__discard(client)
+                if self.__size < self.max_size:
+                    self.__size += 1
+                    break
+                if not self.__condition.wait(timeout):
+                    raise TimeoutError(f"No connection available within {timeout} seconds")
+        return self.__open()
+
+    def release(self, client: Client, reusable: bool = True):
+        with self.__condition:
+            if reusable and not self.__closed and not client.closed:
+                self.__idle.append((client, time.monotonic()))
+                self.__condition.notify()
+            else:
+                self.__discard(client)
+
+    @contextmanager
+    def connection(self, timeout: float = None, fresh: bool = False):
+        client = self.acquire(timeout, fresh)
+        try:
+            yield client
+        except:
+            self.release(client, reusable=False) # the stream may be left in an inconsistent state
+            raise
+        self.release(client)
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            while self.__idle:
+                client, _ = self.__idle.pop()
+                self.__discard(client)
+            self.__condition.notify_all()
+
+
+class MultiplexedConnection:
+    """
+    A single persistent connection carrying many concurrent calls.
+    Each request is tagged with a fresh ID, and each response is matched to the pending request with the same ID,
+    so responses can arrive in any order.
+    It requires the server to keep connections alive after each response (see `ServerStub(keep_alive=True)`).
+    """
+
     def __init__(self, server_address: tuple[str, int]):
+        self.__pending: dict[int, Future] = {}
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count()
+        self.__client = Client(server_address)
+        self.__client.binary = True # responses may be encoded with any codec
+        self.__client.callback = self.__on_message_event
+
+    @property
+    def closed(self):
+        return self.__client.closed
+
+    def submit(self, name, *args, codec: str = 'json') -> Future:
+        future: Future = Future()
+        with self.__lock:
+            if self.closed:
+                raise ConnectionError("Connection to %s:%d is closed" % self.__client.remote_address)
+            request = Request(name, args, next(self.__ids))
+            # the future is registered before sending, as the response may arrive before send() returns
+            self.__pending[request.id] = future # type: ignore
+        try:
+            self.__client.send(serialize(request, codec))
+        except Exception as e:
+            with self.__lock:
+                still_pending = self.__pending.pop(request.id, None) is not None # type: ignore
+            if still_pending: # otherwise, the future has already been failed upon connection closure
+                future.set_exception(e)
+        return future
+
+    def __on_message_event(self, event, payload, connection, error):
+        match event:
+            case 'message':
+                response = deserialize(payload)
+                assert isinstance(response, Response)
+                with self.__lock:
+                    future = self.__pending.pop(response.id, None) # type: ignore
+                if future is None:
+                    print('# Ignoring unexpected response', response, 'from', "%s:%d" % connection.remote_address)
+                elif response.error:
+                    future.set_exception(_error_of(response))
+                else:
+                    future.set_result(response.result)
+            case 'error':
+                self.__fail_pending(error)
+            case 'close':
+                self.__fail_pending(ConnectionError("Connection closed by %s:%d before responding" % connection.remote_address))
+
+    def __fail_pending(self, error: Exception):
+        with self.__lock:
+            pending = list(self.__pending.values())
+            self.__pending.clear()
+        for future in pending:
+            future.set_exception(error)
+
+    def close(self):
+        self.__client.close()
+
+
+class ClientStub(_Debuggable):
+    """
+    Client-side stub for RPC. By default, each call opens a new connection, which is closed once the response arrives.
+    When `pool_size` is positive, calls are served by a `ConnectionPool` of persistent connections instead:
+    calls failing because a pooled connection was closed are retried once on a new connection, provided that either
+    the request was not fully sent, or the method is among `IDEMPOTENT_METHODS` (so writes are never applied twice).
+    When `multiplexed` is True, all calls share a single `MultiplexedConnection`, and many of them may be in flight at once.
+
+    Requests are encoded in JSON, unless another `codec` is selected: in that case, upon the first call,
+    the server is asked for the codecs it supports, and JSON is used anyway if the selected one is not among them.
+
+    Calls rejected because of the load of the server (see `ServerBusyError`) are retried up to `retries` times,
+    after exponentially growing delays starting from about `backoff` seconds (with random jitter, so that many clients
+    rejected at once do not retry all at once). Calls issued via `rpc_async` on multiplexed stubs are never retried.
+
+    Logs are printed unless `debug` is False.
+    """
+
+    # methods which can be called again with no further effects, hence retried when the response is lost
+    IDEMPOTENT_METHODS = ('get_user', 'get_users', 'check_password', 'check_passwords', 'validate_token', 'log_position', NEGOTIATE_CODECS)
+
+    def __init__(self, server_address: tuple[str, int], pool_size: int = 0, min_pool_size: int = 0, max_idle_time: float = 30.0,
+                 multiplexed: bool = False, codec: str = 'json', retries: int = 0, backoff: float = 0.1, debug: bool = True):
+        _Debuggable.__init__(self, debug)
+        self.retries = retries
+        self.backoff = backoff
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec!r}, expected one of {tuple(CODECS)}")
+        self.__preferred_codec = codec
+        self.__codec = codec if codec == 'json' else None # None means yet to be negotiated
         self.__server_address = address(*server_address)
+        self.__pool = ConnectionPool(self.__server_address, min_pool_size, pool_size, max_idle_time) if pool_size > 0 else None
+        self.__multiplexed = multiplexed
+        self.__channel: MultiplexedConnection | None = None
+        self.__channel_lock = threading.Lock()
+        self.__subscriptions: list[Client] = []
 
-    def rpc(self, name, *args):
+    def __get_channel(self) -> MultiplexedConnection:
+        with self.__channel_lock:
+            if self.__channel is None or self.__channel.closed:
+                self.__channel = MultiplexedConnection(self.__server_address)
+            return self.__channel
+
+    @contextmanager
+    def __connect(self, fresh: bool = False):
+        if self.__pool is not None:
+            with self.__pool.connection(fresh=fresh) as client:
+                yield client
+            return
         client = Client(self.__server_address)
+        self._log('# Connected to %s:%d' % client.remote_address)
         try:
-            print('# Connected to %s:%d' % client.remote_address)
-            request = Request(name, args)
-            print('# Marshalling', request, 'towards', "%s:%d" % client.remote_address)
-            request = serialize(request)
-            print('# Sending message:', request.replace('\n', '\n# '))
-            client.send(request)
-            response = client.receive()
-            print('# Received message:', response.replace('\n', '\n# '))
-            response = deserialize(response)
-            assert isinstance(response, Response)
-            print('# Unmarshalled', response, 'from', "%s:%d" % client.remote_address)
-            if response.error:
-                raise RuntimeError(response.error)
-            return response.result
+            yield client
         finally:
             client.close()
-            print('# Disconnected from %s:%d' % client.remote_address)
+            self._log('# Disconnected from %s:%d' % client.remote_address)
+
+    @property
+    def codec(self) -> str:
+        if self.__codec is None:
+            self.__codec = self.__negotiate_codec()
+        return self.__codec
+
+    def __negotiate_codec(self) -> str:
+        try:
+            supported = self.__rpc(NEGOTIATE_CODECS, (), 'json')
+        except RuntimeError:
+            supported = ['json'] # servers unaware of negotiation only support JSON
+        codec = self.__preferred_codec if self.__preferred_codec in supported else 'json'
+        self._log('# Negotiated codec', codec, 'with', "%s:%d" % self.__server_address)
+        return codec
+
+    def rpc_async(self, name, *args) -> Future:
+        """
+        Issues a call without waiting for its result, which is eventually available via the returned future.
+        Unless the stub is multiplexed, the call is actually performed synchronously, and the future is already completed.
+        """
+        if self.__multiplexed:
+            return self.__get_channel().submit(name, *args, codec=self.codec)
+        future: Future = Future()
+        try:
+            future.set_result(self.rpc(name, *args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def rpc(self, name, *args):
+        for attempt in itertools.count():
+            try:
+                return self.__rpc(name, args, self.codec)
+            except ServerBusyError as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                self._log(f'# Retrying {name} in {delay:.3f} seconds, after: {e}')
+                time.sleep(delay)
+
+    def __rpc(self, name, args, codec: str):
+        if self.__multiplexed:
+            return self.__get_channel().submit(name, *args, codec=codec).result()
+        request = Request(name, args)
+        try:
+            response = self.__call(request, codec)
+        except ConnectionError as e:
+            if self.__pool is None:
+                raise
+            # pooled connections may be closed by the server while idle, so we retry once on a brand new connection,
+            # unless the server may have served the request already, and serving it twice would have further effects
+            if not isinstance(e, _RequestNotSent) and name not in self.IDEMPOTENT_METHODS:
+                raise
+            response = self.__call(request, codec, fresh=True)
+        if response.error:
+            raise _error_of(response)
+        return response.result
+
+    def __call(self, request: Request, codec: str, fresh: bool = False) -> Response:
+        with self.__connect(fresh) as client:
+            self._log('# Marshalling', request, 'towards', "%s:%d" % client.remote_address)
+            message = serialize(request, codec)
+            if self._debug: # rendering messages is not for free
+                self._log('# Sending message:', _printable(message))
+            try:
+                client.send(message)
+            except ConnectionError as e:
+                raise _RequestNotSent("Cannot send request to %s:%d: %s" % (*client.remote_address, e)) from e
+            message = client.receive_bytes()
+            if message is None:
+                raise ConnectionError("Connection closed by %s:%d before responding" % client.remote_address)
+            if self._debug:
+                self._log('# Received message:', _printable(message))
+            response = deserialize(message)
+            assert isinstance(response, Response)
+            self._log('# Unmarshalled', response, 'from', "%s:%d" % client.remote_address)
+            return response
+
+    def subscribe(self, on_invalidate, on_disconnect=None) -> Client:
+        """
+        Opens a dedicated connection, over which the server pushes invalidation notices (see `ServerStub`):
+        `on_invalidate(*ids)` is called with the IDs of the users changed by any client, e.g. `CachingUserDatabase.invalidate`,
+        while `on_disconnect()` is called if the connection is lost, as notices may be missed from then on.
+        """
+        client = Client(self.__server_address)
+        client.send(serialize(Request(SUBSCRIBE_INVALIDATIONS, ()), self.codec))
+        message = client.receive_bytes()
+        if message is None:
+            raise ConnectionError("Connection closed by %s:%d before responding" % client.remote_address)
+        response = deserialize(message)
+        if response.error:
+            client.close()
+            raise RuntimeError(response.error)
+
+        def on_message_event(event, payload, connection, error):
+            match event:
+                case 'message':
+                    notice = deserialize(payload)
+                    if isinstance(notice, Request) and notice.name == INVALIDATE:
+                        self._log('# Invalidate', *notice.args[0])
+                        on_invalidate(*notice.args[0])
+                case 'error':
+                    traceback.print_exception(error)
+                case 'close':
+                    if on_disconnect is not None:
+                        on_disconnect()
+
+        client.binary = True # notices may be encoded with any codec
+        client.callback = on_message_event
+        self.__subscriptions.append(client)
+        self._log('# Subscribed to invalidations from %s:%d' % client.remote_address)
+        return client
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+        with self.__channel_lock:
+            if self.__channel is not None:
+                self.__channel.close()
+        for subscription in self.__subscriptions:
+            subscription.close()
 
 
 class RemoteUserDatabase(ClientStub, UserDatabase):
-    def __init__(self, server_address):
-        super().__init__(server_address)
+    """
+    Batch methods send items in chunks of at most `batch_size` items per call, to bound the size of messages.
+    When multiplexed, all chunks are in flight at the same time.
+    """
+
+    def __init__(self, server_address, batch_size: int = 1000, **options):
+        if batch_size < 1:
+            raise ValueError("Batch size must be positive")
+        super().__init__(server_address, **options)
+        self.batch_size = batch_size
+
+    def __rpc_batch(self, name, items: list) -> list:
+        chunks = [list(items[i:i + self.batch_size]) for i in range(0, len(items), self.batch_size)]
+        futures = [self.rpc_async(name, chunk) for chunk in chunks]
+        return [result for future in futures for result in future.result()]
 
     def add_user(self, user: User):
         return self.rpc('add_user', user)
@@ -42,13 +418,68 @@ class RemoteUserDatabase(ClientStub, UserDatabase):
     def check_password(self, credentials: Credentials) -> bool:
         return self.rpc('check_password', credentials)
 
+    def add_users(self, users: list[User]) -> list[str | None]:
+        return self.__rpc_batch('add_users', users)
+
+    def get_users(self, ids: list[str]) -> list[User | None]:
+        return self.__rpc_batch('get_users', ids)
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        return self.__rpc_batch('check_passwords', credentials)
+
+
+class RemoteAuthenticationService(ClientStub, AuthenticationService):
+    """
+    Tokens found valid by the server are cached (at most `token_cache_size` of them, the least recently used being evicted),
+    so that validating them again costs no round-trip, until they expire, or for at most `max_age` seconds (if not None):
+    as tokens may be revoked on the server by other clients, `max_age` bounds how long revocations may go unnoticed.
+    Invalid tokens are never cached, so that they cannot evict valid ones.
+    """
+
+    def __init__(self, server_address, token_cache_size: int = 1024, max_age: float = None, **options):
+        super().__init__(server_address, **options)
+        self.token_cache_size = token_cache_size
+        self.max_age = max_age
+        self.__valid_tokens: OrderedDict[str, tuple[Token, float]] = OrderedDict() # signature -> (token, time of validation)
+        self.__lock = threading.Lock()
+
+    def authenticate(self, credentials: Credentials, duration: timedelta = None) -> Token:
+        return self.rpc('authenticate', credentials, duration)
+
+    def validate_token(self, token: Token) -> bool:
+        if token.expiration <= datetime.now(token.expiration.tzinfo):
+            return False
+        with self.__lock:
+            cached = self.__valid_tokens.get(token.signature)
+            if cached is not None:
+                self.__valid_tokens.move_to_end(token.signature)
+        if cached is not None and cached[0] == token and (self.max_age is None or time.monotonic() - cached[1] < self.max_age):
+            return True
+        result = self.rpc('validate_token', token)
+        if result:
+            with self.__lock:
+                self.__valid_tokens[token.signature] = (token, time.monotonic())
+                if len(self.__valid_tokens) > self.token_cache_size:
+                    self.__valid_tokens.popitem(last=False)
+        return result
+
+    def revoke_token(self, token: Token) -> bool:
+        with self.__lock:
+            self.__valid_tokens.pop(token.signature, None)
+        return self.rpc('revoke_token', token)
+
 
 if __name__ == '__main__':
     from snippets.lab4.example0_users import gc_user, gc_credentials_ok, gc_credentials_wrong
     import sys
 
 
-    user_db = RemoteUserDatabase(address(sys.argv[1]))
+    mode = sys.argv[2] if len(sys.argv) > 2 else ''
+    codec = sys.argv[3] if len(sys.argv) > 3 else 'json'
+    if mode == 'multiplexed':
+        user_db = RemoteUserDatabase(address(sys.argv[1]), multiplexed=True, codec=codec)
+    else:
+        user_db = RemoteUserDatabase(address(sys.argv[1]), pool_size=int(mode or 0), codec=codec)
 
     # Trying to get a user that does not exist should raise a KeyError
     try:
@@ -75,3 +506,72 @@ if __name__ == '__main__':
 
     # Checking credentials should fail if the password is wrong
     assert user_db.check_password(gc_credentials_wrong) == False
+
+    # Many calls can be in flight at the same time: results are matched to requests, no matter the order they arrive in
+    futures = [user_db.rpc_async('check_password', gc_cred) for gc_cred in gc_credentials_ok + [gc_credentials_wrong]]
+    assert [future.result() for future in futures] == [True] * len(gc_credentials_ok) + [False]
+
+    # Many items can be processed in a single call, with errors reported item by item
+    batch = [User(f'user{i}', {f'user{i}@example.com'}, password=f'password{i}') for i in range(5)]
+    *errors, error = user_db.add_users(batch + [gc_user])
+    assert errors == [None] * len(batch) and error.startswith('User with ID') and error.endswith('already exists') # type: ignore
+    assert user_db.get_users(['user0', 'nobody', 'gciatto']) == [batch[0].copy(password=None), None, gc_user.copy(password=None)]
+    assert user_db.check_passwords([Credentials(u.username, u.password) for u in batch] + [gc_credentials_wrong]) == [True] * len(batch) + [False] # type: ignore
+
+    # Lookups can be cached on the client side: a user fetched by any of its IDs is then cached under all of them
+    from snippets.lab4.users.cache import CachingUserDatabase
+    cached_db = CachingUserDatabase(user_db)
+    for id in gc_user.ids:
+        assert cached_db.get_user(id) == gc_user.copy(password=None)
+    assert cached_db.stats['misses'] == 1 and cached_db.stats['hits'] == len(gc_user.ids) - 1
+    assert cached_db.get_users(['gciatto', 'user0', 'nobody']) == [gc_user.copy(password=None), batch[0].copy(password=None), None]
+    assert cached_db.get_user('user0@example.com') == batch[0].copy(password=None)
+    assert cached_db.stats['hits'] == len(gc_user.ids) + 1
+
+    # Missing users are cached too, until they are added via the same cache
+    for _ in range(2):
+        try:
+            cached_db.get_user('jdoe')
+        except RuntimeError as e:
+            assert 'User with ID jdoe not found' in str(e)
+    assert cached_db.stats['negative_hits'] == 1
+    cached_db.add_user(User('jdoe', {'john.doe@example.com'}, password='password'))
+    assert cached_db.get_user('john.doe@example.com').username == 'jdoe'
+
+    # Caches are kept consistent by the server, which pushes invalidations to subscribers whenever any client changes users
+    user_db.subscribe(cached_db.invalidate, cached_db.clear)
+    try:
+        cached_db.get_user('asmith')
+    except RuntimeError as e:
+        assert 'User with ID asmith not found' in str(e)
+    other_db = RemoteUserDatabase(address(sys.argv[1]))
+    other_db.add_user(User('asmith', {'alice.smith@example.com'}, password='password'))
+    deadline = time.monotonic() + 1.0
+    while True: # invalidations are asynchronous, so the missing user stays cached until the one of asmith arrives
+        try:
+            assert cached_db.get_user('asmith').username == 'asmith'
+            break
+        except RuntimeError as e:
+            assert 'User with ID asmith not found' in str(e)
+            assert time.monotonic() < deadline, "Invalidation of asmith never arrived"
+            time.sleep(0.01)
+    other_db.close()
+
+    # Tokens can be issued and validated remotely, and tokens found valid are then validated locally, until they expire
+    auth_service = RemoteAuthenticationService(address(sys.argv[1]), debug=user_db._debug)
+    try:
+        auth_service.authenticate(gc_credentials_wrong)
+    except RuntimeError as e:
+        assert 'Invalid credentials' in str(e)
+    gc_token = auth_service.authenticate(gc_credentials_ok[0], timedelta(hours=1))
+    assert gc_token.user == gc_user.copy(password=None)
+    assert auth_service.validate_token(gc_token) == True
+    assert auth_service.validate_token(gc_token.copy(signature='wrong signature')) == False
+    assert auth_service.validate_token(gc_token.copy(user=gc_token.user.copy(role=Role.USER))) == False
+    assert auth_service.validate_token(gc_token) == True # cached, hence no round-trip
+    assert auth_service.validate_token(gc_token.copy(expiration=datetime.now() - timedelta(seconds=1))) == False
+    assert auth_service.revoke_token(gc_token) == True
+    assert auth_service.validate_token(gc_token) == False
+    auth_service.close()
+
+    user_db.close()
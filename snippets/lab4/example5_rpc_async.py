@@ -0,0 +1,203 @@
+from snippets.lab3 import address
+from snippets.lab3.aio import AsyncClient, AsyncConnection, AsyncServer
+from snippets.lab4.users import *
+from snippets.lab4.users.impl import InMemoryUserDatabase
+from snippets.lab4.example1_presentation import serialize, deserialize, codec_of, Request, Response, CODECS, NEGOTIATE_CODECS
+import asyncio
+import itertools
+import traceback
+
+
+class AsyncServerStub(AsyncServer):
+    """
+    The asyncio counterpart of `ServerStub`: all connections are served by a single event loop.
+    Connections are always kept alive, and each response carries the ID of its request,
+    so it can serve both plain and multiplexed clients. All codecs are supported.
+    Each request is served by a task of its own, so that many requests of the same connection are served concurrently,
+    and responses are sent as soon as they are ready (possibly out of order).
+    """
+
+    def __init__(self, port):
+        super().__init__(port, self.__on_connection_event)
+        self.__user_db = InMemoryUserDatabase()
+        self.__tasks: set[asyncio.Task] = set() # strong references to running tasks, which the event loop only keeps weakly
+
+    def __on_connection_event(self, event, connection, address, error):
+        match event:
+            case 'listen':
+                print('Server listening on %s:%d' % address)
+            case 'connect':
+                print('[%s:%d] Open connection' % connection.remote_address)
+                connection.binary = True # payloads are decoded according to their codec
+                connection.callback = self.__on_message_event
+            case 'error':
+                traceback.print_exception(error)
+            case 'stop':
+                print('Server stopped')
+
+    async def __on_message_event(self, event, payload, connection: AsyncConnection, error):
+        match event:
+            case 'message':
+                task = asyncio.get_running_loop().create_task(self.__serve(payload, connection))
+                self.__tasks.add(task)
+                task.add_done_callback(self.__tasks.discard)
+            case 'error':
+                traceback.print_exception(error)
+            case 'close':
+                print('[%s:%d] Close connection' % connection.remote_address)
+
+    async def __serve(self, payload, connection: AsyncConnection):
+        try:
+            codec = codec_of(payload)
+            request = codec.deserializer.deserialize(payload)
+            assert isinstance(request, Request)
+            print('[%s:%d] Unmarshall request:' % connection.remote_address, request)
+            response = await self.__handle_request(request)
+            await connection.send(codec.serializer.serialize(response))
+            print('[%s:%d] Marshall response:' % connection.remote_address, response)
+        except Exception as e:
+            if not connection.closed:
+                traceback.print_exception(e)
+                await connection.close() # the client would wait forever for the response
+
+    async def __handle_request(self, request):
+        if request.name == NEGOTIATE_CODECS:
+            return Response(list(CODECS), None, request.id)
+        # hashing passwords takes tens of milliseconds, which would stall all connections if the database was called
+        # from the event loop: it is called from a separate thread instead
+        try:
+            method = getattr(self.__user_db, request.name)
+            result = await asyncio.to_thread(method, *request.args)
+            error = None
+        except Exception as e:
+            result = None
+            error = " ".join(e.args)
+        return Response(result, error, request.id)
+
+
+class AsyncClientStub:
+    """
+    The asyncio counterpart of a multiplexed `ClientStub`: all calls share a single connection,
+    which is opened upon the first call, and responses are matched to requests by ID.
+    """
+
+    def __init__(self, server_address: tuple[str, int]):
+        self.__server_address = address(*server_address)
+        self.__client: AsyncClient | None = None
+        self.__connecting = asyncio.Lock() # so that concurrent first calls share the same connection
+        self.__pending: dict[int, asyncio.Future] = {}
+        self.__ids = itertools.count()
+
+    async def __get_client(self) -> AsyncClient:
+        async with self.__connecting:
+            if self.__client is None or self.__client.closed:
+                self.__client = await AsyncClient.connect(self.__server_address, self.__on_message_event)
+                print('# Connected to %s:%d' % self.__client.remote_address)
+            return self.__client
+
+    async def rpc(self, name, *args):
+        client = await self.__get_client()
+        request = Request(name, args, next(self.__ids))
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[request.id] = future # type: ignore
+        print('# Marshalling', request, 'towards', "%s:%d" % client.remote_address)
+        try:
+            await client.send(serialize(request))
+            response = await future
+        finally:
+            self.__pending.pop(request.id, None) # type: ignore
+        print('# Unmarshalled', response, 'from', "%s:%d" % client.remote_address)
+        if response.error:
+            raise RuntimeError(response.error)
+        return response.result
+
+    def __on_message_event(self, event, payload, connection, error):
+        match event:
+            case 'message':
+                response = deserialize(payload)
+                assert isinstance(response, Response)
+                future = self.__pending.get(response.id) # type: ignore
+                if future is not None and not future.done():
+                    future.set_result(response)
+            case 'error':
+                self.__fail_pending(error)
+            case 'close':
+                self.__fail_pending(ConnectionError("Connection closed by %s:%d before responding" % connection.remote_address))
+
+    def __fail_pending(self, error: Exception):
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def close(self):
+        if self.__client is not None:
+            await self.__client.close()
+            print('# Disconnected from %s:%d' % self.__client.remote_address)
+
+
+class AsyncRemoteUserDatabase(AsyncClientStub):
+    async def add_user(self, user: User):
+        return await self.rpc('add_user', user)
+
+    async def get_user(self, id: str) -> User:
+        return await self.rpc('get_user', id)
+
+    async def check_password(self, credentials: Credentials) -> bool:
+        return await self.rpc('check_password', credentials)
+
+    async def add_users(self, users: list[User]) -> list[str | None]:
+        return await self.rpc('add_users', users)
+
+    async def get_users(self, ids: list[str]) -> list[User | None]:
+        return await self.rpc('get_users', ids)
+
+    async def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        return await self.rpc('check_passwords', credentials)
+
+
+async def run_server(port: int):
+    server = AsyncServerStub(port)
+    await server.start()
+    print('Close server with Ctrl+D (Unix) or Ctrl+Z (Win)')
+    try:
+        await asyncio.to_thread(input) # input() is blocking, so it is run in a separate thread
+    except (EOFError, KeyboardInterrupt):
+        pass
+    await server.close()
+
+
+async def run_client(server_address: tuple[str, int]):
+    from snippets.lab4.example0_users import gc_user, gc_credentials_ok, gc_credentials_wrong
+
+    user_db = AsyncRemoteUserDatabase(server_address)
+
+    # Trying to get a user that does not exist should raise a KeyError
+    try:
+        await user_db.get_user('gciatto')
+    except RuntimeError as e:
+        assert 'User with ID gciatto not found' in str(e)
+
+    # Adding a novel user should work
+    await user_db.add_user(gc_user)
+
+    # Getting a user that exists should work
+    assert await user_db.get_user('gciatto') == gc_user.copy(password=None)
+
+    # Many calls can be in flight at the same time, on the same connection
+    results = await asyncio.gather(*[user_db.check_password(gc_cred) for gc_cred in gc_credentials_ok + [gc_credentials_wrong]])
+    assert results == [True] * len(gc_credentials_ok) + [False]
+
+    await user_db.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    mode = sys.argv[1].lower().strip()
+    if mode == 'server':
+        asyncio.run(run_server(int(sys.argv[2])))
+    elif mode == 'client':
+        asyncio.run(run_client(address(sys.argv[2])))
+    else:
+        print(f"Invalid mode {mode!r}, expected 'server' or 'client'")
+        sys.exit(1)
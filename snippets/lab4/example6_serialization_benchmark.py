@@ -0,0 +1,165 @@
+from snippets.lab4.users import User, Token, Role
+from snippets.lab4.example1_presentation import Request, Response, CODECS
+from datetime import datetime, timedelta
+import json
+import time
+import tracemalloc
+
+
+def make_user(i: int) -> User:
+    return User(
+        username=f'user{i}',
+        emails={f'user{i}@example.com', f'user{i}@unibo.it'},
+        full_name=f'User Number {i}',
+        role=Role.ADMIN if i % 10 == 0 else Role.USER,
+        password=f'password of user {i}',
+    )
+
+
+def make_token(i: int) -> Token:
+    return Token(make_user(i), datetime(2024, 1, 1) + timedelta(minutes=i), f'signature{i:08x}')
+
+
+def make_payload(kind: str, size: int, depth: int = 1):
+    """
+    Generates a synthetic object graph of the given `kind`, containing `size` users (or tokens),
+    nested into `depth` levels of lists, the innermost of which contains the objects.
+    """
+    match kind:
+        case 'user':
+            items: list = [make_user(i) for i in range(size)]
+        case 'token':
+            items = [make_token(i) for i in range(size)]
+        case 'request':
+            items = [Request('add_user', (make_user(i),), i) for i in range(size)]
+        case 'response':
+            items = [Response(make_user(i).copy(password=None), None, i) for i in range(size)]
+        case _:
+            raise ValueError(f"Unknown kind of payload {kind!r}")
+    payload: object = items if size != 1 else items[0]
+    for _ in range(depth - 1):
+        payload = [payload]
+    return payload
+
+
+def _measure(operation, min_time: float) -> float:
+    """
+    Calls `operation` repeatedly for at least `min_time` seconds, and returns how many calls per second were made.
+    """
+    count = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time or count == 0:
+        operation()
+        count += 1
+    return count / elapsed
+
+
+def _memory_usage(operation) -> tuple[int, int]:
+    """
+    Calls `operation` once, and returns the peak amount of bytes allocated (and traced by `tracemalloc`) meanwhile,
+    along with the amount of memory blocks allocated by it and still alive afterwards (i.e. the ones making up its result),
+    as counted by comparing snapshots taken before and after the call.
+    """
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__)] # the bookkeeping of snapshots themselves
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(ignored)
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        result = operation()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot().filter_traces(ignored)
+    finally:
+        tracemalloc.stop()
+    del result
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return peak - baseline, blocks
+
+
+def benchmark(codec: str, kind: str, size: int, depth: int = 1, min_time: float = 0.5) -> dict:
+    """
+    Measures serialization and deserialization of a synthetic payload (see `make_payload`) with the given `codec`.
+    Returns a dict with the results, where `error` is not None if the codec cannot handle the payload.
+    """
+    serializer, deserializer = CODECS[codec].serializer, CODECS[codec].deserializer
+    payload = make_payload(kind, size, depth)
+    result: dict = dict(codec=codec, kind=kind, size=size, depth=depth, error=None)
+    try:
+        message = serializer.serialize(payload)
+        assert deserializer.deserialize(message) == payload
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        return result
+    result['bytes'] = len(message.encode() if isinstance(message, str) else message)
+    result['serialize_ops'] = _measure(lambda: serializer.serialize(payload), min_time)
+    result['deserialize_ops'] = _measure(lambda: deserializer.deserialize(message), min_time)
+    result['serialize_peak_bytes'], result['serialize_blocks'] = _memory_usage(lambda: serializer.serialize(payload))
+    result['deserialize_peak_bytes'], result['deserialize_blocks'] = _memory_usage(lambda: deserializer.deserialize(message))
+    return result
+
+
+def _key(result: dict) -> tuple:
+    return result['codec'], result['kind'], result['size'], result['depth']
+
+
+def find_regressions(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    Compares `results` with the ones of a previous run, and describes each metric which got worse by more than `tolerance`
+    (e.g. 0.2 means 20%): throughputs must not decrease, sizes, memory, and allocated blocks must not increase.
+    """
+    previous = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(_key(result))
+        if old is None or result['error'] or old['error']:
+            continue
+        for metric, higher_is_better in [('serialize_ops', True), ('deserialize_ops', True), ('bytes', False),
+                                         ('serialize_peak_bytes', False), ('deserialize_peak_bytes', False),
+                                         ('serialize_blocks', False), ('deserialize_blocks', False)]:
+            if metric not in old:
+                continue # baselines of earlier versions lack some metrics
+            change = (result[metric] - old[metric]) / old[metric] if old[metric] else 0
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{'/'.join(map(str, _key(result)))}: {metric} {old[metric]:.0f} -> {result[metric]:.0f} ({change:+.0%})")
+    return regressions
+
+
+def print_results(results: list[dict]):
+    print(f"{'codec':<8}{'kind':<10}{'size':>6}{'depth':>6}{'bytes':>10}{'ser ops/s':>12}{'deser ops/s':>12}{'ser peak':>10}{'deser peak':>11}{'ser blocks':>11}{'deser blocks':>13}")
+    for r in results:
+        row = f"{r['codec']:<8}{r['kind']:<10}{r['size']:>6}{r['depth']:>6}"
+        if r['error']:
+            print(row, ' unsupported:', r['error'])
+        else:
+            print(row + f"{r['bytes']:>10}{r['serialize_ops']:>12.0f}{r['deserialize_ops']:>12.0f}"
+                        f"{r['serialize_peak_bytes']:>10}{r['deserialize_peak_bytes']:>11}{r['serialize_blocks']:>11}{r['deserialize_blocks']:>13}")
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog='python -m snippets -l 4 -e 6', description='Benchmark for the presentation layer')
+    parser.add_argument('--codecs', nargs='+', choices=list(CODECS), default=list(CODECS), help='Codecs to benchmark')
+    parser.add_argument('--kinds', nargs='+', choices=['user', 'token', 'request', 'response'],
+                        default=['user', 'token', 'request', 'response'], help='Kinds of payload')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1, 100], help='Amounts of objects per payload')
+    parser.add_argument('--depths', nargs='+', type=int, default=[1, 8], help='Nesting levels of payloads')
+    parser.add_argument('--min-time', type=float, default=0.5, help='Seconds spent measuring each operation')
+    parser.add_argument('--output', '-o', help='File where to write results, as JSON')
+    parser.add_argument('--baseline', '-b', help='JSON file with the results of a previous run, to detect regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Tolerated relative worsening w.r.t. the baseline')
+    args = parser.parse_args()
+
+    results = [benchmark(codec, kind, size, depth, args.min_time)
+               for kind in args.kinds for size in args.sizes for depth in args.depths for codec in args.codecs]
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        sys.exit(1 if regressions else 0)
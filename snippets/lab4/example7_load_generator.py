@@ -0,0 +1,260 @@
+from snippets.lab3 import address
+from snippets.lab4.users import User, Credentials
+from snippets.lab4.example1_presentation import CODECS
+from snippets.lab4.example2_rpc_server import ServerStub, make_user_db, parse_rate_limit, LOCAL_USER_DB_STORES
+from snippets.lab4.example3_rpc_client import RemoteUserDatabase, ServerBusyError
+from snippets.lab4.users.hashing import PasswordHasher
+import math
+import random
+import tempfile
+import threading
+import time
+
+
+class LatencyHistogram:
+    """
+    Records latencies into logarithmic buckets, `BUCKETS_PER_DOUBLING` per power of two (i.e. with a relative error of about 4%),
+    so that percentiles can be estimated with constant memory, no matter how many latencies are recorded.
+    """
+
+    BUCKETS_PER_DOUBLING = 16
+    MIN_LATENCY = 1e-6 # seconds
+
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency: float):
+        bucket = int(math.log2(max(latency, self.MIN_LATENCY) / self.MIN_LATENCY) * self.BUCKETS_PER_DOUBLING)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def merge(self, other: 'LatencyHistogram'):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        """
+        Returns an upper bound of the latency below which (at least) a fraction `q` of the recorded latencies lies.
+        """
+        if self.count == 0:
+            return 0.0
+        threshold = q * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= threshold:
+                return min(self.MIN_LATENCY * 2 ** ((bucket + 1) / self.BUCKETS_PER_DOUBLING), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+PERCENTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99, 'p999': 0.999}
+
+DEFAULT_MIX = {'add_user': 1, 'get_user': 6, 'check_password': 3}
+
+
+def parse_mix(text: str) -> dict[str, int]:
+    """
+    Parses a mix of operations, such as 'add_user=1,get_user=6,check_password=3', into a dict of weights.
+    """
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        if name.strip() not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation {name!r}, expected one of {tuple(DEFAULT_MIX)}")
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def make_user(name: str) -> User:
+    return User(name, {f'{name}@example.com'}, full_name=name.title(), password=f'password of {name}')
+
+
+class LoadClient(threading.Thread):
+    """
+    A client issuing calls back to back, according to a mix of operations, until `deadline`.
+    Latencies of successful calls issued after `warmup_end` are recorded in a histogram per operation,
+    while failed calls are counted by kind of error.
+    """
+
+    def __init__(self, index: int, user_db: RemoteUserDatabase, mix: dict[str, int], users: list[User],
+                 warmup_end: float, deadline: float, seed: int = 0):
+        super().__init__(daemon=True)
+        self.__index = index
+        self.__user_db = user_db
+        self.__operations = list(mix)
+        self.__weights = list(mix.values())
+        self.__users = users
+        self.__warmup_end = warmup_end
+        self.__deadline = deadline
+        self.__random = random.Random(seed + index)
+        self.__added = 0
+        self.histograms = {name: LatencyHistogram() for name in mix}
+        self.errors = {'connection': 0, 'rejected': 0, 'other': 0}
+
+    def __call(self, operation: str):
+        match operation:
+            case 'add_user':
+                self.__added += 1
+                self.__user_db.add_user(make_user(f'load{self.__index}x{self.__added}'))
+            case 'get_user':
+                self.__user_db.get_user(self.__random.choice(self.__users).username)
+            case 'check_password':
+                user = self.__random.choice(self.__users)
+                password = user.password if self.__random.random() < 0.9 else 'wrong password'
+                self.__user_db.check_password(Credentials(user.username, password)) # type: ignore
+
+    def run(self):
+        while (start := time.perf_counter()) < self.__deadline:
+            operation = self.__random.choices(self.__operations, self.__weights)[0]
+            try:
+                self.__call(operation)
+            except (ConnectionError, OSError):
+                self.errors['connection'] += 1
+                continue
+            except ServerBusyError:
+                self.errors['rejected'] += 1
+                continue
+            except RuntimeError:
+                self.errors['other'] += 1
+                continue
+            if start >= self.__warmup_end:
+                self.histograms[operation].record(time.perf_counter() - start)
+        self.__user_db.close()
+
+
+def run_load(server_address: tuple[str, int], clients: int, duration: float, mix: dict[str, int] = DEFAULT_MIX,
+             warmup: float = 0.0, users: int = 100, server: ServerStub = None, **client_options) -> dict:
+    """
+    Drives `clients` concurrent clients against the server at `server_address` for `warmup` + `duration` seconds,
+    and returns a report of throughput, latencies, and errors (overall and per operation).
+    If the `server` object is provided, its queue is sampled during the run, and its counters are reported too.
+    Further options are passed to each `RemoteUserDatabase`.
+    """
+    population = [make_user(f'user{i}') for i in range(users)]
+    setup_db = RemoteUserDatabase(server_address, debug=False, **client_options)
+    for user in population:
+        try:
+            setup_db.add_user(user)
+        except RuntimeError:
+            pass # the user already exists, e.g. because of a previous run against the same server
+    setup_db.close()
+
+    start = time.perf_counter()
+    warmup_end, deadline = start + warmup, start + warmup + duration
+    load_clients = [LoadClient(i, RemoteUserDatabase(server_address, debug=False, **client_options),
+                               mix, population, warmup_end, deadline) for i in range(clients)]
+    stats_before = server.stats if server is not None else None
+    queue_samples = []
+    for client in load_clients:
+        client.start()
+    while time.perf_counter() < deadline:
+        if server is not None:
+            queue_samples.append(server.stats['queued'])
+        time.sleep(0.05)
+    for client in load_clients:
+        client.join()
+
+    histograms = {name: LatencyHistogram() for name in mix}
+    errors = {'connection': 0, 'rejected': 0, 'other': 0}
+    for client in load_clients:
+        for name, histogram in client.histograms.items():
+            histograms[name].merge(histogram)
+        for kind, count in client.errors.items():
+            errors[kind] += count
+    overall = LatencyHistogram()
+    for histogram in histograms.values():
+        overall.merge(histogram)
+
+    def summary(histogram: LatencyHistogram) -> dict:
+        result = dict(calls=histogram.count, throughput=histogram.count / duration, mean=histogram.mean, max=histogram.max)
+        result.update({name: histogram.percentile(q) for name, q in PERCENTILES.items()})
+        return result
+
+    report = dict(clients=clients, duration=duration, overall=summary(overall),
+                  operations={name: summary(histogram) for name, histogram in histograms.items()}, errors=errors)
+    if server is not None:
+        stats_after = server.stats
+        server_report: dict = {stat: stats_after[stat] - stats_before[stat] for stat in stats_after if stat != 'queued'} # type: ignore
+        server_report['max_queued'] = max(queue_samples, default=0)
+        server_report['mean_queued'] = sum(queue_samples) / len(queue_samples) if queue_samples else 0
+        report['server'] = server_report
+    return report
+
+
+def print_report(report: dict):
+    print(f"{report['clients']} clients, {report['duration']:.1f} seconds")
+    print(f"{'operation':<16}{'calls':>8}{'calls/s':>10}" + ''.join(f"{name + ' ms':>10}" for name in PERCENTILES) + f"{'max ms':>10}")
+    for name, summary in [*report['operations'].items(), ('overall', report['overall'])]:
+        print(f"{name:<16}{summary['calls']:>8}{summary['throughput']:>10.0f}" +
+              ''.join(f"{summary[p] * 1000:>10.2f}" for p in PERCENTILES) + f"{summary['max'] * 1000:>10.2f}")
+    print('Errors:', ', '.join(f'{kind}={count}' for kind, count in report['errors'].items()))
+    if 'server' in report:
+        print('Server:', ', '.join(f'{stat}={value:g}' for stat, value in report['server'].items()))
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(prog='python -m snippets -l 4 -e 7', description='Load generator for the RPC user database')
+    parser.add_argument('--server', help='Address of a running server (by default, one is started in this process)')
+    parser.add_argument('--clients', '-n', type=int, default=8, help='Amount of concurrent clients')
+    parser.add_argument('--duration', '-d', type=float, default=10.0, help='Seconds of measured load')
+    parser.add_argument('--warmup', type=float, default=1.0, help='Seconds of load preceding measurements')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='Weights of operations, e.g. add_user=1,get_user=6,check_password=3')
+    parser.add_argument('--users', type=int, default=100, help='Amount of users added before the load starts')
+    parser.add_argument('--mode', choices=['per-call', 'pooled', 'multiplexed'], default='pooled', help='How clients use connections')
+    parser.add_argument('--codec', choices=list(CODECS), default='json', help='Codec used by clients')
+    parser.add_argument('--pipelined', action='store_true', help='Flush responses in background, on the local server')
+    parser.add_argument('--workers', '-w', type=int, default=0, help='Size of the worker pool of the local server')
+    parser.add_argument('--queue-size', '-q', type=int, default=0, help='Maximum amount of queued requests on the local server')
+    parser.add_argument('--overload-policy', choices=ServerStub.OVERLOAD_POLICIES, default='block', help='Overload policy of the local server')
+    parser.add_argument('--store', choices=LOCAL_USER_DB_STORES, default='memory', help='How users are stored on the local server')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='[METHOD=]RATE[:BURST]',
+                        help='Requests per second per client address on the local server, for all methods or the given one')
+    parser.add_argument('--hashing-workers', type=int, default=0, help='Processes hashing passwords on the local server (0 means none)')
+    parser.add_argument('--output', '-o', help='File where to write the report, as JSON')
+    args = parser.parse_args()
+
+    client_options: dict = dict(codec=args.codec)
+    if args.mode == 'pooled':
+        client_options['pool_size'] = 1 # each client issues one call at a time
+    elif args.mode == 'multiplexed':
+        client_options['multiplexed'] = True
+
+    server = user_db = None
+    data = tempfile.TemporaryDirectory(prefix='users-') # where the local server stores users, if its store is persistent
+    hasher = PasswordHasher(workers=args.hashing_workers)
+    if args.server:
+        server_address = address(args.server)
+    else:
+        # clients and server share the same interpreter (hence, the same GIL): use --server for more realistic figures
+        user_db = make_user_db(args.store, debug=False, path=data.name, hasher=hasher)
+        server = ServerStub(0, keep_alive=args.mode != 'per-call', pipelined=args.pipelined, workers=args.workers,
+                            queue_size=args.queue_size, overload_policy=args.overload_policy, debug=False, rate_limits=dict(args.rate_limit),
+                            user_db=user_db)
+        server_address = ('localhost', server.local_address[1])
+
+    report = run_load(server_address, args.clients, args.duration, args.mix, args.warmup, args.users, server, **client_options)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if server is not None:
+        server.close()
+    if hasattr(user_db, 'close'):
+        user_db.close() # type: ignore
+    data.cleanup()
+    hasher.close()
@@ -0,0 +1,79 @@
+from snippets.lab4.users import User, Credentials, Role
+from snippets.lab4.example2_rpc_server import make_user_db, LOCAL_USER_DB_STORES
+from snippets.lab4.users.hashing import PasswordHasher
+import gc
+import tempfile
+import time
+import tracemalloc
+
+
+def make_user(i: int) -> User:
+    return User(
+        username=f'user{i}',
+        emails={f'user{i}@example.com', f'user.{i}@unibo.it'},
+        full_name=f'User Number {i}',
+        role=Role.ADMIN if i % 100 == 0 else Role.USER,
+        password=f'password of user {i}',
+    )
+
+
+def benchmark(store: str, users: int, lookups: int = 100_000) -> dict:
+    """
+    Fills a user database of the given kind of `store` with `users` users, and measures:
+    the memory it retains (as traced by `tracemalloc`), the time to fill it, and the throughput of lookups.
+    Passwords are hashed with a single iteration of PBKDF2, so that figures are about the layout of stores, rather than hashing.
+    """
+    with tempfile.TemporaryDirectory(prefix='users-') as path: # persistent stores start empty, and leave nothing behind
+        gc.collect()
+        tracemalloc.start()
+        try:
+            baseline, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            user_db = make_user_db(store, debug=False, path=path, hasher=PasswordHasher(iterations=1))
+            for i in range(users):
+                user_db.add_user(make_user(i))
+            fill_time = time.perf_counter() - start
+            gc.collect()
+            memory, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        memory -= baseline
+
+        try:
+            start = time.perf_counter()
+            for i in range(lookups):
+                user_db.get_user(f'user{i * 7919 % users}@example.com')
+            get_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for i in range(lookups):
+                user_db.check_password(Credentials(f'user{i * 7919 % users}', f'password of user {i * 7919 % users}'))
+            check_time = time.perf_counter() - start
+        finally:
+            if hasattr(user_db, 'close'):
+                user_db.close()
+
+    return dict(store=store, users=users, memory=memory, bytes_per_user=memory / users, fill_time=fill_time,
+                get_user_ops=lookups / get_time, check_password_ops=lookups / check_time)
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(prog='python -m snippets -l 4 -e 8', description='Memory benchmark for user databases')
+    parser.add_argument('--stores', nargs='+', choices=LOCAL_USER_DB_STORES, default=list(LOCAL_USER_DB_STORES), help='Stores to benchmark')
+    parser.add_argument('--users', '-n', type=int, default=100_000, help='Amount of users per database')
+    parser.add_argument('--lookups', type=int, default=100_000, help='Amount of lookups measured per database')
+    parser.add_argument('--output', '-o', help='File where to write results, as JSON')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'store':<10}{'users':>10}{'MiB':>10}{'bytes/user':>12}{'fill s':>9}{'get ops/s':>12}{'check ops/s':>13}")
+    for store in args.stores:
+        r = benchmark(store, args.users, args.lookups)
+        results.append(r)
+        print(f"{r['store']:<10}{r['users']:>10}{r['memory'] / 2**20:>10.1f}{r['bytes_per_user']:>12.0f}{r['fill_time']:>9.2f}"
+              f"{r['get_user_ops']:>12.0f}{r['check_password_ops']:>13.0f}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,201 @@
+from snippets.lab4.users.impl import InMemoryAuthenticationService, _Debuggable
+from snippets.lab4.users.sqlite import SqliteTokenRegistry
+from snippets.lab4.example2_rpc_server import ServerStub, make_user_db
+from multiprocessing.connection import wait
+from collections import deque
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+
+# Stores which many processes can share consistently, as each worker process opens its own handle to the same data
+SHARED_STORES = ('sqlite',)
+
+
+def _tokens_path(path: str) -> str:
+    return os.path.join(path, 'tokens.sqlite3')
+
+
+def _serve(port: int, store: str, path: str, secret: str, server_options: dict):
+    """
+    Body of each worker process: serves requests on the shared `port` until it is terminated.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    user_db = make_user_db(store, debug=False, path=path)
+    auth_service = InMemoryAuthenticationService(user_db, secret, debug=False, registry=SqliteTokenRegistry(_tokens_path(path)))
+    server = ServerStub(port, user_db=user_db, auth_service=auth_service, reuse_port=True, **server_options)
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass # the whole process group gets Ctrl+C: the supervisor takes care of shutting down
+    finally:
+        server.close()
+        auth_service.close()
+        user_db.close() # type: ignore
+
+
+class PreforkServer(_Debuggable):
+    """
+    Serves RPC requests via `processes` worker processes (one per core, by default), each one running its own `ServerStub`,
+    so that (de)serialization and hashing are not bound to the single core usable by a Python process (because of the GIL).
+    Workers share the listening `port` via SO_REUSEPORT, so that the kernel spreads incoming connections among them.
+
+    A supervisor thread restarts workers which die: a worker which dies soon after being (re)started is restarted after a delay,
+    doubling from `MIN_BACKOFF` up to `MAX_BACKOFF` seconds, so that a worker which keeps crashing does not spin;
+    the delay is reset once a worker has survived `STABLE_TIME` seconds. If more than `max_restarts` restarts
+    happen within `restart_window` seconds, something is wrong beyond single workers (e.g. the store is unreadable):
+    the supervisor gives up restarting workers, and reports the error (see `error`), while the surviving workers keep serving.
+
+    Workers share the same `store` (among `SHARED_STORES`) at `path`,
+    so that any worker sees the users added via any other worker, and the same `secret` (a random one, by default),
+    so that any worker accepts the tokens issued by any other worker. Issued tokens are tracked in a `SqliteTokenRegistry`
+    at `path` too, so that a token revoked via any worker is invalid in all of them.
+    Further `server_options` are passed to each `ServerStub` (whose logs are not printed,
+    while the ones of the supervisor are printed unless `debug` is False).
+
+    Any other state of a `ServerStub` is per-process: a connection subscribed to invalidations (see '$subscribe') is only
+    notified of the changes made via the worker it is connected to, and rate-limit buckets are kept by each worker
+    (so a client whose connections are spread among `processes` workers may get up to `processes` times the configured rate).
+    """
+
+    MIN_BACKOFF = 0.1
+    MAX_BACKOFF = 30.0
+    STABLE_TIME = 10.0
+
+    def __init__(self, port: int, processes: int = None, store: str = 'sqlite', path: str = 'users-data', secret: str = None,
+                 max_restarts: int = 10, restart_window: float = 60.0, debug: bool = True, **server_options):
+        if store not in SHARED_STORES:
+            raise ValueError(f"Store {store!r} cannot be shared among processes, expected one of {SHARED_STORES}")
+        processes = processes or os.cpu_count() or 1
+        if processes < 1:
+            raise ValueError("The number of processes must be positive")
+        _Debuggable.__init__(self, debug)
+        # the port is reserved by a socket which is bound but never listening, so that it receives no connections:
+        # this resolves port 0 to an actual port, and keeps the port busy while workers are being restarted
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("Sharing ports among processes (SO_REUSEPORT) is not supported on this platform")
+        self.__placeholder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__placeholder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__placeholder.bind(('0.0.0.0', port))
+        self.local_address = self.__placeholder.getsockname()
+        secret = secret or str(uuid.uuid4())
+        self.__worker_args = (self.local_address[1], store, path, secret, dict(server_options, debug=False)) # workers would print interleaved logs
+        make_user_db(store, debug=False, path=path).close() # type: ignore # creates the schemas before workers race to do it
+        SqliteTokenRegistry(_tokens_path(path)).close()
+        self.__context = multiprocessing.get_context('spawn') # forking a process with threads is unsafe
+        self.__started = [0.0] * processes
+        self.__workers = [self.__start_worker(i) for i in range(processes)]
+        self.__restarts = 0
+        self.__max_restarts = max_restarts
+        self.__restart_window = restart_window
+        self.__error: Exception | None = None
+        self.__closed = threading.Event()
+        self.__supervisor_thread = threading.Thread(target=self.__supervise, daemon=True)
+        self.__supervisor_thread.start()
+        self._log('Prefork server listening on %s:%d with %d processes' % (*self.local_address, processes))
+
+    @property
+    def restarts(self) -> int:
+        return self.__restarts
+
+    @property
+    def error(self) -> Exception | None:
+        """
+        Why the supervisor gave up restarting workers, if it did.
+        """
+        return self.__error
+
+    @property
+    def pids(self) -> list[int | None]:
+        return [worker.pid for worker in self.__workers]
+
+    def __start_worker(self, index: int):
+        worker = self.__context.Process(target=_serve, args=self.__worker_args, name=f'worker-{index}', daemon=True)
+        worker.start()
+        self.__started[index] = time.monotonic()
+        return worker
+
+    def __supervise(self) -> None:
+        backoffs = [0.0] * len(self.__workers)
+        pending: dict[int, float] = {} # index of dead worker -> when to restart it
+        recent_restarts: deque[float] = deque()
+        while not self.__closed.is_set():
+            timeout = min([1.0] + [deadline - time.monotonic() for deadline in pending.values()])
+            alive = [worker.sentinel for index, worker in enumerate(self.__workers) if index not in pending]
+            if alive:
+                wait(alive, timeout=max(timeout, 0))
+            else:
+                self.__closed.wait(max(timeout, 0))
+            if self.__closed.is_set():
+                return
+            now = time.monotonic()
+            for index, worker in enumerate(self.__workers):
+                if index not in pending and not worker.is_alive():
+                    if now - self.__started[index] >= self.STABLE_TIME:
+                        backoffs[index] = 0.0
+                    else:
+                        backoffs[index] = min(max(backoffs[index] * 2, self.MIN_BACKOFF), self.MAX_BACKOFF)
+                    self._log(f'Worker {worker.name} (pid {worker.pid}) exited with code {worker.exitcode}: '
+                              f'restarting it in {backoffs[index]:.1f} seconds')
+                    pending[index] = now + backoffs[index]
+            for index, deadline in list(pending.items()):
+                if deadline > now:
+                    continue
+                while recent_restarts and recent_restarts[0] <= now - self.__restart_window:
+                    recent_restarts.popleft()
+                if len(recent_restarts) >= self.__max_restarts:
+                    self.__error = RuntimeError(f'Workers restarted {len(recent_restarts)} times within {self.__restart_window} seconds, '
+                                                f'last exit code was {self.__workers[index].exitcode}: giving up restarting them')
+                    print(f'# {self.__error}', file=sys.stderr)
+                    return
+                del pending[index]
+                dead, self.__workers[index] = self.__workers[index], self.__start_worker(index)
+                dead.close() # only once replaced, so that `pids` never meets a closed process
+                self.__restarts += 1
+                recent_restarts.append(now)
+
+    def close(self):
+        self.__closed.set()
+        self.__supervisor_thread.join()
+        for worker in self.__workers:
+            worker.terminate()
+        for worker in self.__workers:
+            worker.join()
+        self.__placeholder.close()
+        self._log('Prefork server stopped')
+
+
+if __name__ == '__main__':
+    from snippets.lab4.example1_presentation import CODECS
+    from snippets.lab4.example2_rpc_server import parse_rate_limit
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m snippets -l 4 -e 9', description='RPC server for user database, on many processes')
+    parser.add_argument('port', type=int, help='Port to listen on')
+    parser.add_argument('--processes', '-p', type=int, default=None, help='Amount of worker processes (by default, one per core)')
+    parser.add_argument('--data', default='users-data', help='Where users are stored')
+    parser.add_argument('--secret', help='Secret signing tokens (by default, a random one)')
+    parser.add_argument('--keep-alive', action='store_true', help='Serve many requests per connection')
+    parser.add_argument('--pipelined', action='store_true', help='Flush responses in background (implies --keep-alive)')
+    parser.add_argument('--workers', '-w', type=int, default=0, help='Size of the worker pool of each process (0 means no pool)')
+    parser.add_argument('--max-connections', '-c', type=int, default=None, help='Maximum amount of open connections per process')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='[METHOD=]RATE[:BURST]',
+                        help='Requests per second per client address and per process, for all methods or for the given one (repeatable)')
+    parser.add_argument('--codecs', nargs='+', choices=list(CODECS), default=list(CODECS), help='Supported codecs')
+    args = parser.parse_args()
+
+    server = PreforkServer(args.port, args.processes, path=args.data, secret=args.secret, keep_alive=args.keep_alive, pipelined=args.pipelined,
+                           workers=args.workers, max_connections=args.max_connections, codecs=tuple(args.codecs),
+                           rate_limits=dict(args.rate_limit), debug=True)
+    while True:
+        try:
+            input('Close server with Ctrl+D (Unix) or Ctrl+Z (Win)\n')
+        except (EOFError, KeyboardInterrupt):
+            break
+    server.close()
@@ -73,6 +73,37 @@ class UserDatabase(Protocol):
     def check_password(self, credentials: Credentials) -> bool:
         ...
 
+    # Batch variants, to process many items at once: failures are reported item by item, rather than raised.
+    # By default, they just call the single-item methods, but implementations may do better (e.g. in a single round-trip).
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        """
+        Adds all `users`, returning the error message of each user which could not be added (None for the ones which were).
+        """
+        errors: list[str | None] = []
+        for user in users:
+            try:
+                self.add_user(user)
+                errors.append(None)
+            except Exception as e:
+                errors.append(" ".join(map(str, e.args)))
+        return errors
+
+    def get_users(self, ids: list[str]) -> list[User | None]:
+        """
+        Gets the users with the given `ids`, returning None for each ID which is not found.
+        """
+        users: list[User | None] = []
+        for id in ids:
+            try:
+                users.append(self.get_user(id))
+            except (KeyError, RuntimeError):
+                users.append(None)
+        return users
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        return [self.check_password(c) for c in credentials]
+
 
 class AuthenticationService(Protocol):
     def authenticate(self, credentials: Credentials, duration: timedelta = None) -> Token:
@@ -80,3 +111,28 @@ class AuthenticationService(Protocol):
 
     def validate_token(self, token: Token) -> bool:
         ...
+
+
+class TokenRegistry(Protocol):
+    """
+    Tracks issued tokens until they expire, so that they can be revoked (see `InMemoryAuthenticationService`).
+    """
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ...
+
+    def track(self, token: Token):
+        ...
+
+    def is_revoked(self, signature: str) -> bool:
+        ...
+
+    def revoke(self, token: Token) -> bool:
+        ...
+
+    def revoke_user(self, username: str) -> int:
+        ...
+
+    def close(self):
+        ...
@@ -0,0 +1,174 @@
+from ..users import *
+from .impl import _Debuggable
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+import time
+
+
+def _is_not_found(error: Exception) -> bool:
+    # local databases raise KeyError, while remote ones raise RuntimeError carrying the same message
+    return isinstance(error, KeyError) or 'not found' in str(error)
+
+
+@dataclass
+class _Entry:
+    key: str
+    ids: set[str]
+    user: User | None # None means the user was not found
+    error: Exception | None
+    expiration: float
+
+
+class CachingUserDatabase(UserDatabase, _Debuggable):
+    """
+    A read-through cache in front of another (typically, remote) user database, for `get_user` calls.
+
+    - each user is cached under all of its IDs, so that looking it up by any of them is a hit
+    - IDs which were not found are cached too (negative caching), so that repeated lookups of missing users are cheap
+    - entries expire after `ttl` seconds (or `negative_ttl`, for missing users)
+    - at most `max_size` entries are kept, the least recently used ones being evicted first
+    - adding a user through the cache invalidates all of its IDs; further ones can be invalidated via `invalidate`,
+      e.g. upon notices pushed by the server (see `ClientStub.subscribe`)
+    - lookups which are concurrent to invalidations do not cache their (possibly stale) results
+
+    Passwords are never cached: `check_password` always reaches the underlying database.
+    Counters of hits, misses, evictions, expirations, and invalidations are available via `stats`.
+    """
+
+    def __init__(self, database: UserDatabase, max_size: int = 1024, ttl: float = 60.0, negative_ttl: float = 5.0, debug: bool = True):
+        if max_size < 1:
+            raise ValueError("Cache size must be positive")
+        _Debuggable.__init__(self, debug)
+        self.__database = database
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.__entries: OrderedDict[str, _Entry] = OrderedDict() # in least-recently-used-first order
+        self.__aliases: dict[str, _Entry] = {}
+        self.__lock = threading.Lock()
+        self.__generation = 0 # incremented upon each invalidation
+        self.__stats = dict(hits=0, negative_hits=0, misses=0, evictions=0, expirations=0, invalidations=0)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['size'] = len(self.__entries)
+        return stats
+
+    def add_user(self, user: User):
+        try:
+            return self.__database.add_user(user)
+        finally:
+            self.invalidate(*user.ids)
+
+    def get_user(self, id: str) -> User:
+        entry, generation = self.__lookup(id)
+        if entry is None:
+            try:
+                user = self.__database.get_user(id)
+            except Exception as e:
+                if not _is_not_found(e):
+                    raise
+                error = type(e)(*e.args) # a copy, not to keep the traceback alive
+                self.__store(_Entry(id, {id}, None, error, time.monotonic() + self.negative_ttl), generation)
+                raise
+            entry = _Entry(user.username, user.ids, user, None, time.monotonic() + self.ttl)
+            self.__store(entry, generation)
+        elif entry.user is None:
+            raise type(entry.error)(*entry.error.args) # type: ignore
+        return entry.user.copy() # type: ignore
+
+    def check_password(self, credentials: Credentials) -> bool:
+        return self.__database.check_password(credentials)
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        try:
+            return self.__database.add_users(users)
+        finally:
+            self.invalidate(*{id for user in users for id in user.ids})
+
+    def get_users(self, ids: list[str]) -> list[User | None]:
+        """
+        Serves cached users from the cache, and gets all the other ones from the underlying database in a single batch.
+        IDs which are not found are not cached, as batches carry no error for them.
+        """
+        results: list[User | None] = []
+        missing: dict[str, list[int]] = {} # positions of the IDs which are not cached
+        generation = None
+        for id in ids:
+            entry, generation = self.__lookup(id)
+            if entry is None:
+                missing.setdefault(id, []).append(len(results))
+            results.append(entry.user.copy() if entry is not None and entry.user is not None else None)
+        if missing:
+            for id, user in zip(missing, self.__database.get_users(list(missing))):
+                if user is not None:
+                    self.__store(_Entry(user.username, user.ids, user, None, time.monotonic() + self.ttl), generation) # type: ignore
+                for position in missing[id]:
+                    results[position] = user.copy() if user is not None else None
+        return results
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        return self.__database.check_passwords(credentials)
+
+    def __lookup(self, id: str) -> tuple[_Entry | None, int]:
+        with self.__lock:
+            entry = self.__aliases.get(id)
+            if entry is not None and entry.expiration <= time.monotonic():
+                self.__remove(entry)
+                self.__stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.__stats['misses'] += 1
+            else:
+                self.__entries.move_to_end(entry.key)
+                self.__stats['hits' if entry.user is not None else 'negative_hits'] += 1
+            generation = self.__generation
+        self._log(f"Cache {'miss' if entry is None else 'hit'} for user with ID {id}")
+        return entry, generation
+
+    def __store(self, entry: _Entry, generation: int):
+        with self.__lock:
+            if generation != self.__generation:
+                return # some invalidation happened while the entry was being fetched, so it may be stale
+            for id in entry.ids: # stale entries sharing some IDs with the new one are dropped
+                if id in self.__aliases:
+                    self.__remove(self.__aliases[id])
+            self.__entries[entry.key] = entry
+            for id in entry.ids:
+                self.__aliases[id] = entry
+            while len(self.__entries) > self.max_size:
+                self.__remove(next(iter(self.__entries.values())))
+                self.__stats['evictions'] += 1
+
+    def __remove(self, entry: _Entry):
+        # the caller is expected to hold the lock
+        del self.__entries[entry.key]
+        for id in entry.ids:
+            if self.__aliases.get(id) is entry:
+                del self.__aliases[id]
+
+    def invalidate(self, *ids: str):
+        """
+        Drops the cached entries of the given IDs, along with all the other IDs of the same users.
+        """
+        with self.__lock:
+            self.__generation += 1
+            for id in ids:
+                entry = self.__aliases.get(id)
+                if entry is not None:
+                    self.__remove(entry)
+                    self.__stats['invalidations'] += 1
+        self._log(f"Invalidate users with IDs {', '.join(ids)}")
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+            self.__aliases.clear()
+
+    def close(self):
+        if hasattr(self.__database, 'close'):
+            self.__database.close()
@@ -0,0 +1,147 @@
+from ..users import *
+from .impl import _Debuggable
+from .hashing import PasswordHasher, pack_hash, unpack_hash
+from collections.abc import Iterator
+import threading
+
+
+class _UserRecord:
+    """
+    A row of the primary table: slots rather than a per-instance dict, and emails as a tuple rather than a set.
+    The password is stored as its hash in binary form (see `pack_hash`), which is converted to text only when it is verified.
+    """
+
+    __slots__ = ('username', 'emails', 'full_name', 'role', 'password_hash')
+
+    def __init__(self, username: str, emails: tuple[str, ...], full_name: str | None, role: Role, password_hash: bytes):
+        self.username = username
+        self.emails = emails
+        self.full_name = full_name
+        self.role = role
+        self.password_hash = password_hash
+
+    def to_user(self) -> User:
+        return User(self.username, set(self.emails), self.full_name, self.role)
+
+
+class CompactUserDatabase(UserDatabase, _Debuggable):
+    """
+    Same behaviour as `InMemoryUserDatabase`, with a memory-compact layout, for databases of millions of users:
+    users are rows of a primary table, indexed by position, while a secondary index maps each ID (username or email)
+    to the position of its user. The index and the rows share the same string objects.
+    (IDs are not interned via `sys.intern`, as they are unique: the interning table would only add an entry per ID.)
+    `User` objects are only created upon lookups. Passwords are hashed by the given `hasher`, as in `InMemoryUserDatabase`.
+    Users can be added concurrently: checking the IDs of a user and inserting its record happen under a lock
+    (hashing does not, so that additions are only serialized for as long as the tables are updated).
+    """
+
+    def __init__(self, debug: bool = True, hasher: PasswordHasher = None):
+        _Debuggable.__init__(self, debug)
+        self.__records: list[_UserRecord] = []
+        self.__index: dict[str, int] = {}
+        self.__lock = threading.Lock() # guards additions, while lookups take no lock, as single list and dict operations are atomic
+        self._hasher = hasher or PasswordHasher()
+        self._log("Compact user database initialized with empty users")
+
+    def __len__(self):
+        return len(self.__records)
+
+    def add_user(self, user: User):
+        self._check_new(user) # fails fast, before hashing
+        self._add_hashed_user(user.copy(password=self._hasher.hash(user.password))) # type: ignore
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        # passwords are hashed all at once (i.e. in parallel, if the hasher has workers), before inserting users one by one
+        return self.add_hashed_users(self._hash_all(users))
+
+    def add_hashed_users(self, users: list[User]) -> list[str | None]:
+        """
+        Adds `users` whose passwords are hashed already (e.g. by a primary, see `PrimaryUserDatabase`), storing hashes as they are.
+        """
+        errors: list[str | None] = []
+        for user in users:
+            try:
+                self._add_hashed_user(user)
+                errors.append(None)
+            except ValueError as e:
+                errors.append(" ".join(map(str, e.args)))
+        return errors
+
+    def _add_hashed_user(self, user: User):
+        with self.__lock:
+            record = self._make_record(user)
+            self._insert(record)
+        self._log(f"Add: {record.to_user()}")
+
+    def _hash_all(self, users: list[User]) -> list[User]:
+        """
+        Copies of `users` whose passwords (if any) are replaced by their hashes, computed all at once.
+        """
+        hashes = iter(self._hasher.hash_all([user.password for user in users if user.password is not None])) # type: ignore
+        return [user.copy(password=next(hashes) if user.password is not None else None) for user in users]
+
+    def _check_new(self, user: User):
+        for id in user.ids:
+            if id in self.__index:
+                raise ValueError(f"User with ID {id} already exists")
+        if user.password is None:
+            raise ValueError("Password digest is required")
+
+    def _make_record(self, user: User) -> _UserRecord:
+        # the password of the user is expected to be hashed already
+        self._check_new(user)
+        return _UserRecord(
+            username=user.username,
+            emails=tuple(user.emails),
+            full_name=user.full_name,
+            role=user.role,
+            password_hash=pack_hash(user.password), # type: ignore # checked to be there
+        )
+
+    def _insert(self, record: _UserRecord):
+        position = len(self.__records)
+        self.__records.append(record)
+        self.__index[record.username] = position
+        for email in record.emails:
+            self.__index[email] = position
+
+    def _records(self) -> list[_UserRecord]:
+        """
+        A copy of the primary table (records themselves are never modified, so they are not copied).
+        """
+        return list(self.__records)
+
+    def hashed_users(self) -> Iterator[User]:
+        """
+        Iterates over all users, along with their password hashes (e.g. to take a snapshot, see `PrimaryUserDatabase`).
+        """
+        for record in self._records():
+            yield User(record.username, set(record.emails), record.full_name, record.role, unpack_hash(record.password_hash))
+
+    def __get_record(self, id: str) -> _UserRecord:
+        if id not in self.__index:
+            raise KeyError(f"User with ID {id} not found")
+        return self.__records[self.__index[id]]
+
+    def get_user(self, id: str) -> User:
+        result = self.__get_record(id).to_user()
+        self._log(f"Get user with ID {id}: {result}")
+        return result
+
+    def check_password(self, credentials: Credentials) -> bool:
+        try:
+            record = self.__get_record(credentials.id)
+            result = self._hasher.verify(credentials.password, unpack_hash(record.password_hash))
+        except KeyError:
+            result = False
+        self._log(f"Checking {credentials}: {'correct' if result else 'incorrect'}")
+        return result
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        # only the credentials of existing users are verified, all at once
+        positions = [self.__index.get(c.id) for c in credentials]
+        pairs = [(c.password, unpack_hash(self.__records[p].password_hash)) for c, p in zip(credentials, positions) if p is not None]
+        verified = iter(self._hasher.verify_all(pairs))
+        results = [next(verified) if position is not None else False for position in positions]
+        self._log(f"Checking {len(credentials)} credentials: {results.count(True)} correct")
+        return results
@@ -0,0 +1,116 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+import hashlib
+import hmac
+import multiprocessing
+import os
+import struct
+
+
+# Passwords are hashed via PBKDF2-HMAC-SHA256, with a random salt per password, and encoded as strings
+# of the form 'pbkdf2_sha256$<iterations>$<salt>$<hash>' (salt and hash in hex), so that the amount of iterations
+# can be raised over time, while passwords hashed with fewer iterations can still be verified.
+PBKDF2_ITERATIONS = 100_000
+_SALT_SIZE = 16
+_ALGORITHM = 'pbkdf2_sha256'
+_PACKED_HEADER = struct.Struct('<IB') # iterations, salt size
+
+
+def hash_password(password: str, iterations: int = PBKDF2_ITERATIONS) -> str:
+    salt = os.urandom(_SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f'{_ALGORITHM}${iterations}${salt.hex()}${digest.hex()}'
+
+
+def verify_password(password: str, encoded: str) -> bool:
+    algorithm, iterations, salt, expected = encoded.split('$')
+    if algorithm != _ALGORITHM:
+        raise ValueError(f"Unsupported password hash {algorithm!r}")
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(digest, bytes.fromhex(expected))
+
+
+def pack_hash(encoded: str) -> bytes:
+    """
+    Converts an encoded hash (see `hash_password`) into a compact binary form, for stores keeping many of them:
+    the amount of iterations and the size of the salt, followed by the raw salt and hash (about 53 bytes, rather than 114 characters).
+    Raises ValueError if `encoded` is not a hash produced by `hash_password`.
+    """
+    try:
+        algorithm, iterations, salt, digest = encoded.split('$')
+        if algorithm != _ALGORITHM:
+            raise ValueError(f"Unsupported password hash {algorithm!r}")
+        raw_salt = bytes.fromhex(salt)
+        return _PACKED_HEADER.pack(int(iterations), len(raw_salt)) + raw_salt + bytes.fromhex(digest)
+    except (ValueError, struct.error) as e:
+        raise ValueError(f"Invalid password hash: {e}") from e
+
+
+def unpack_hash(packed: bytes) -> str:
+    """
+    The inverse of `pack_hash`.
+    """
+    iterations, salt_size = _PACKED_HEADER.unpack_from(packed)
+    salt, digest = packed[_PACKED_HEADER.size:_PACKED_HEADER.size + salt_size], packed[_PACKED_HEADER.size + salt_size:]
+    return f'{_ALGORITHM}${iterations}${salt.hex()}${digest.hex()}'
+
+
+def _hash_passwords(passwords: list[str], iterations: int) -> list[str]:
+    return [hash_password(password, iterations) for password in passwords]
+
+
+def _verify_passwords(pairs: list[tuple[str, str]]) -> list[bool]:
+    return [verify_password(password, encoded) for password, encoded in pairs]
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords (see `hash_password` and `verify_password`), with `iterations` iterations of PBKDF2.
+
+    By default, hashes are computed by the calling thread. When `workers` is positive, they are offloaded to a pool
+    of that many processes instead, so that the calling thread (e.g. one serving a connection) only waits for results,
+    while hashes are computed on all cores. Batch methods split their items into one chunk per worker,
+    so that each chunk costs a single round-trip to a worker process.
+    """
+
+    def __init__(self, iterations: int = PBKDF2_ITERATIONS, workers: int = 0):
+        if iterations < 1:
+            raise ValueError("The amount of iterations must be positive")
+        self.iterations = iterations
+        self.__workers = workers
+        self.__executor: Executor | None = None
+        if workers > 0:
+            # workers are spawned rather than forked, as servers fork them while running many threads
+            self.__executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def hash(self, password: str) -> str:
+        if self.__executor is None:
+            return hash_password(password, self.iterations)
+        return self.__executor.submit(hash_password, password, self.iterations).result()
+
+    def verify(self, password: str, encoded: str) -> bool:
+        if self.__executor is None:
+            return verify_password(password, encoded)
+        return self.__executor.submit(verify_password, password, encoded).result()
+
+    def __chunks(self, items: list) -> list[list]:
+        size = -(-len(items) // self.__workers) # i.e. the ceiling of the division
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def hash_all(self, passwords: list[str]) -> list[str]:
+        if self.__executor is None or len(passwords) < 2:
+            return [self.hash(password) for password in passwords]
+        futures = [self.__executor.submit(_hash_passwords, chunk, self.iterations) for chunk in self.__chunks(passwords)]
+        return [encoded for future in futures for encoded in future.result()]
+
+    def verify_all(self, pairs: list[tuple[str, str]]) -> list[bool]:
+        """
+        Verifies many pairs (password, encoded hash) at once.
+        """
+        if self.__executor is None or len(pairs) < 2:
+            return [self.verify(password, encoded) for password, encoded in pairs]
+        futures = [self.__executor.submit(_verify_passwords, chunk) for chunk in self.__chunks(pairs)]
+        return [result for future in futures for result in future.result()]
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
@@ -1,16 +1,21 @@
 from ..users import *
+from .hashing import PasswordHasher
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
 import hashlib
-
-
-def _compute_sha256_hash(input: str) -> str:
-    sha256_hash = hashlib.sha256()
-    sha256_hash.update(input.encode('utf-8'))
-    return sha256_hash.hexdigest()
+import heapq
+import hmac
+import threading
 
 
 class _Debuggable:
     def __init__(self, debug: bool = True):
         self.__debug = debug
+
+    @property
+    def _debug(self) -> bool:
+        return self.__debug
     
     def _log(self, *args, **kwargs):
         if self.__debug:
@@ -18,22 +23,86 @@ class _Debuggable:
 
 
 class InMemoryUserDatabase(UserDatabase, _Debuggable):
-    def __init__(self, debug: bool = True):
+    """
+    Passwords are stored as salted PBKDF2 hashes, computed by the given `hasher` (see `PasswordHasher`):
+    by default, one hashing on the calling thread.
+
+    Users can be added concurrently (e.g. by the many threads of a server): checking that none of the IDs of a user exists,
+    and then inserting the user under all of them, is atomic. To do so without serializing all additions behind one lock,
+    each ID is guarded by one of `lock_stripes` locks (chosen by hash), and an addition holds the locks of all its IDs
+    (taken in a fixed order, to avoid deadlocks). Lookups take no lock at all, as single dict operations are atomic.
+    When `lock_stripes` is 0, there is no locking, which is only safe if users are added by one thread at a time.
+    """
+
+    def __init__(self, debug: bool = True, hasher: PasswordHasher = None, lock_stripes: int = 64):
         _Debuggable.__init__(self, debug)
         self.__users: dict[str, User] = {}
+        self.__hasher = hasher or PasswordHasher()
+        self.__locks = [threading.Lock() for _ in range(lock_stripes)]
         self._log("User database initialized with empty users")
+
+    @contextmanager
+    def __locking(self, ids: set[str]):
+        if not self.__locks:
+            yield
+            return
+        locks = [self.__locks[stripe] for stripe in sorted({hash(id) % len(self.__locks) for id in ids})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
     
-    def add_user(self, user: User):
+    def __check_new(self, user: User):
         for id in user.ids:
             if id in self.__users:
                 raise ValueError(f"User with ID {id} already exists")
         if user.password is None:
             raise ValueError("Password digest is required")
-        user = user.copy(password=_compute_sha256_hash(user.password))
+
+    def __insert(self, user: User):
         for id in user.ids:
             self.__users[id] = user
         self._log(f"Add: {user}")
 
+    def add_user(self, user: User):
+        self.__check_new(user) # fails fast, before hashing
+        user = user.copy(password=self.__hasher.hash(user.password)) # type: ignore
+        with self.__locking(user.ids):
+            self.__check_new(user) # users may be added in the meanwhile
+            self.__insert(user)
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        # passwords are hashed all at once (i.e. in parallel, if the hasher has workers), before inserting users one by one
+        passwords = [user.password for user in users if user.password is not None]
+        hashes = iter(self.__hasher.hash_all(passwords)) # type: ignore
+        return self.add_hashed_users([user.copy(password=next(hashes) if user.password is not None else None) for user in users])
+
+    def add_hashed_users(self, users: list[User]) -> list[str | None]:
+        """
+        Adds `users` whose passwords are hashed already (e.g. by a primary, see `PrimaryUserDatabase`), storing hashes as they are.
+        """
+        errors: list[str | None] = []
+        for user in users:
+            try:
+                with self.__locking(user.ids):
+                    self.__check_new(user) # users may be added in the meanwhile, or may be repeated in the batch
+                    self.__insert(user)
+                errors.append(None)
+            except ValueError as e:
+                errors.append(" ".join(map(str, e.args)))
+        return errors
+
+    def hashed_users(self) -> Iterator[User]:
+        """
+        Iterates over all users, along with their password hashes (e.g. to take a snapshot, see `PrimaryUserDatabase`).
+        """
+        for id, user in list(self.__users.items()):
+            if id == user.username: # each user is stored under all its IDs, but yielded once
+                yield user
+
     def __get_user(self, id: str) -> User:
         if id not in self.__users:
             raise KeyError(f"User with ID {id} not found")
@@ -47,22 +116,177 @@ class InMemoryUserDatabase(UserDatabase, _Debuggable):
     def check_password(self, credentials: Credentials) -> bool:
         try:
             user = self.__get_user(credentials.id)
-            result = user.password == _compute_sha256_hash(credentials.password)
+            result = self.__hasher.verify(credentials.password, user.password) # type: ignore
         except KeyError:
             result = False
         self._log(f"Checking {credentials}: {'correct' if result else 'incorrect'}")
         return result
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        # only the credentials of existing users are verified, all at once
+        users = [self.__users.get(c.id) for c in credentials]
+        pairs = [(c.password, user.password) for c, user in zip(credentials, users) if user is not None]
+        verified = iter(self.__hasher.verify_all(pairs)) # type: ignore
+        results = [next(verified) if user is not None else False for user in users]
+        self._log(f"Checking {len(credentials)} credentials: {results.count(True)} correct")
+        return results
     
 
+def _token_payload(user: User, expiration: datetime) -> bytes:
+    """
+    The canonical encoding of what a token signature covers: each field of the user (emails in sorted order),
+    and the expiration, as length-prefixed UTF-8 strings, so that distinct tokens never share the same encoding.
+    """
+    fields = (user.username, *sorted(user.emails), user.full_name or '', user.role.name, expiration.isoformat())
+    parts = [len(fields).to_bytes(2, 'big')]
+    for field in fields:
+        data = field.encode('utf-8')
+        parts.append(len(data).to_bytes(4, 'big'))
+        parts.append(data)
+    return b''.join(parts)
+
+
+class InMemoryTokenRegistry:
+    """
+    Tracks issued tokens until they expire, so that they can be revoked, one by one or all the ones of a user at once:
+    revoked signatures are kept in a set, which validation checks first.
+    Tracked and revoked tokens are reclaimed upon expiration by a sweeper thread, which waits for the earliest expiration
+    in a min-heap of (expiration, signature) pairs, so reclaiming each token costs O(log n), with no scans.
+
+    The registry lives in the memory of its process: services in other processes (e.g. the workers of a `PreforkServer`)
+    must share a registry in a shared store instead (see `SqliteTokenRegistry`), or they would ignore each other's revocations.
+    """
+
+    def __init__(self):
+        self.__issued: dict[str, Token] = {} # by signature
+        self.__issued_by_user: dict[str, set[str]] = {} # username -> signatures
+        self.__revoked: set[str] = set() # signatures
+        self.__expirations: list[tuple[datetime, str]] = [] # min-heap of (expiration, signature), for tracked tokens
+        self.__lock = threading.Condition()
+        self.__stats = dict(issued=0, revoked=0, swept=0)
+        self.__closed = False
+        self.__sweeper_thread = threading.Thread(target=self.__sweep_expired_tokens, daemon=True)
+        self.__sweeper_thread.start()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Amounts of tokens issued, revoked, and swept so far, and of the ones currently tracked (live or revoked).
+        """
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['tracked'] = len(self.__issued)
+            stats['tracked_revoked'] = len(self.__revoked)
+        return stats
+
+    def track(self, token: Token):
+        with self.__lock:
+            self.__add(token)
+            self.__stats['issued'] += 1
+
+    def __add(self, token: Token):
+        # the caller is expected to hold the lock
+        self.__issued[token.signature] = token
+        self.__issued_by_user.setdefault(token.user.username, set()).add(token.signature)
+        earliest = self.__expirations[0][0] if self.__expirations else None
+        heapq.heappush(self.__expirations, (token.expiration, token.signature))
+        if earliest is None or token.expiration < earliest:
+            self.__lock.notify() # the sweeper must wake up earlier than planned
+
+    def is_revoked(self, signature: str) -> bool:
+        return signature in self.__revoked
+
+    def revoke(self, token: Token) -> bool:
+        """
+        Revokes `token`, returning False if it was revoked already.
+        """
+        with self.__lock:
+            if token.signature in self.__revoked:
+                return False
+            if token.signature not in self.__issued:
+                self.__add(token) # issued elsewhere, so it must be reclaimed upon expiration too
+            self.__revoked.add(token.signature)
+            self.__stats['revoked'] += 1
+        return True
+
+    def revoke_user(self, username: str) -> int:
+        """
+        Revokes all the tokens issued to the user with the given `username`, returning how many they were.
+        """
+        with self.__lock:
+            signatures = self.__issued_by_user.get(username, set()) - self.__revoked
+            self.__revoked.update(signatures)
+            self.__stats['revoked'] += len(signatures)
+        return len(signatures)
+
+    def __sweep_expired_tokens(self):
+        with self.__lock:
+            while not self.__closed:
+                if not self.__expirations:
+                    self.__lock.wait()
+                    continue
+                expiration, signature = self.__expirations[0]
+                delay = (expiration - datetime.now()).total_seconds()
+                if delay > 0:
+                    self.__lock.wait(delay)
+                    continue
+                heapq.heappop(self.__expirations)
+                self.__revoked.discard(signature)
+                token = self.__issued.pop(signature, None)
+                if token is not None:
+                    signatures = self.__issued_by_user[token.user.username]
+                    signatures.discard(signature)
+                    if not signatures:
+                        del self.__issued_by_user[token.user.username]
+                self.__stats['swept'] += 1
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            self.__lock.notify()
+        self.__sweeper_thread.join()
+
+
 class InMemoryAuthenticationService(AuthenticationService, _Debuggable):
-    def __init__(self, database: UserDatabase, secret: str = None, debug: bool = True):
+    """
+    Tokens are signed via HMAC-SHA256 of their canonical encoding (see `_token_payload`), keyed with the `secret`,
+    so validating them requires no state but the secret itself. The keyed hash object is prepared once, and then copied
+    for each signature, and signatures are compared in constant time.
+
+    The payloads of the latest `token_cache_size` tokens found valid are cached by signature,
+    so that validating the same token again only costs encoding it (its expiration is checked anyway).
+
+    Issued tokens are tracked by the given `registry` (by default, an `InMemoryTokenRegistry`), so that they can be revoked,
+    one by one (`revoke_token`) or all the ones of a user at once (`revoke_user_tokens`).
+    Tokens issued by other services sharing the same secret are valid here too, and they can be revoked here as well:
+    services sharing the same secret should share the same registry too, so that they honour each other's revocations.
+    """
+
+    def __init__(self, database: UserDatabase, secret: str = None, debug: bool = True, token_cache_size: int = 1024,
+                 registry: TokenRegistry = None):
         _Debuggable.__init__(self, debug)
         self.__database = database
         if not secret:
             import uuid
             secret = str(uuid.uuid4())
-        self.__secret = secret
+        self.__mac = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256)
+        self.__verified: OrderedDict[str, bytes] = OrderedDict() # signature -> payload, in least-recently-used-first order
+        self.__verified_lock = threading.Lock()
+        self.token_cache_size = token_cache_size
+        self.__registry = registry if registry is not None else InMemoryTokenRegistry()
         self._log(f"Authentication service initialized with secret {secret}")
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Amounts of tokens issued, revoked, and swept so far, and of the ones currently tracked (see the `registry`).
+        """
+        return self.__registry.stats
+
+    def __sign(self, payload: bytes) -> str:
+        mac = self.__mac.copy()
+        mac.update(payload)
+        return mac.hexdigest()
     
     def authenticate(self, credentials: Credentials, duration: timedelta = None) -> Token:
         if duration is None:
@@ -70,16 +294,55 @@ class InMemoryAuthenticationService(AuthenticationService, _Debuggable):
         if self.__database.check_password(credentials):
             expiration = datetime.now() + duration
             user = self.__database.get_user(credentials.id)
-            signature = _compute_sha256_hash(f"{user}{expiration}{self.__secret}")
-            result = Token(user, expiration, signature)
+            result = Token(user, expiration, self.__sign(_token_payload(user, expiration)))
+            self.__registry.track(result)
             self._log(f"Generate token for user {credentials.id}: {result}")
             return result
         raise ValueError("Invalid credentials")
     
     def __validate_token_signature(self, token: Token) -> bool:
-        return token.signature == _compute_sha256_hash(f"{token.user}{token.expiration}{self.__secret}")
+        payload = _token_payload(token.user, token.expiration)
+        with self.__verified_lock:
+            cached = self.__verified.get(token.signature)
+            if cached is not None:
+                self.__verified.move_to_end(token.signature)
+        if cached is not None:
+            return hmac.compare_digest(cached, payload)
+        if not hmac.compare_digest(token.signature.encode('utf-8'), self.__sign(payload).encode('utf-8')):
+            return False
+        with self.__verified_lock:
+            self.__verified[token.signature] = payload
+            if len(self.__verified) > self.token_cache_size:
+                self.__verified.popitem(last=False)
+        return True
 
     def validate_token(self, token: Token) -> bool:
-        result = token.expiration > datetime.now() and self.__validate_token_signature(token)
-        self._log(f"{token} is " + ('valid' if result else 'invalid'))
+        # the registry is checked last, as it may be a shared store, hence slower than checking signatures
+        result = token.expiration > datetime.now() and self.__validate_token_signature(token) \
+            and not self.__registry.is_revoked(token.signature)
+        if self._debug: # rendering tokens is not for free
+            self._log(f"{token} is " + ('valid' if result else 'invalid'))
         return result
+
+    def revoke_token(self, token: Token) -> bool:
+        """
+        Revokes a valid `token`, so that it is invalid from now on, returning False if it was not valid already.
+        """
+        if not self.validate_token(token) or not self.__registry.revoke(token):
+            return False
+        with self.__verified_lock:
+            self.__verified.pop(token.signature, None)
+        self._log(f"Revoke token for user {token.user.username}")
+        return True
+
+    def revoke_user_tokens(self, username: str) -> int:
+        """
+        Revokes all the tokens issued to the user with the given `username` (by services sharing the registry),
+        returning how many they were.
+        """
+        revoked = self.__registry.revoke_user(username)
+        self._log(f"Revoke {revoked} tokens for user {username}")
+        return revoked
+
+    def close(self):
+        self.__registry.close()
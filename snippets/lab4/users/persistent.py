@@ -0,0 +1,298 @@
+from ..users import *
+from .compact import CompactUserDatabase, _UserRecord
+from .hashing import PasswordHasher
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+# Files in the data directory:
+# - 'snapshot': all users as of the beginning of some log generation G (a header, followed by one entry per user)
+# - 'log.<N>': users added during generation N, for each N >= G (one entry per user, appended as users are added)
+# Each entry is a header (payload length, CRC32 of the payload) followed by the payload, i.e. an encoded user record:
+# the role, the amount of emails, then the username, the full name, the password hash, and the emails,
+# each one as a 2-byte length followed by its bytes (a length of 0xFFFF stands for None, so longer strings are rejected):
+# UTF-8 bytes for strings, and the binary form of the hash for the password (see `pack_hash`).
+# So, a torn write at the end of a log (e.g. due to a crash) is detected, and discarded, upon startup.
+
+_ENTRY_HEADER = struct.Struct('<II')
+_SNAPSHOT_HEADER = struct.Struct('<8sQQ') # magic, generation, amount of entries
+_SNAPSHOT_MAGIC = b'USERSNAP'
+_RECORD_HEADER = struct.Struct('<BB')
+_STRING_LENGTH = struct.Struct('<H')
+_NONE_LENGTH = 0xFFFF
+_MAX_STRING_LENGTH = _NONE_LENGTH - 1
+
+
+def _encode_bytes(value: bytes | None, parts: list[bytes]):
+    if value is None:
+        parts.append(_STRING_LENGTH.pack(_NONE_LENGTH))
+        return
+    if len(value) > _MAX_STRING_LENGTH:
+        raise ValueError(f"String of {len(value)} bytes exceeds the maximum of {_MAX_STRING_LENGTH} bytes: {value[:32]!r}...")
+    parts.append(_STRING_LENGTH.pack(len(value)))
+    parts.append(value)
+
+
+def _encode_string(value: str | None, parts: list[bytes]):
+    _encode_bytes(value.encode('utf-8') if value is not None else None, parts)
+
+
+def _decode_bytes(data: memoryview, position: int) -> tuple[bytes | None, int]:
+    length, = _STRING_LENGTH.unpack_from(data, position)
+    position += _STRING_LENGTH.size
+    if length == _NONE_LENGTH:
+        return None, position
+    return bytes(data[position:position + length]), position + length
+
+
+def _decode_string(data: memoryview, position: int) -> tuple[str | None, int]:
+    value, position = _decode_bytes(data, position)
+    return (str(value, 'utf-8') if value is not None else None), position
+
+
+def _encode_entry(record: _UserRecord) -> bytes:
+    parts = [_RECORD_HEADER.pack(record.role.value, len(record.emails))]
+    _encode_string(record.username, parts)
+    _encode_string(record.full_name, parts)
+    _encode_bytes(record.password_hash, parts)
+    for email in record.emails:
+        _encode_string(email, parts)
+    payload = b''.join(parts)
+    return _ENTRY_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _decode_entries(data: memoryview, position: int = 0):
+    """
+    Iterates over the entries in `data` from `position`, yielding pairs (record, position right after it).
+    Stops at the first incomplete or corrupted entry.
+    """
+    while position + _ENTRY_HEADER.size <= len(data):
+        length, checksum = _ENTRY_HEADER.unpack_from(data, position)
+        start, end = position + _ENTRY_HEADER.size, position + _ENTRY_HEADER.size + length
+        if end > len(data) or zlib.crc32(data[start:end]) != checksum:
+            return
+        role, emails_count = _RECORD_HEADER.unpack_from(data, start)
+        cursor = start + _RECORD_HEADER.size
+        username, cursor = _decode_string(data, cursor)
+        full_name, cursor = _decode_string(data, cursor)
+        password_hash, cursor = _decode_bytes(data, cursor)
+        emails = []
+        for _ in range(emails_count):
+            email, cursor = _decode_string(data, cursor)
+            emails.append(email)
+        yield _UserRecord(username, tuple(emails), full_name, Role(role), password_hash), end # type: ignore
+        position = end
+
+
+def _fsync_directory(path: str):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return # e.g. on Windows, where directories cannot be opened (nor need to be synced) this way
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PersistentUserDatabase(CompactUserDatabase):
+    """
+    A `CompactUserDatabase` whose users survive restarts, as they are stored in the `path` directory:
+    each added user is appended to a write-ahead log, and every `snapshot_every` users the whole database is written
+    as a compacted snapshot (in background), after which older logs are deleted.
+    Upon startup, the snapshot is loaded via mmap, and then the logs following it are replayed.
+
+    Passwords are hashed by the given `hasher` before taking the lock, so that hashing does not serialize additions.
+
+    Logs are synced to disk in batches (group commit): every `sync_interval` seconds, all the users added in the meanwhile
+    are fsync-ed at once, and only then their `add_user` calls return, so that no acknowledged user is ever lost.
+    When `sync_interval` is None, logs are never fsync-ed explicitly, which is faster, but the latest users may be lost
+    upon a crash of the machine (not of the process).
+    """
+
+    def __init__(self, path: str, sync_interval: float | None = 0.01, snapshot_every: int = 100_000, debug: bool = True,
+                 hasher: PasswordHasher = None):
+        super().__init__(debug, hasher)
+        self.path = path
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.__lock = threading.Lock() # guards the database and the current log
+        self.__synced = threading.Condition(self.__lock)
+        self.__written = self.__synced_count = 0 # amounts of entries written to the current log, and synced to disk
+        self.__logged_since_snapshot = 0
+        self.__snapshot_thread: threading.Thread | None = None
+        self.__closed = False
+        os.makedirs(path, exist_ok=True)
+        self.__generation = self.__load()
+        self.__log = open(self.__log_path(self.__generation), 'ab')
+        self.__syncer_thread = None
+        if sync_interval is not None:
+            self.__syncer_thread = threading.Thread(target=self.__sync_periodically, daemon=True)
+            self.__syncer_thread.start()
+
+    def __log_path(self, generation: int) -> str:
+        return os.path.join(self.path, f'log.{generation}')
+
+    def __log_generations(self) -> list[int]:
+        names = [name for name in os.listdir(self.path) if name.startswith('log.') and name[4:].isdigit()]
+        return sorted(int(name[4:]) for name in names)
+
+    def __load(self) -> int:
+        generation = 0
+        snapshot_path = os.path.join(self.path, 'snapshot')
+        if os.path.exists(snapshot_path) and os.path.getsize(snapshot_path) >= _SNAPSHOT_HEADER.size:
+            with open(snapshot_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                view = memoryview(data)
+                try:
+                    magic, generation, count = _SNAPSHOT_HEADER.unpack_from(view)
+                    if magic != _SNAPSHOT_MAGIC:
+                        raise ValueError(f"Not a snapshot of users: {snapshot_path}")
+                    loaded = 0
+                    for record, _ in _decode_entries(view, _SNAPSHOT_HEADER.size):
+                        self._insert(record)
+                        loaded += 1
+                    if loaded != count:
+                        raise ValueError(f"Corrupted snapshot {snapshot_path}: {loaded} users out of {count}")
+                finally:
+                    view.release()
+        for log_generation in self.__log_generations():
+            if log_generation < generation:
+                os.remove(self.__log_path(log_generation)) # already included in the snapshot
+                continue
+            self.__replay(self.__log_path(log_generation))
+            generation = log_generation
+        self._log(f"Loaded {len(self)} users from {self.path}")
+        return generation
+
+    def __replay(self, log_path: str):
+        with open(log_path, 'rb') as file:
+            data = file.read()
+        end = 0
+        for record, end in _decode_entries(memoryview(data)):
+            self._insert(record)
+            self.__logged_since_snapshot += 1
+        if end < len(data): # the tail of the log is an incomplete entry, which has never been acknowledged
+            with open(log_path, 'r+b') as file:
+                file.truncate(end)
+
+    def add_user(self, user: User):
+        self._check_new(user) # fails fast, before hashing
+        self.__wait_synced(self.__append(user.copy(password=self._hasher.hash(user.password)))) # type: ignore
+
+    def add_hashed_users(self, users: list[User]) -> list[str | None]:
+        # users are appended one by one, but synced all together, with a single wait
+        errors: list[str | None] = []
+        position = None
+        for user in users:
+            try:
+                position = self.__append(user)
+                errors.append(None)
+            except Exception as e:
+                errors.append(" ".join(map(str, e.args)))
+        if position is not None:
+            self.__wait_synced(position)
+        return errors
+
+    def __append(self, user: User) -> tuple[int, int]:
+        """
+        Adds `user` (whose password is hashed already) to the database and to the log,
+        returning the position of its entry (generation and index of the entry).
+        """
+        with self.__lock:
+            if self.__closed:
+                raise ValueError("Database is closed")
+            record = self._make_record(user)
+            self.__log.write(_encode_entry(record)) # encoding fails before anything is written, if the user cannot be stored
+            self._insert(record)
+            self.__written += 1
+            position = self.__generation, self.__written
+            self.__logged_since_snapshot += 1
+            if self.__logged_since_snapshot >= self.snapshot_every:
+                self.__start_snapshot()
+        self._log(f"Add: {record.to_user()}")
+        return position
+
+    def __wait_synced(self, position: tuple[int, int]):
+        generation, written = position
+        with self.__lock:
+            if self.sync_interval is None:
+                self.__log.flush()
+                return
+            # rotating the log syncs it, so entries of previous generations are synced already
+            while self.__generation == generation and self.__synced_count < written and not self.__closed:
+                self.__synced.wait()
+
+    def __sync_periodically(self):
+        with self.__lock:
+            while not self.__closed:
+                self.__synced.wait(self.sync_interval)
+                self.__sync_log()
+
+    def __sync_log(self):
+        # the caller is expected to hold the lock
+        if self.__synced_count < self.__written:
+            self.__log.flush()
+            os.fsync(self.__log.fileno())
+            self.__synced_count = self.__written
+            self.__synced.notify_all()
+
+    def sync(self):
+        """
+        Forces all the users added so far to be synced to disk.
+        """
+        with self.__lock:
+            self.__sync_log()
+
+    def __start_snapshot(self):
+        # the caller is expected to hold the lock
+        if self.__snapshot_thread is not None and self.__snapshot_thread.is_alive():
+            return
+        self.__sync_log()
+        self.__log.close()
+        self.__generation += 1
+        self.__log = open(self.__log_path(self.__generation), 'ab')
+        self.__written = self.__synced_count = 0
+        self.__synced.notify_all()
+        self.__logged_since_snapshot = 0
+        self.__snapshot_thread = threading.Thread(target=self.__write_snapshot, args=(self._records(), self.__generation), daemon=True)
+        self.__snapshot_thread.start()
+
+    def __write_snapshot(self, records: list[_UserRecord], generation: int):
+        # records are the ones logged before the given generation, so older logs can be deleted once the snapshot is written
+        snapshot_path = os.path.join(self.path, 'snapshot')
+        with open(snapshot_path + '.tmp', 'wb', buffering=1024 * 1024) as file:
+            file.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, generation, len(records)))
+            for record in records:
+                file.write(_encode_entry(record))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+        _fsync_directory(self.path)
+        for log_generation in self.__log_generations():
+            if log_generation < generation:
+                os.remove(self.__log_path(log_generation))
+        self._log(f"Snapshot of {len(records)} users written to {snapshot_path}")
+
+    def snapshot(self):
+        """
+        Writes a snapshot of the whole database, and waits for it to be completed.
+        """
+        with self.__lock:
+            if self.__snapshot_thread is not None:
+                self.__snapshot_thread.join() # a snapshot may be in progress
+            self.__start_snapshot()
+            snapshot_thread = self.__snapshot_thread
+        snapshot_thread.join() # type: ignore
+
+    def close(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__sync_log()
+            self.__closed = True
+            self.__synced.notify_all()
+            self.__log.close()
+        if self.__snapshot_thread is not None:
+            self.__snapshot_thread.join()
@@ -0,0 +1,356 @@
+from ..users import *
+from .impl import _Debuggable
+from .hashing import PasswordHasher
+from snippets.lab3 import Client, address
+from snippets.lab4.example1_presentation import serialize, deserialize, Request, REPLICATE, APPLY
+from snippets.lab4.example3_rpc_client import RemoteUserDatabase
+import itertools
+import threading
+import traceback
+
+
+# Error raised by replicas which cannot catch up with a requested log position in time (clients then read from the primary)
+_LAGGING = "Replica lagging behind"
+
+
+class PrimaryUserDatabase(UserDatabase, _Debuggable):
+    """
+    Wraps the `database` of a primary server, keeping a change log of all the users added through it,
+    which replicas follow (see `ServerStub` and `ReplicaUserDatabase.follow`).
+    Passwords are hashed by the given `hasher`, and users are stored (see `add_hashed_users`) and logged along with their hashes,
+    so that replicas install the very same hashes, and plain passwords are never kept, nor sent to replicas.
+
+    The position of the log is the amount of users added so far: `add_user` returns the position right after the added user,
+    so that clients may ask replicas to have caught up with it before reading (read-your-writes).
+    Users are added to the database concurrently, and appended to the log once added, so that the log only has users
+    which do not conflict with each other: hence, replicas get the same users, no matter their order in the log.
+
+    Only the latest entries (between `max_log_size` / 2 and `max_log_size` of them) are kept: replicas which are behind
+    the oldest one are sent a snapshot of the whole database instead (see `hashed_users`), followed by the latest entries.
+    """
+
+    def __init__(self, database: UserDatabase, hasher: PasswordHasher = None, max_log_size: int = 100_000, debug: bool = True):
+        if max_log_size < 2:
+            raise ValueError("The log must keep at least 2 entries")
+        _Debuggable.__init__(self, debug)
+        self.__database = database
+        self.__hasher = hasher or PasswordHasher()
+        self.max_log_size = max_log_size
+        self.__log: list[User] = []
+        self.__log_start = 0 # the position of the first entry of the log
+        self.__lock = threading.Lock()
+        self.__appended = threading.Condition(self.__lock)
+        self.__closed = False
+
+    def log_position(self) -> int:
+        with self.__lock:
+            return self.__log_start + len(self.__log)
+
+    def __append(self, users: list[User]) -> int:
+        with self.__lock:
+            self.__log.extend(users)
+            if len(self.__log) > self.max_log_size: # the oldest half is dropped at once, so trimming costs O(1) per entry
+                dropped = len(self.__log) - self.max_log_size // 2
+                del self.__log[:dropped]
+                self.__log_start += dropped
+            self.__appended.notify_all()
+            return self.__log_start + len(self.__log)
+
+    def add_user(self, user: User) -> int:
+        ids = list(user.ids)
+        for id, existing in zip(ids, self.__database.get_users(ids)): # fails fast, before hashing
+            if existing is not None:
+                raise ValueError(f"User with ID {id} already exists")
+        hashed_user = user.copy(password=self.__hasher.hash(user.password) if user.password is not None else None)
+        error = self.__database.add_hashed_users([hashed_user])[0] # type: ignore
+        if error is not None:
+            raise ValueError(error)
+        return self.__append([hashed_user])
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        hashes = iter(self.__hasher.hash_all([user.password for user in users if user.password is not None])) # type: ignore
+        hashed_users = [user.copy(password=next(hashes) if user.password is not None else None) for user in users]
+        errors = self.__database.add_hashed_users(hashed_users) # type: ignore
+        self.__append([user for user, error in zip(hashed_users, errors) if error is None])
+        return errors
+
+    def get_user(self, id: str) -> User:
+        return self.__database.get_user(id)
+
+    def get_users(self, ids: list[str]) -> list[User | None]:
+        return self.__database.get_users(ids)
+
+    def check_password(self, credentials: Credentials) -> bool:
+        return self.__database.check_password(credentials)
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        return self.__database.check_passwords(credentials)
+
+    def stream(self, position: int, send, batch_size: int = 1000):
+        """
+        Passes the log from `position` on to `send(position, users, snapshot)`, in batches of at most `batch_size` users,
+        waiting for further users to be added once the end of the log is reached.
+        If entries from `position` on are no longer in the log, a snapshot of the database is passed first, in batches too
+        (with `snapshot` True, and the position of the log as of the snapshot), then an empty batch of entries from that position
+        (meaning that the snapshot is complete), and the log from that position on follows.
+        Returns once `send` raises an `OSError` (i.e. the replica is gone), or the database is closed.
+        """
+        try:
+            while True:
+                with self.__lock:
+                    while position >= self.__log_start + len(self.__log) and not self.__closed:
+                        self.__appended.wait()
+                    if self.__closed:
+                        return
+                    if position < self.__log_start:
+                        position = self.__log_start + len(self.__log)
+                        users = None
+                    else:
+                        users = self.__log[position - self.__log_start:position - self.__log_start + batch_size]
+                if users is None:
+                    self.__send_snapshot(position, send, batch_size)
+                    continue
+                send(position, users, False)
+                position += len(users)
+        except OSError:
+            return
+
+    def __send_snapshot(self, position: int, send, batch_size: int):
+        # users are added to the database before being logged, so all the users logged before `position` are in the snapshot
+        # (which may also have some of the following ones, which replicas skip when they are applied)
+        self._log(f"Sending snapshot as of position {position}")
+        users = self.__database.hashed_users() # type: ignore
+        while True:
+            batch = list(itertools.islice(users, batch_size))
+            send(position, batch, True)
+            if len(batch) < batch_size:
+                break
+        send(position, [], False) # the snapshot is complete: the replica is at its position
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            self.__appended.notify_all()
+        if hasattr(self.__database, 'close'):
+            self.__database.close()
+
+
+class ReplicaUserDatabase(UserDatabase, _Debuggable):
+    """
+    Wraps the `database` of a replica server, which is read-only for clients, and filled with the change log of a primary
+    (see `follow`), whose users are installed with their password hashes as they are (see `add_hashed_users`).
+    Reads may require the replica to have applied the log up to some `min_position`:
+    they wait for it up to `max_lag` seconds, and then fail, so that clients can read from the primary instead.
+    """
+
+    def __init__(self, database: UserDatabase, max_lag: float = 1.0, debug: bool = True):
+        _Debuggable.__init__(self, debug)
+        self.__database = database
+        self.max_lag = max_lag
+        self.__position = 0
+        self.__snapshot_position: int | None = None # the position of the log as of the latest snapshot received, if any
+        self.__lock = threading.Lock()
+        self.__applied = threading.Condition(self.__lock)
+        self.__client: Client | None = None
+        self.__closed = False
+
+    def log_position(self) -> int:
+        with self.__lock:
+            return self.__position
+
+    def apply(self, position: int, users: list[User], snapshot: bool = False):
+        """
+        Applies the entries of the log from `position` on, skipping the ones which were applied already.
+        When `snapshot` is True, `users` are (part of) a snapshot of the primary as of `position` instead:
+        they are installed, but the replica catches up with `position` only once (possibly no) entries from there on are applied.
+        """
+        with self.__lock:
+            if snapshot:
+                self.__snapshot_position = position
+                self.__install(users)
+                self._log(f"Installed {len(users)} users of a snapshot as of position {position}")
+                return
+            if position > self.__position:
+                if position != self.__snapshot_position:
+                    raise ValueError(f"Missing log entries from position {self.__position} to {position}")
+                self.__position = position # the entries before it are in the snapshot
+            users = users[self.__position - position:]
+            self.__install(users)
+            self.__position += len(users)
+            self.__applied.notify_all()
+        self._log(f"Applied {len(users)} log entries, up to position {self.__position}")
+
+    def __install(self, users: list[User]):
+        # the caller is expected to hold the lock; users which are there already (e.g. from a snapshot) are skipped
+        existing = {user.username for user in self.__database.get_users([user.username for user in users]) if user is not None}
+        for error in self.__database.add_hashed_users([user for user in users if user.username not in existing]): # type: ignore
+            if error is not None:
+                self._log(f"Cannot apply log entry: {error}")
+
+    def __wait_for(self, min_position: int | None):
+        if min_position is None:
+            return
+        with self.__lock:
+            if not self.__applied.wait_for(lambda: self.__position >= min_position, self.max_lag):
+                raise TimeoutError(f"{_LAGGING}: at position {self.__position}, rather than {min_position}")
+
+    def add_user(self, user: User):
+        raise ValueError("Replicas are read-only: users must be added via the primary")
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        raise ValueError("Replicas are read-only: users must be added via the primary")
+
+    def get_user(self, id: str, min_position: int = None) -> User:
+        self.__wait_for(min_position)
+        return self.__database.get_user(id)
+
+    def get_users(self, ids: list[str], min_position: int = None) -> list[User | None]:
+        self.__wait_for(min_position)
+        return self.__database.get_users(ids)
+
+    def check_password(self, credentials: Credentials, min_position: int = None) -> bool:
+        self.__wait_for(min_position)
+        return self.__database.check_password(credentials)
+
+    def check_passwords(self, credentials: list[Credentials], min_position: int = None) -> list[bool]:
+        self.__wait_for(min_position)
+        return self.__database.check_passwords(credentials)
+
+    def follow(self, primary_address: tuple[str, int], codec: str = 'json', retry_interval: float = 1.0):
+        """
+        Follows the change log of the primary server at `primary_address`, from the current position on,
+        via a dedicated connection over which the primary pushes log entries.
+        If the connection is lost, or the primary refuses it (e.g. as it is overloaded, or not a primary yet), it is re-opened
+        every `retry_interval` seconds, resuming from the last applied position.
+        """
+        primary_address = address(*primary_address)
+
+        def on_message_event(event, payload, connection, error):
+            match event:
+                case 'message':
+                    entries = deserialize(payload)
+                    if isinstance(entries, Request) and entries.name == APPLY:
+                        self.apply(*entries.args)
+                case 'error':
+                    traceback.print_exception(error)
+                case 'close':
+                    if not self.__closed:
+                        self._log('# Lost connection to primary %s:%d' % primary_address)
+                        retry()
+
+        def retry():
+            timer = threading.Timer(retry_interval, connect)
+            timer.daemon = True
+            timer.start()
+
+        def connect():
+            if self.__closed:
+                return
+            client = None
+            try:
+                client = Client(primary_address)
+                client.send(serialize(Request(REPLICATE, (self.log_position(),)), codec))
+                message = client.receive_bytes()
+                if message is None:
+                    raise ConnectionError("Connection closed by %s:%d before responding" % primary_address)
+                response = deserialize(message)
+                if response.error:
+                    raise RuntimeError(response.error)
+            except (OSError, RuntimeError) as e:
+                if client is not None:
+                    client.close()
+                self._log('# Cannot follow primary %s:%d, retrying in %g seconds:' % (*primary_address, retry_interval), e)
+                retry()
+                return
+            client.binary = True # entries may be encoded with any codec
+            client.callback = on_message_event
+            self.__client = client
+            self._log('# Following primary %s:%d from position %d' % (*primary_address, self.log_position()))
+
+        connect()
+
+    def close(self):
+        self.__closed = True
+        if self.__client is not None:
+            self.__client.close()
+        if hasattr(self.__database, 'close'):
+            self.__database.close()
+
+
+class ReplicatedUserDatabase(UserDatabase, _Debuggable):
+    """
+    Client of a primary server and its replicas: users are added via the `primary`, while reads are spread
+    among the `replicas` in round-robin (all of them being `RemoteUserDatabase`s). The `consistency` of reads is either:
+    - 'eventual': replicas are read as they are, so users recently added may not be found yet
+    - 'session': replicas are read once they have caught up with the latest user added via this object (read-your-writes)
+    - 'primary': reads go to the primary too, so replicas are not used at all
+    Reads fall back to the primary when a replica is unreachable, or lagging behind (see `ReplicaUserDatabase`).
+    """
+
+    CONSISTENCY_LEVELS = ('eventual', 'session', 'primary')
+
+    def __init__(self, primary: RemoteUserDatabase, replicas: list[RemoteUserDatabase], consistency: str = 'session', debug: bool = True):
+        if consistency not in self.CONSISTENCY_LEVELS:
+            raise ValueError(f"Invalid consistency {consistency!r}, expected one of {self.CONSISTENCY_LEVELS}")
+        _Debuggable.__init__(self, debug)
+        self.__primary = primary
+        self.__replicas = list(replicas)
+        self.__next_replica = itertools.cycle(self.__replicas)
+        self.consistency = consistency
+        self.__position = 0 # the position of the log right after the latest user added via this object
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, primary_address: tuple[str, int], replica_addresses: list[tuple[str, int]], consistency: str = 'session',
+                debug: bool = True, **options) -> 'ReplicatedUserDatabase':
+        """
+        Creates a replicated database reaching each server via a `RemoteUserDatabase` created with the given `options`.
+        """
+        primary = RemoteUserDatabase(primary_address, debug=debug, **options)
+        replicas = [RemoteUserDatabase(replica_address, debug=debug, **options) for replica_address in replica_addresses]
+        return cls(primary, replicas, consistency, debug)
+
+    def __advance(self, position: int):
+        with self.__lock:
+            self.__position = max(self.__position, position)
+
+    def __read(self, name: str, arg):
+        if self.consistency == 'primary' or not self.__replicas:
+            return self.__primary.rpc(name, arg)
+        with self.__lock:
+            replica = next(self.__next_replica)
+            min_position = self.__position if self.consistency == 'session' else None
+        try:
+            return replica.rpc(name, arg, min_position)
+        except RuntimeError as e:
+            if _LAGGING not in str(e):
+                raise
+            self._log(f"# Reading from primary: {e}")
+        except OSError as e:
+            self._log(f"# Reading from primary, as a replica is unreachable: {e}")
+        return self.__primary.rpc(name, arg)
+
+    def add_user(self, user: User):
+        self.__advance(self.__primary.rpc('add_user', user))
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        errors = self.__primary.add_users(users)
+        self.__advance(self.__primary.rpc('log_position'))
+        return errors
+
+    def get_user(self, id: str) -> User:
+        return self.__read('get_user', id)
+
+    def get_users(self, ids: list[str]) -> list[User | None]:
+        return self.__read('get_users', ids)
+
+    def check_password(self, credentials: Credentials) -> bool:
+        return self.__read('check_password', credentials)
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        return self.__read('check_passwords', credentials)
+
+    def close(self):
+        self.__primary.close()
+        for replica in self.__replicas:
+            replica.close()
@@ -0,0 +1,200 @@
+from ..users import *
+from .impl import _Debuggable
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import hashlib
+import threading
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto `nodes` nodes (numbered from 0): each node owns `replicas` points of a ring of hashes,
+    and each key is owned by the node of the first point following the hash of the key.
+    So, keys are evenly spread among nodes, and adding a node moves only about 1/N of the keys.
+    """
+
+    def __init__(self, nodes: int, replicas: int = 128):
+        if nodes < 1:
+            raise ValueError("The amount of nodes must be positive")
+        points = sorted((_hash(f'{node}#{replica}'), node) for node in range(nodes) for replica in range(replicas))
+        self.__hashes = [hash for hash, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    def node_of(self, key: str) -> int:
+        index = bisect.bisect(self.__hashes, _hash(key)) % len(self.__hashes)
+        return self.__nodes[index]
+
+
+class ShardedUserDatabase(UserDatabase, _Debuggable):
+    """
+    Spreads users among many user databases (the `shards`, typically `RemoteUserDatabase`s of distinct servers),
+    via consistent hashing of usernames: each user is stored, as a whole, by the shard owning its username.
+
+    As users may also be looked up by email, a directory maps each known ID to the shard storing its user.
+    The directory is filled as users are added or found through this object: IDs which are not in the directory,
+    and not found in the shard owning them as usernames, are looked up in all the other shards at once.
+
+    Before adding a user, all its IDs are looked up (in all shards, if need be), so that IDs stay unique across shards
+    (unless `check_unique_ids` is False). Within a batch, a user sharing an ID with a previous user of the same batch
+    is rejected as well, as unsharded databases do. Concurrent additions of users sharing an email via distinct shards may still race.
+    """
+
+    def __init__(self, shards: list[UserDatabase], replicas: int = 128, check_unique_ids: bool = True, debug: bool = True):
+        _Debuggable.__init__(self, debug)
+        self.__shards = list(shards)
+        self.__ring = HashRing(len(shards), replicas)
+        self.__directory: dict[str, int] = {}
+        self.__directory_lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=len(shards))
+        self.check_unique_ids = check_unique_ids
+
+    @classmethod
+    def connect(cls, server_addresses: list[tuple[str, int]], replicas: int = 128, check_unique_ids: bool = True,
+                debug: bool = True, **options) -> 'ShardedUserDatabase':
+        """
+        Creates a sharded database whose shards are the servers at `server_addresses` (the order matters),
+        each one reached via a `RemoteUserDatabase` created with the given `options`.
+        """
+        from snippets.lab4.example3_rpc_client import RemoteUserDatabase
+        shards: list[UserDatabase] = [RemoteUserDatabase(server_address, debug=debug, **options) for server_address in server_addresses]
+        return cls(shards, replicas, check_unique_ids, debug)
+
+    def shard_of(self, user: User) -> int:
+        return self.__ring.node_of(user.username)
+
+    def __remember(self, ids, shard: int):
+        with self.__directory_lock:
+            for id in ids:
+                self.__directory[id] = shard
+
+    def __candidates(self, id: str) -> int:
+        # the shard where the user with the given ID is expected to be: the one in the directory, if any,
+        # or the one owning the ID, in case it is a username
+        shard = self.__directory.get(id)
+        return shard if shard is not None else self.__ring.node_of(id)
+
+    def __broadcast(self, method: str, items: list) -> list[list]:
+        """
+        Calls the batch `method` with all `items` on all shards at once, returning their results, shard by shard.
+        """
+        futures = [self.__executor.submit(getattr(shard, method), items) for shard in self.__shards]
+        return [future.result() for future in futures]
+
+    def __locate(self, ids: list[str]) -> list[tuple[User | None, int | None]]:
+        """
+        Finds the users with the given IDs, returning pairs (user, shard), or (None, None) for the ones which are not found.
+        """
+        results: list[tuple[User | None, int | None]] = [(None, None)] * len(ids)
+        by_shard: dict[int, list[int]] = {}
+        for position, id in enumerate(ids):
+            by_shard.setdefault(self.__candidates(id), []).append(position)
+        futures = {shard: self.__executor.submit(self.__shards[shard].get_users, [ids[p] for p in positions])
+                   for shard, positions in by_shard.items()}
+        missing: list[int] = []
+        for shard, positions in by_shard.items():
+            for position, user in zip(positions, futures[shard].result()):
+                if user is not None:
+                    results[position] = (user, shard)
+                else:
+                    missing.append(position)
+        if missing: # IDs which are not where they were expected to be: they may be emails, which are unknown to the directory
+            self._log(f"Broadcast lookup of {len(missing)} IDs to all shards")
+            found = self.__broadcast('get_users', [ids[p] for p in missing])
+            for shard, users in enumerate(found):
+                for position, user in zip(missing, users):
+                    if user is not None:
+                        results[position] = (user, shard)
+        for user, location in results:
+            if user is not None:
+                self.__remember(user.ids, location) # type: ignore
+        return results
+
+    def add_user(self, user: User):
+        error = self.add_users([user])[0]
+        if error is not None:
+            raise ValueError(error)
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        errors: list[str | None] = [None] * len(users)
+        if self.check_unique_ids:
+            # usernames too, as a new username may be the email of a user stored by another shard (and vice versa)
+            ids = list({id for user in users for id in user.ids})
+            existing = {id for id, (user, _) in zip(ids, self.__locate(ids)) if user is not None}
+            for position, user in enumerate(users):
+                for id in user.ids:
+                    if id in existing:
+                        errors[position] = f"User with ID {id} already exists"
+        # users of the same batch may be sent to distinct shards, so none of them would notice that they share an ID
+        claimed: set[str] = set()
+        for position, user in enumerate(users):
+            if errors[position] is None:
+                duplicate = next((id for id in user.ids if id in claimed), None)
+                if duplicate is not None:
+                    errors[position] = f"User with ID {duplicate} already exists"
+                else:
+                    claimed.update(user.ids)
+        by_shard: dict[int, list[int]] = {}
+        for position, user in enumerate(users):
+            if errors[position] is None:
+                by_shard.setdefault(self.shard_of(user), []).append(position)
+        futures = {shard: self.__executor.submit(self.__shards[shard].add_users, [users[p] for p in positions])
+                   for shard, positions in by_shard.items()}
+        for shard, positions in by_shard.items():
+            for position, error in zip(positions, futures[shard].result()):
+                errors[position] = error
+                if error is None:
+                    self.__remember(users[position].ids, shard)
+        self._log(f"Add {errors.count(None)} users out of {len(users)}")
+        return errors
+
+    def get_user(self, id: str) -> User:
+        user, _ = self.__locate([id])[0]
+        if user is None:
+            raise KeyError(f"User with ID {id} not found")
+        self._log(f"Get user with ID {id}: {user}")
+        return user
+
+    def get_users(self, ids: list[str]) -> list[User | None]:
+        return [user for user, _ in self.__locate(ids)]
+
+    def check_password(self, credentials: Credentials) -> bool:
+        return self.check_passwords([credentials])[0]
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        # credentials are first checked by the shards where their users are expected to be, in a single round-trip;
+        # only failed checks of IDs unknown to the directory are retried where their users actually are (if anywhere)
+        positions = list(range(len(credentials)))
+        results = self.__check_passwords(credentials, positions, [self.__candidates(c.id) for c in credentials])
+        unknown = [p for p in positions if not results[p] and credentials[p].id not in self.__directory]
+        if unknown:
+            located = self.__locate([credentials[p].id for p in unknown])
+            for position, result in zip(unknown, self.__check_passwords(credentials, unknown, [shard for _, shard in located])):
+                results[position] = result
+        self._log(f"Checking {len(credentials)} credentials: {results.count(True)} correct")
+        return results
+
+    def __check_passwords(self, credentials: list[Credentials], positions: list[int], shards: list[int | None]) -> list[bool]:
+        """
+        Checks the credentials at the given `positions` on the corresponding `shards` (None means the user does not exist).
+        """
+        results = [False] * len(credentials)
+        by_shard: dict[int, list[int]] = {}
+        for position, shard in zip(positions, shards):
+            if shard is not None:
+                by_shard.setdefault(shard, []).append(position)
+        futures = {shard: self.__executor.submit(self.__shards[shard].check_passwords, [credentials[p] for p in shard_positions])
+                   for shard, shard_positions in by_shard.items()}
+        for shard, shard_positions in by_shard.items():
+            for position, result in zip(shard_positions, futures[shard].result()):
+                results[position] = result
+        return results
+
+    def close(self):
+        self.__executor.shutdown()
+        for shard in self.__shards:
+            if hasattr(shard, 'close'):
+                shard.close()
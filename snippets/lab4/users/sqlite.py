@@ -0,0 +1,285 @@
+from ..users import *
+from .impl import _Debuggable
+from .hashing import PasswordHasher
+from collections.abc import Iterator
+import sqlite3
+import threading
+import weakref
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    full_name TEXT,
+    role INTEGER NOT NULL,
+    password_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS emails (
+    email TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS emails_by_user ON emails (user_id);
+'''
+
+# Statements are constant strings with placeholders, so that each connection prepares them once, and then reuses them
+_FIND_USER_BY_USERNAME = 'SELECT id, username, full_name, role, password_hash FROM users WHERE username = ?'
+_FIND_USER_BY_EMAIL = '''
+SELECT users.id, username, full_name, role, password_hash FROM emails JOIN users ON users.id = emails.user_id WHERE email = ?
+'''
+_FIND_EMAILS = 'SELECT email FROM emails WHERE user_id = ?'
+_ID_EXISTS = 'SELECT EXISTS (SELECT 1 FROM users WHERE username = ?1) OR EXISTS (SELECT 1 FROM emails WHERE email = ?1)'
+_INSERT_USER = 'INSERT INTO users (username, full_name, role, password_hash) VALUES (?, ?, ?, ?)'
+_INSERT_EMAIL = 'INSERT INTO emails (email, user_id) VALUES (?, ?)'
+_ALL_USERS = '''
+SELECT username, full_name, role, password_hash, group_concat(email, char(0)) FROM users JOIN emails ON emails.user_id = users.id GROUP BY users.id
+'''
+
+
+class _Connection(sqlite3.Connection):
+    pass # unlike sqlite3.Connection, subclasses can be weakly referenced
+
+
+class _Connections:
+    """
+    Connections to the SQLite file at `path`, in WAL mode, so that readers never block, nor are blocked by, the (single) writer.
+    Each thread gets its own connection, as connections cannot be shared among threads; connections are closed
+    as soon as their threads terminate (or upon `close`). The `schema` is created upon the first connection.
+    """
+
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self.__local = threading.local()
+        self.__connections: weakref.WeakSet[_Connection] = weakref.WeakSet()
+        self.__closed = False
+        connection = self.get()
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.executescript(schema)
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            if self.__closed:
+                raise ValueError("Database is closed")
+            # autocommit mode (isolation_level=None), as transactions are explicitly started where needed
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False,
+                                         cached_statements=32, factory=_Connection)
+            connection.execute('PRAGMA synchronous = NORMAL') # in WAL mode, this is safe against corruption
+            connection.execute('PRAGMA foreign_keys = ON')
+            self.__local.connection = connection
+            self.__connections.add(connection) # type: ignore
+        return connection
+
+    def close(self):
+        self.__closed = True
+        for connection in list(self.__connections):
+            connection.close()
+
+
+class SqliteUserDatabase(UserDatabase, _Debuggable):
+    """
+    A user database stored in the SQLite file at `path`, so that it may be larger than RAM:
+    users are rows of a table indexed by username, while emails are rows of another table, indexed by email,
+    referring to their users. Passwords are hashed by the given `hasher`, as in `InMemoryUserDatabase`,
+    before starting transactions, so that the write lock is never held while hashing.
+    Each thread gets its own connection (see `_Connections`).
+    """
+
+    def __init__(self, path: str, debug: bool = True, hasher: PasswordHasher = None):
+        _Debuggable.__init__(self, debug)
+        self.path = path
+        self.__hasher = hasher or PasswordHasher()
+        self.__connections = _Connections(path, _SCHEMA)
+        self._log(f"SQLite user database initialized from {path}")
+
+    def __connection(self) -> sqlite3.Connection:
+        return self.__connections.get()
+
+    def __find(self, connection: sqlite3.Connection, id: str) -> tuple | None:
+        return connection.execute(_FIND_USER_BY_USERNAME, (id,)).fetchone() \
+            or connection.execute(_FIND_USER_BY_EMAIL, (id,)).fetchone()
+
+    def __check_new(self, connection: sqlite3.Connection, user: User):
+        for id in user.ids:
+            if connection.execute(_ID_EXISTS, (id,)).fetchone()[0]:
+                raise ValueError(f"User with ID {id} already exists")
+        if user.password is None:
+            raise ValueError("Password digest is required")
+
+    def __insert(self, connection: sqlite3.Connection, user: User):
+        # the caller is expected to have started a transaction, and the password of the user to be hashed already
+        self.__check_new(connection, user) # users may be added in the meanwhile, or may be repeated in the batch
+        cursor = connection.execute(_INSERT_USER, (user.username, user.full_name, user.role.value, user.password))
+        connection.executemany(_INSERT_EMAIL, [(email, cursor.lastrowid) for email in user.emails])
+
+    def add_user(self, user: User):
+        connection = self.__connection()
+        self.__check_new(connection, user) # fails fast, before hashing
+        hashed_user = user.copy(password=self.__hasher.hash(user.password)) # type: ignore
+        connection.execute('BEGIN IMMEDIATE') # writers take the lock upfront, rather than upgrading it
+        try:
+            self.__insert(connection, hashed_user)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        self._log(f"Add: {user.copy(password=None)}")
+
+    def add_users(self, users: list[User]) -> list[str | None]:
+        # passwords are hashed all at once, before starting the transaction
+        passwords = [user.password for user in users if user.password is not None]
+        hashes = iter(self.__hasher.hash_all(passwords)) # type: ignore
+        return self.add_hashed_users([user.copy(password=next(hashes) if user.password is not None else None) for user in users])
+
+    def add_hashed_users(self, users: list[User]) -> list[str | None]:
+        """
+        Adds `users` whose passwords are hashed already (e.g. by a primary, see `PrimaryUserDatabase`), storing hashes as they are.
+        """
+        # all users are inserted in a single transaction, i.e. with a single sync to disk
+        connection = self.__connection()
+        errors: list[str | None] = []
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for user in users:
+                connection.execute('SAVEPOINT add_user')
+                try:
+                    self.__insert(connection, user)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(" ".join(map(str, e.args)))
+                    connection.execute('ROLLBACK TO add_user')
+                connection.execute('RELEASE add_user')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        self._log(f"Add {errors.count(None)} users out of {len(users)}")
+        return errors
+
+    def hashed_users(self) -> Iterator[User]:
+        """
+        Iterates over all users, along with their password hashes (e.g. to take a snapshot, see `PrimaryUserDatabase`).
+        """
+        # emails cannot contain NUL characters, which thus separate the emails of each user
+        for username, full_name, role, password_hash, emails in self.__connection().execute(_ALL_USERS):
+            yield User(username, set(emails.split('\0')), full_name, Role(role), password_hash)
+
+    def get_user(self, id: str) -> User:
+        connection = self.__connection()
+        row = self.__find(connection, id)
+        if row is None:
+            raise KeyError(f"User with ID {id} not found")
+        user_id, username, full_name, role, _ = row
+        emails = {email for email, in connection.execute(_FIND_EMAILS, (user_id,))}
+        result = User(username, emails, full_name, Role(role))
+        self._log(f"Get user with ID {id}: {result}")
+        return result
+
+    def check_password(self, credentials: Credentials) -> bool:
+        row = self.__find(self.__connection(), credentials.id)
+        result = row is not None and self.__hasher.verify(credentials.password, row[4])
+        self._log(f"Checking {credentials}: {'correct' if result else 'incorrect'}")
+        return result
+
+    def check_passwords(self, credentials: list[Credentials]) -> list[bool]:
+        # only the credentials of existing users are verified, all at once
+        connection = self.__connection()
+        rows = [self.__find(connection, c.id) for c in credentials]
+        verified = iter(self.__hasher.verify_all([(c.password, row[4]) for c, row in zip(credentials, rows) if row is not None]))
+        results = [next(verified) if row is not None else False for row in rows]
+        self._log(f"Checking {len(credentials)} credentials: {results.count(True)} correct")
+        return results
+
+    def close(self):
+        self.__connections.close()
+
+
+_TOKENS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokens (
+    signature TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    expiration REAL NOT NULL,
+    revoked INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tokens_by_user ON tokens (username);
+CREATE INDEX IF NOT EXISTS tokens_by_expiration ON tokens (expiration);
+'''
+
+_TRACK_TOKEN = 'INSERT OR IGNORE INTO tokens (signature, username, expiration) VALUES (?, ?, ?)'
+_IS_REVOKED = 'SELECT revoked FROM tokens WHERE signature = ?'
+_REVOKE_TOKEN = 'UPDATE tokens SET revoked = 1 WHERE signature = ? AND NOT revoked'
+_REVOKE_USER_TOKENS = 'UPDATE tokens SET revoked = 1 WHERE username = ? AND expiration > ? AND NOT revoked'
+_SWEEP_TOKENS = 'DELETE FROM tokens WHERE expiration <= ?'
+_COUNT_TOKENS = 'SELECT count(*), coalesce(sum(revoked), 0) FROM tokens'
+
+
+class SqliteTokenRegistry:
+    """
+    A registry of tokens (see `InMemoryTokenRegistry`) stored in the SQLite file at `path`, so that many processes
+    (e.g. the workers of a `PreforkServer`) share it: a token revoked via any process is invalid in all of them.
+    Revoking is a single conditional update, so that only one of many concurrent revocations of the same token succeeds.
+    Expired tokens are deleted every `sweep_interval` seconds by a sweeper thread (of each process sharing the file).
+    """
+
+    def __init__(self, path: str, sweep_interval: float = 60.0):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.__connections = _Connections(path, _TOKENS_SCHEMA)
+        self.__stats = dict(issued=0, revoked=0, swept=0) # by this process
+        self.__stats_lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__sweeper_thread = threading.Thread(target=self.__sweep_expired_tokens, daemon=True)
+        self.__sweeper_thread.start()
+
+    def __count(self, stat: str, amount: int = 1):
+        with self.__stats_lock:
+            self.__stats[stat] += amount
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Amounts of tokens issued, revoked, and swept so far by this process, and of the ones currently tracked by all processes.
+        """
+        with self.__stats_lock:
+            stats = dict(self.__stats)
+        stats['tracked'], stats['tracked_revoked'] = self.__connections.get().execute(_COUNT_TOKENS).fetchone()
+        return stats
+
+    def track(self, token: Token):
+        self.__connections.get().execute(_TRACK_TOKEN, (token.signature, token.user.username, token.expiration.timestamp()))
+        self.__count('issued')
+
+    def is_revoked(self, signature: str) -> bool:
+        row = self.__connections.get().execute(_IS_REVOKED, (signature,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def revoke(self, token: Token) -> bool:
+        connection = self.__connections.get()
+        # tokens issued elsewhere are tracked first, so that they are deleted upon expiration too
+        connection.execute(_TRACK_TOKEN, (token.signature, token.user.username, token.expiration.timestamp()))
+        revoked = connection.execute(_REVOKE_TOKEN, (token.signature,)).rowcount == 1
+        if revoked:
+            self.__count('revoked')
+        return revoked
+
+    def revoke_user(self, username: str) -> int:
+        revoked = self.__connections.get().execute(_REVOKE_USER_TOKENS, (username, datetime.now().timestamp())).rowcount
+        self.__count('revoked', revoked)
+        return revoked
+
+    def __sweep_expired_tokens(self):
+        while not self.__closed.wait(self.sweep_interval):
+            self.sweep()
+
+    def sweep(self) -> int:
+        """
+        Deletes expired tokens, revoked or not, returning how many they were.
+        """
+        swept = self.__connections.get().execute(_SWEEP_TOKENS, (datetime.now().timestamp(),)).rowcount
+        self.__count('swept', swept)
+        return swept
+
+    def close(self):
+        self.__closed.set()
+        self.__sweeper_thread.join()
+        self.__connections.close()